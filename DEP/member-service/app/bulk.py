@@ -0,0 +1,128 @@
+from datetime import datetime
+from typing import AsyncIterator, Callable
+from pydantic import ValidationError
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, sessionmaker
+from model import Member
+from schema import MemberCreate
+import codecs
+import csv
+import json
+
+BATCH_SIZE = 1000
+
+
+# legge il corpo della richiesta a blocchi e restituisce le righe complete man mano che arrivano
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    resto = ""
+    async for chunk in chunks:
+        resto += decoder.decode(chunk)
+        *righe, resto = resto.split("\n")
+        for riga in righe:
+            yield riga.rstrip("\r")
+    resto += decoder.decode(b"", final=True)
+    if resto.strip():
+        yield resto.rstrip("\r")
+
+
+# converte ogni riga in un dizionario: CSV con riga di intestazione oppure NDJSON
+class RecordParser:
+
+    def __init__(self, formato: str):
+        self.formato = formato
+        self.intestazione: list[str] | None = None
+
+    # restituisce None per le righe da ignorare (vuote o intestazione), ValueError se la riga non è leggibile
+    def parse(self, riga: str) -> dict | None:
+        if not riga.strip():
+            return None
+        if self.formato == "ndjson":
+            try:
+                dati = json.loads(riga)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"JSON non valido: {e.msg}")
+            if not isinstance(dati, dict):
+                raise ValueError("Ogni riga deve essere un oggetto JSON")
+            return dati
+
+        valori = next(csv.reader([riga]))
+        if self.intestazione is None:
+            self.intestazione = [v.strip().lower() for v in valori]
+            return None
+        if len(valori) != len(self.intestazione):
+            raise ValueError(f"Attese {len(self.intestazione)} colonne, trovate {len(valori)}")
+        return dict(zip(self.intestazione, valori))
+
+
+# valida un nuovo membro con le regole di MemberCreate, le stesse per l'inserimento singolo e per
+# l'importazione; solleva ValueError con la descrizione degli errori
+def validate_member(dati: dict) -> dict:
+    try:
+        member = MemberCreate(**dati)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(str(l) for l in err['loc'])}: {err['msg']}" for err in e.errors()))
+    return {"cf": member.cf.upper(), "name": member.name, "surname": member.surname}
+
+
+# importa i membri a blocchi: ogni blocco costa una query IN per i duplicati, un inserimento multiplo
+# e un commit. Tiene traccia degli esiti delle righe scartate
+class MemberImport:
+
+    def __init__(self, session_factory: sessionmaker, validate: Callable[[dict], dict], batch_size: int = BATCH_SIZE):
+        self.session_factory = session_factory
+        self.validate = validate
+        self.batch_size = batch_size
+        self.aggiunti = 0
+        self.errori: list[dict] = []
+        self._batch: list[tuple[int, dict]] = []
+
+    # aggiunge una riga al blocco corrente; restituisce True quando il blocco è pieno e va salvato
+    def add(self, numero: int, dati: dict) -> bool:
+        try:
+            membro = self.validate(dati)
+        except ValueError as e:
+            self.errori.append({"riga": numero, "cf": str(dati.get("cf", "")), "esito": "invalid", "detail": str(e)})
+            return False
+        self._batch.append((numero, membro))
+        return len(self._batch) >= self.batch_size
+
+    def reject(self, numero: int, detail: str) -> None:
+        self.errori.append({"riga": numero, "cf": "", "esito": "invalid", "detail": detail})
+
+    # salva il blocco corrente in un'unica transazione
+    def flush(self) -> None:
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        db: Session = self.session_factory()
+        try:
+            cfs = {membro["cf"] for _, membro in batch}
+            esistenti = {cf for (cf,) in db.query(Member.cf).filter(Member.cf.in_(cfs))}
+
+            oggi = datetime.utcnow().date()
+            nuovi = []
+            for numero, membro in batch:
+                if membro["cf"] in esistenti:
+                    self.errori.append({"riga": numero, "cf": membro["cf"], "esito": "duplicate",
+                                        "detail": "Member already exists"})
+                    continue
+                esistenti.add(membro["cf"])  # duplicati all'interno dello stesso file
+                nuovi.append({**membro, "registration_date": oggi})
+
+            if nuovi:
+                db.execute(insert(Member).on_conflict_do_nothing(), nuovi)
+            db.commit()
+            self.aggiunti += len(nuovi)
+        finally:
+            db.close()
+
+    def result(self) -> dict:
+        duplicati = sum(1 for e in self.errori if e["esito"] == "duplicate")
+        return {
+            "aggiunti": self.aggiunti,
+            "duplicati": duplicati,
+            "non_validi": len(self.errori) - duplicati,
+            "errori": sorted(self.errori, key=lambda e: e["riga"]),
+        }
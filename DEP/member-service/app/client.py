@@ -0,0 +1,320 @@
+from collections import deque
+from threading import Lock
+from fastapi.concurrency import run_in_threadpool
+from requests.adapters import HTTPAdapter
+import asyncio
+import metrics
+import os
+import random
+import time
+import httpx
+import requests
+
+# in modalità async le chiamate attese dai gestori usano httpx invece di requests nel threadpool
+ASYNC_MODE = os.environ.get("SERVICE_MODE", "sync") == "async"
+
+# errori di rete o di protocollo che i chiamanti devono gestire, qualunque sia il client usato
+PEER_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError)
+
+
+# sollevata senza contattare il servizio quando il circuit breaker è aperto;
+# deriva da RequestException così i chiamanti la gestiscono come un errore di rete
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+# circuit breaker: dopo `failure_threshold` errori consecutivi smette di contattare
+# il servizio per `reset_timeout` secondi, poi lascia passare una sola richiesta di prova
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            # half open: una sola richiesta di prova alla volta
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._state = self.CLOSED
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+# latenze delle ultime chiamate e contatori complessivi
+class LatencyStats:
+
+    def __init__(self, window: int = 1024):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.short_circuited = 0
+        self._samples = deque(maxlen=window)
+        self._lock = Lock()
+
+    def record(self, seconds: float, error: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self._samples.append(seconds)
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def record_short_circuit(self) -> None:
+        with self._lock:
+            self.short_circuited += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            stats = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "retries": self.retries,
+                "short_circuited": self.short_circuited,
+            }
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+        stats.update(
+            avg_ms=sum(samples) / len(samples) * 1000 if samples else 0.0,
+            p50_ms=percentile(0.50),
+            p95_ms=percentile(0.95),
+            p99_ms=percentile(0.99),
+        )
+        return stats
+
+
+# client HTTP verso un altro microservizio: connessioni keep-alive riutilizzate da un pool,
+# timeout su ogni chiamata, retry con backoff esponenziale e jitter per le chiamate idempotenti
+class ServiceClient:
+    IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+    RETRY_STATUS = {502, 503, 504}
+
+    def __init__(self, base_url: str, connect_timeout: float, read_timeout: float, deadline: float,
+                 retries: int, backoff: float, pool_size: int, failure_threshold: int, reset_timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = LatencyStats()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool_size = pool_size
+        self._async_session: httpx.AsyncClient | None = None
+
+    # registra l'esito di una chiamata, retry compresi; `operation` è l'etichetta usata nelle metriche
+    def _record(self, operation: str, start: float, outcome: str) -> None:
+        seconds = time.monotonic() - start
+        if outcome != "short_circuit":
+            self.latency.record(seconds, error=outcome == "error")
+        metrics.observe_peer(self.base_url, operation, seconds, outcome)
+
+    # esegue la richiesta; `idempotent` permette di abilitare i retry anche per le POST
+    # che non modificano lo stato (es. query GraphQL)
+    def request(self, method: str, path: str, idempotent: bool | None = None, operation: str = "other",
+                **kwargs) -> requests.Response:
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        attempts = 1 + (self.retries if idempotent else 0)
+        url = f"{self.base_url}{path}"
+
+        start = time.monotonic()
+        scadenza = start + self.deadline
+        for attempt in range(attempts):
+            # a scadenza superata il timeout sarebbe nullo o negativo, che i client rifiutano con un ValueError;
+            # controllato prima del breaker, per non occupare la richiesta di prova
+            remaining = scadenza - time.monotonic()
+            if remaining <= 0:
+                self._record(operation, start, "error")
+                raise requests.exceptions.Timeout(f"Deadline exceeded for {self.base_url}")
+            if not self.breaker.allow():
+                self.latency.record_short_circuit()
+                self._record(operation, start, "error" if attempt else "short_circuit")
+                raise CircuitOpenError(f"Circuit open for {self.base_url}")
+
+            timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.breaker.record_failure()
+                if not self._retry(attempt, attempts, scadenza):
+                    self._record(operation, start, "error")
+                    raise
+                continue
+            except BaseException:
+                # anche gli altri errori contano come fallimento: se la richiesta era la prova del breaker
+                # mezzo aperto, senza un esito il breaker non lascerebbe passare più nessuna richiesta
+                self.breaker.record_failure()
+                self._record(operation, start, "error")
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+                if response.status_code in self.RETRY_STATUS and self._retry(attempt, attempts, scadenza):
+                    continue
+            else:
+                self.breaker.record_success()
+            self._record(operation, start, "error" if response.status_code >= 500 else "ok")
+            return response
+
+    # attende prima del prossimo tentativo, se c'è ancora tempo per farlo
+    def _retry(self, attempt: int, attempts: int, scadenza: float) -> bool:
+        if attempt + 1 >= attempts:
+            return False
+        pausa = random.uniform(0, self.backoff * 2 ** attempt)  # full jitter
+        if time.monotonic() + pausa >= scadenza:
+            return False
+        self.latency.record_retry()
+        time.sleep(pausa)
+        return True
+
+    # versione da attendere di `request`: in modalità async usa httpx senza occupare thread,
+    # altrimenti esegue la chiamata sincrona nel threadpool
+    async def arequest(self, method: str, path: str, idempotent: bool | None = None, operation: str = "other",
+                       **kwargs):
+        if not ASYNC_MODE:
+            return await run_in_threadpool(self.request, method, path, idempotent, operation, **kwargs)
+
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in self.IDEMPOTENT_METHODS
+        attempts = 1 + (self.retries if idempotent else 0)
+        if self._async_session is None:
+            self._async_session = httpx.AsyncClient(base_url=self.base_url, limits=httpx.Limits(
+                max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+
+        start = time.monotonic()
+        scadenza = start + self.deadline
+        for attempt in range(attempts):
+            remaining = scadenza - time.monotonic()
+            if remaining <= 0:
+                self._record(operation, start, "error")
+                raise requests.exceptions.Timeout(f"Deadline exceeded for {self.base_url}")
+            if not self.breaker.allow():
+                self.latency.record_short_circuit()
+                self._record(operation, start, "error" if attempt else "short_circuit")
+                raise CircuitOpenError(f"Circuit open for {self.base_url}")
+
+            timeout = httpx.Timeout(min(self.read_timeout, remaining), connect=min(self.connect_timeout, remaining))
+            try:
+                response = await self._async_session.request(method, path, timeout=timeout, **kwargs)
+            except httpx.TransportError:
+                self.breaker.record_failure()
+                if not await self._aretry(attempt, attempts, scadenza):
+                    self._record(operation, start, "error")
+                    raise
+                continue
+            except BaseException:
+                self.breaker.record_failure()
+                self._record(operation, start, "error")
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+                if response.status_code in self.RETRY_STATUS and await self._aretry(attempt, attempts, scadenza):
+                    continue
+            else:
+                self.breaker.record_success()
+            self._record(operation, start, "error" if response.status_code >= 500 else "ok")
+            return response
+
+    async def _aretry(self, attempt: int, attempts: int, scadenza: float) -> bool:
+        if attempt + 1 >= attempts:
+            return False
+        pausa = random.uniform(0, self.backoff * 2 ** attempt)  # full jitter
+        if time.monotonic() + pausa >= scadenza:
+            return False
+        self.latency.record_retry()
+        await asyncio.sleep(pausa)
+        return True
+
+    async def aclose(self) -> None:
+        if self._async_session is not None:
+            await self._async_session.aclose()
+            self._async_session = None
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    async def aget(self, path: str, **kwargs):
+        return await self.arequest("GET", path, **kwargs)
+
+    async def apost(self, path: str, **kwargs):
+        return await self.arequest("POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        return {"url": self.base_url, "state": self.breaker.state,
+                "consecutive_failures": self.breaker.failures, **self.latency.snapshot()}
+
+
+# crea il client verso un servizio leggendo la configurazione dalle variabili d'ambiente
+def service_client(base_url: str) -> ServiceClient:
+    return ServiceClient(
+        base_url=base_url,
+        connect_timeout=float(os.environ.get("PEER_CONNECT_TIMEOUT", "1")),
+        read_timeout=float(os.environ.get("PEER_READ_TIMEOUT", "3")),
+        deadline=float(os.environ.get("PEER_DEADLINE", "5")),
+        retries=int(os.environ.get("PEER_RETRIES", "2")),
+        backoff=float(os.environ.get("PEER_BACKOFF", "0.1")),
+        pool_size=int(os.environ.get("PEER_POOL_SIZE", "40")),
+        failure_threshold=int(os.environ.get("PEER_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.environ.get("PEER_BREAKER_RESET", "10")),
+    )
+
+
+resource_client = service_client(os.environ.get("RESOURCE_SERVICE_URL", "http://resource-service:5000"))
@@ -0,0 +1,41 @@
+from datetime import date, datetime
+from typing import Any, Iterable, Sequence
+from fastapi import Response
+import json
+import os
+
+# orjson serve solo alla modalità veloce; senza, la codifica usa il modulo json della libreria standard
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "model" valida e serializza le risposte attraverso i modelli (pydantic o i tipi strawberry) riga per riga,
+# "fast" codifica direttamente in JSON le righe lette dal database, che non hanno bisogno di essere validate
+RESPONSE_MODE = os.environ.get("RESPONSE_MODE", "model")
+FAST = RESPONSE_MODE == "fast"
+
+MEDIA_TYPE = "application/json"
+
+
+def _default(valore: Any) -> Any:
+    if isinstance(valore, (date, datetime)):
+        return valore.isoformat()
+    raise TypeError(f"Tipo non serializzabile in JSON: {type(valore).__name__}")
+
+
+# JSON compatto in bytes; le date diventano stringhe ISO 8601 come nei modelli
+def dumps(valore: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(valore)
+    return json.dumps(valore, separators=(",", ":"), ensure_ascii=False, default=_default).encode()
+
+
+# lista di oggetti JSON con le chiavi `colonne`, una per ogni tupla letta dal database
+def rows(colonne: Sequence[str], righe: Iterable[Sequence[Any]]) -> bytes:
+    return dumps([dict(zip(colonne, riga)) for riga in righe])
+
+
+# risposta con un corpo già codificato: FastAPI la restituisce senza passare dal response_model
+def response(corpo: bytes, headers: dict[str, str] | None = None) -> Response:
+    return Response(corpo, media_type=MEDIA_TYPE, headers=headers)
@@ -1,76 +1,215 @@
 from fastapi import FastAPI
-from db import engine, get_db
+from db import engine, run_db, SessionLocal, ReadSessionLocal
 from model import Base, Member
 import uvicorn
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Optional
 from schema import *
 import requests
+import json
+from client import resource_client
+import bulk
+import fastjson
+import metrics
+import outbox
+import profiling
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
+# traccia SQL per richiesta, solo con SQL_PROFILE=1
+if profiling.ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
 router = APIRouter(prefix="/members", tags=["members"])
 
+MAX_PAGINA = 1000
+BATCH_STREAM = 500
+MAX_CF_VERIFICA = 5000
+COLONNE_MEMBRO = ("cf", "name", "surname", "registration_date")
+
 
 # verifica se una persona è associata al club
 @router.get("/{cf}")
-def check_member(cf: str, db: Session = Depends(get_db)) -> MemberOut:
-    member = db.query(Member).filter(Member.cf == cf.upper()).first()
+async def check_member(cf: str) -> MemberOut:
+    member = await run_db(lambda db: db.query(Member).filter(Member.cf == cf.upper()).first(), read=True)
     if not member:
         raise HTTPException(status_code=404, detail="Member not found")
     return member
 
 
+# verifica in una sola query quali dei codici fiscali indicati appartengono a un membro del club
+@router.post("/exists")
+async def check_members(request: MembersExistRequest) -> MembersExist:
+    if len(request.cfs) > MAX_CF_VERIFICA:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_CF_VERIFICA} CFs per request")
+
+    cfs = {cf.upper() for cf in request.cfs}
+    esistenti = await run_db(lambda db: {cf for (cf,) in db.query(Member.cf).filter(Member.cf.in_(cfs))}, read=True)
+    return MembersExist(exists={cf: cf in esistenti for cf in cfs})
+
+
 # aggiunge un nuovo membro al club
 @router.post("", status_code=status.HTTP_201_CREATED)
-def add_member(member: MemberCreate, db: Session = Depends(get_db)) -> Message:
+async def add_member(member: MemberCreate) -> Message:
     cf = member.cf.upper()
 
-    # verifica se esiste già
-    existing = db.query(Member).filter(Member.cf == cf).first()
-    if existing:
-        raise HTTPException(status_code=409, detail="Member already exists")
-
-    new_member = Member(
-        cf=cf,
-        name=member.name,
-        surname=member.surname,
-        registration_date=datetime.utcnow().date()
-    )
-    db.add(new_member)
-    db.commit()
+    def aggiungi(db: Session) -> None:
+        # verifica se esiste già
+        existing = db.query(Member).filter(Member.cf == cf).first()
+        if existing:
+            raise HTTPException(status_code=409, detail="Member already exists")
+
+        new_member = Member(
+            cf=cf,
+            name=member.name,
+            surname=member.surname,
+            registration_date=datetime.utcnow().date()
+        )
+        db.add(new_member)
+        db.commit()
+
+    await run_db(aggiungi)
     return Message(detail="Member added")
 
 
-# rimuove un membro dal club
+# importa molti membri da un corpo CSV (con intestazione cf,name,surname) o NDJSON letto in streaming,
+# salvandoli a blocchi; restituisce il numero di membri aggiunti e l'esito delle righe scartate
+@router.post("/bulk")
+async def add_members_bulk(request: Request) -> ImportResult:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type == "text/csv":
+        parser = bulk.RecordParser("csv")
+    elif content_type in ("application/x-ndjson", "application/jsonl"):
+        parser = bulk.RecordParser("ndjson")
+    else:
+        raise HTTPException(status_code=415, detail="Content-Type must be text/csv or application/x-ndjson")
+
+    importer = bulk.MemberImport(SessionLocal, bulk.validate_member)
+    numero = 0
+    async for riga in bulk.read_lines(request.stream()):
+        numero += 1
+        try:
+            dati = parser.parse(riga)
+        except ValueError as e:
+            importer.reject(numero, str(e))
+            continue
+        if dati is not None and importer.add(numero, dati):
+            await run_in_threadpool(importer.flush)
+    await run_in_threadpool(importer.flush)
+
+    return ImportResult(**importer.result())
+
+
+# cancella in resource-service le prenotazioni dei membri eliminati, con una sola chiamata per blocco;
+# la cancellazione è idempotente, quindi può essere ripetuta senza effetti collaterali.
+# Per i cf tornati membri prima della consegna viene inviato l'istante dell'eliminazione, così le prenotazioni
+# del nuovo membro restano; per gli altri vengono rimosse tutte, comprese quelle accettate nel frattempo da
+# resource-service con un esito ancora in cache. `inviato` permette a resource-service di riportare gli istanti
+# sul proprio orologio invece di confrontarli direttamente con le sue prenotazioni
+def send_cancellazioni(cancellati: Dict[str, datetime]) -> None:
+    with ReadSessionLocal() as db:
+        riaggiunti = {cf for (cf,) in db.query(Member.cf).filter(Member.cf.in_(cancellati))}
+    response = resource_client.post("/resources/prenotazioni/cancella", json={
+        "cfs": sorted(cancellati),
+        "cancellati": {cf: istante.isoformat() for cf, istante in cancellati.items() if cf in riaggiunti},
+        "inviato": datetime.utcnow().isoformat(),
+    }, idempotent=True, operation="cascade")
+    if response.status_code != 200:
+        raise requests.HTTPError(f"Errore {response.status_code} nel cancellare le prenotazioni")
+
+
+cancellazioni = outbox.dispatcher(SessionLocal, send_cancellazioni, outbox.CANCELLA_PRENOTAZIONI)
+
+
+# rimuove un membro dal club; la cancellazione delle sue prenotazioni viene registrata nell'outbox
+# nella stessa transazione e consegnata a resource-service in background
 @router.delete("/{cf}")
-def delete_member(cf: str, db: Session = Depends(get_db)) -> Message:
+async def delete_member(cf: str) -> Message:
     cf = cf.upper()
 
-    # verifica se il membro esiste
-    member = db.query(Member).filter(Member.cf == cf).first()
-    if not member:
-        raise HTTPException(status_code=404, detail="Member not found")
-    db.delete(member)
-    db.commit()
+    def rimuovi(db: Session) -> None:
+        # verifica se il membro esiste
+        member = db.query(Member).filter(Member.cf == cf).first()
+        if not member:
+            raise HTTPException(status_code=404, detail="Member not found")
+        db.delete(member)
+        outbox.enqueue(db, outbox.CANCELLA_PRENOTAZIONI, cf)
+        db.commit()
 
-    # rimozione delle prenotazioni del membro
-    try:
-        url = f"http://resource-service:5000/resources/prenotazioni/{cf}"
-        response = requests.delete(url)
-        if response.status_code != 204:
-            raise HTTPException(status_code=502, detail=f"Errore nel cancellare le prenotazioni per {cf}")
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Servizio prenotazioni non raggiungibile: {str(e)}")
+    await run_db(rimuovi)
+    cancellazioni.notify()
 
     return Message(detail="Member deleted")
 
 
-# mostra tutti i membri presenti
+# stato del circuit breaker e latenze delle chiamate a resource-service
+@router.get("/stats/resource-service")
+async def get_resource_service_stats() -> ClientStats:
+    return ClientStats(**resource_client.stats())
+
+
+# cancellazioni di prenotazioni in attesa di essere consegnate a resource-service
+@router.get("/stats/outbox")
+async def get_outbox_stats() -> OutboxStats:
+    return OutboxStats(**await run_db(cancellazioni.stats, read=True))
+
+
+# scrive i membri in formato NDJSON leggendoli a blocchi, così la memoria usata non dipende dal numero di righe
+def stream_members(after: Optional[str], limit: Optional[int]):
+    db: Session = ReadSessionLocal()
+    try:
+        query = db.query(Member.cf, Member.name, Member.surname, Member.registration_date).order_by(Member.cf)
+        if after:
+            query = query.filter(Member.cf > after.upper())
+        if limit:
+            query = query.limit(limit)
+
+        righe = []
+        for cf, name, surname, registration_date in query.yield_per(BATCH_STREAM):
+            righe.append(json.dumps({"cf": cf, "name": name, "surname": surname,
+                                     "registration_date": registration_date.isoformat()}) + "\n")
+            if len(righe) == BATCH_STREAM:
+                yield "".join(righe)
+                righe = []
+        if righe:
+            yield "".join(righe)
+    finally:
+        db.close()
+
+
+# mostra i membri presenti ordinati per codice fiscale: senza `limit` li restituisce tutti, altrimenti
+# una pagina a partire dal cf successivo ad `after`; il cursore della pagina successiva è nell'header X-Next-After.
+# Con format=ndjson la risposta viene trasmessa una riga per membro man mano che viene letta
 @router.get("", response_model=List[MemberOut])
-def all_members(db: Session = Depends(get_db)) -> List[MemberOut]:
-    members = db.query(Member).all()
+async def all_members(response: Response, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGINA),
+                      after: Optional[str] = None,
+                      format: str = Query("json", pattern="^(json|ndjson)$")) -> List[MemberOut]:
+    if format == "ndjson":
+        return StreamingResponse(stream_members(after, limit), media_type="application/x-ndjson")
+
+    def leggi(db: Session, *colonne) -> list:
+        query = db.query(*colonne).order_by(Member.cf)
+        if after:
+            query = query.filter(Member.cf > after.upper())
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    # modalità veloce: le tuple lette dal database vanno direttamente in JSON, senza creare gli oggetti
+    # dell'ORM né validare ogni riga con MemberOut
+    if fastjson.FAST:
+        righe = await run_db(leggi, Member.cf, Member.name, Member.surname, Member.registration_date, read=True)
+        headers = {"X-Next-After": righe[-1].cf} if limit is not None and len(righe) == limit else None
+        return fastjson.response(fastjson.rows(COLONNE_MEMBRO, righe), headers)
+
+    members = await run_db(leggi, Member, read=True)
+    if limit is None:
+        return members
+    if len(members) == limit:
+        response.headers["X-Next-After"] = members[-1].cf
     return members
 
 
@@ -78,5 +217,22 @@ app.include_router(router)
 Base.metadata.create_all(bind=engine)
 
 
+# metriche in formato Prometheus: latenze per route, statement SQL per richiesta, chiamate agli altri servizi
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# consegna le cancellazioni rimaste in sospeso e quelle registrate da qui in avanti
+@app.on_event("startup")
+def start_outbox():
+    cancellazioni.start()
+
+
+@app.on_event("shutdown")
+def stop_outbox():
+    cancellazioni.stop()
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=5000)
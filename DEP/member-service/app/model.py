@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Date
+from sqlalchemy import Column, String, Date, DateTime, Integer
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -10,3 +10,15 @@ class Member(Base):
     name = Column(String(50), index=True)
     surname = Column(String(50), index=True)
     registration_date = Column(Date, index=True)
+
+
+# eventi da consegnare a resource-service, scritti nella stessa transazione della modifica che li genera
+class Outbox(Base):
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    tipo = Column(String(50), nullable=False)
+    cf = Column(String(16), nullable=False)
+    creato = Column(DateTime, nullable=False)
+    tentativi = Column(Integer, nullable=False, default=0)
+    prossimo_tentativo = Column(DateTime, nullable=False, index=True)
+    ultimo_errore = Column(String(500))
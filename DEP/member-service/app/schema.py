@@ -1,5 +1,6 @@
 from pydantic import BaseModel, constr
 from datetime import date
+from typing import Dict, List, Optional
 
 
 class MemberCreate(BaseModel):
@@ -20,3 +21,48 @@ class MemberOut(BaseModel):
 
 class Message(BaseModel):
     detail: str
+
+
+class MembersExistRequest(BaseModel):
+    cfs: List[str]
+
+
+class MembersExist(BaseModel):
+    exists: Dict[str, bool]
+
+
+class RigaScartata(BaseModel):
+    riga: int
+    cf: str
+    esito: str  # duplicate oppure invalid
+    detail: str
+
+
+class ImportResult(BaseModel):
+    aggiunti: int
+    duplicati: int
+    non_validi: int
+    errori: List[RigaScartata]
+
+
+class ClientStats(BaseModel):
+    url: str
+    state: str
+    consecutive_failures: int
+    requests: int
+    errors: int
+    retries: int
+    short_circuited: int
+    avg_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+class OutboxStats(BaseModel):
+    tipo: str
+    in_attesa: int
+    attesa_massima_s: float
+    consegnati: int
+    errori: int
+    ultimo_errore: Optional[str]
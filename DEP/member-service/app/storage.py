@@ -0,0 +1,83 @@
+from typing import TYPE_CHECKING
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+import os
+
+# l'estensione asyncio viene caricata da create_async_engines solo in modalità async, qui serve alle annotazioni
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+# configurazione di SQLite e dei pool di connessioni, letta dalle variabili d'ambiente
+class StorageConfig:
+
+    def __init__(self, journal_mode: str = "WAL", busy_timeout: int = 5000, synchronous: str = "NORMAL",
+                 cache_size: int = -16000, mmap_size: int = 64 * 1024 * 1024,
+                 read_pool_size: int = 8, read_pool_overflow: int = 8, pool_timeout: float = 30):
+        self.journal_mode = journal_mode
+        self.busy_timeout = busy_timeout        # millisecondi di attesa se il database è bloccato
+        self.synchronous = synchronous
+        self.cache_size = cache_size            # se negativo è espresso in KiB
+        self.mmap_size = mmap_size
+        self.read_pool_size = read_pool_size
+        self.read_pool_overflow = read_pool_overflow
+        self.pool_timeout = pool_timeout
+
+    @classmethod
+    def from_env(cls) -> "StorageConfig":
+        return cls(
+            journal_mode=os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+            busy_timeout=int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000")),
+            synchronous=os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+            cache_size=int(os.environ.get("SQLITE_CACHE_SIZE", "-16000")),
+            mmap_size=int(os.environ.get("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024))),
+            read_pool_size=int(os.environ.get("DB_READ_POOL_SIZE", "8")),
+            read_pool_overflow=int(os.environ.get("DB_READ_POOL_OVERFLOW", "8")),
+            pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        )
+
+
+# imposta i pragma su ogni nuova connessione; le connessioni di sola lettura rifiutano le scritture
+def _pragmas(config: StorageConfig, read_only: bool):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            cursor.execute(f"PRAGMA journal_mode={config.journal_mode}")
+        cursor.execute(f"PRAGMA busy_timeout={config.busy_timeout}")
+        cursor.execute(f"PRAGMA synchronous={config.synchronous}")
+        cursor.execute(f"PRAGMA cache_size={config.cache_size}")
+        cursor.execute(f"PRAGMA mmap_size={config.mmap_size}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return on_connect
+
+
+# crea l'engine di scrittura e quello di lettura sullo stesso file:
+# le scritture passano da un'unica connessione, così sono serializzate nel processo e non
+# competono per il lock del database, mentre le letture usano un pool separato che in WAL
+# non viene bloccato dalle scritture in corso
+def create_engines(path: str, config: StorageConfig) -> tuple[Engine, Engine]:
+    url = f"sqlite:///{path}"
+    writer = create_engine(url, connect_args={"check_same_thread": False},
+                           pool_size=1, max_overflow=0, pool_timeout=config.pool_timeout)
+    reader = create_engine(url, connect_args={"check_same_thread": False},
+                           pool_size=config.read_pool_size, max_overflow=config.read_pool_overflow,
+                           pool_timeout=config.pool_timeout)
+    event.listen(writer, "connect", _pragmas(config, read_only=False))
+    event.listen(reader, "connect", _pragmas(config, read_only=True))
+    return writer, reader
+
+
+# come create_engines, ma con il driver aiosqlite: le attese sul database non occupano un thread
+# del pool di FastAPI. I pragma vengono impostati tramite l'engine sincrono sottostante
+def create_async_engines(path: str, config: StorageConfig) -> tuple["AsyncEngine", "AsyncEngine"]:
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = f"sqlite+aiosqlite:///{path}"
+    writer = create_async_engine(url, pool_size=1, max_overflow=0, pool_timeout=config.pool_timeout)
+    reader = create_async_engine(url, pool_size=config.read_pool_size, max_overflow=config.read_pool_overflow,
+                                 pool_timeout=config.pool_timeout)
+    event.listen(writer.sync_engine, "connect", _pragmas(config, read_only=False))
+    event.listen(reader.sync_engine, "connect", _pragmas(config, read_only=True))
+    return writer, reader
@@ -0,0 +1,202 @@
+from datetime import date, datetime, timedelta
+from threading import Event, Lock, Thread
+from sqlalchemy import Date, bindparam, create_engine, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from availability import availability
+from migrations import add_missing_columns
+from model import Base, OccupazionePiscina, PrenotazioniCampi, PrenotazioniPiscina
+from occupancy import occupancy
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# SQLite permette al più 10 database collegati a una connessione
+MAX_ATTACHED = 8
+TABELLE = (PrenotazioniCampi.__table__, PrenotazioniPiscina.__table__)
+_FILE_STAGIONE = re.compile(r"^prenotazioni-(\d{4})\.db$")
+
+
+# archivio delle prenotazioni passate: le righe con data precedente al limite vengono spostate dalle
+# tabelle del servizio in un file SQLite per stagione (anno), così le tabelle calde contengono solo
+# le date correnti e future e restano nella cache delle pagine.
+# Lo spostamento avviene a blocchi: ogni blocco viene prima copiato nell'archivio (INSERT OR IGNORE sulla
+# chiave primaria) e poi cancellato con una transazione breve sull'engine di scrittura, con una pausa tra
+# un blocco e l'altro per lasciare spazio alle prenotazioni. Se il processo si interrompe tra i due passi,
+# le righe restano in entrambi i database e il blocco viene ripetuto al giro successivo; le letture
+# storiche usano UNION, quindi non vedono doppioni nel frattempo
+class Archive:
+
+    def __init__(self, directory: str, keep_days: int, batch_size: int, pause: float, interval: float):
+        self.directory = directory
+        self.keep_days = keep_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.archiviate = {tabella.name: 0 for tabella in TABELLE}
+        self.ultima_esecuzione: datetime | None = None
+        self.ultimo_errore: str | None = None
+        self._engines: dict[int, Engine] = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: Thread | None = None
+
+    def path(self, stagione: int) -> str:
+        return os.path.join(self.directory, f"prenotazioni-{stagione}.db")
+
+    # stagioni già archiviate, in ordine
+    def seasons(self) -> list[int]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(m.group(1)) for m in map(_FILE_STAGIONE.match, os.listdir(self.directory)) if m)
+
+    # le prenotazioni con data precedente vengono archiviate
+    def cutoff(self) -> date:
+        return date.today() - timedelta(days=self.keep_days)
+
+    def _engine(self, stagione: int) -> Engine:
+        with self._lock:
+            engine = self._engines.get(stagione)
+            if engine is None:
+                os.makedirs(self.directory, exist_ok=True)
+                engine = create_engine(f"sqlite:///{self.path(stagione)}")
+                Base.metadata.create_all(bind=engine, tables=list(TABELLE))
+                add_missing_columns(engine, TABELLE)
+                self._engines[stagione] = engine
+            return engine
+
+    # sposta nell'archivio tutte le prenotazioni precedenti al limite; restituisce le righe spostate per tabella
+    def run(self, write_session: sessionmaker, read_session: sessionmaker, limite: date | None = None) -> dict:
+        limite = limite or self.cutoff()
+        spostate = {}
+        for tabella in TABELLE:
+            spostate[tabella.name] = 0
+            while not self._stop.is_set():
+                n = self._move_batch(tabella, write_session, read_session, limite)
+                if not n:
+                    break
+                spostate[tabella.name] += n
+                self.archiviate[tabella.name] += n
+                time.sleep(self.pause)
+
+        # i contatori della piscina delle date archiviate non servono più
+        with write_session() as db:
+            db.query(OccupazionePiscina).filter(OccupazionePiscina.data < limite).delete(synchronize_session=False)
+            db.commit()
+        self.ultima_esecuzione = datetime.utcnow()
+        return spostate
+
+    def _move_batch(self, tabella, write_session: sessionmaker, read_session: sessionmaker, limite: date) -> int:
+        with read_session() as db:
+            righe = db.execute(tabella.select().where(tabella.c.data < limite).order_by(
+                tabella.c.id).limit(self.batch_size)).mappings().all()
+        if not righe:
+            return 0
+
+        stagioni: dict[int, list[dict]] = {}
+        for riga in righe:
+            stagioni.setdefault(riga["data"].year, []).append(dict(riga))
+        for stagione, blocco in stagioni.items():
+            with self._engine(stagione).begin() as conn:
+                conn.execute(insert(tabella).prefix_with("OR IGNORE"), blocco)
+
+        with write_session() as db:
+            db.execute(tabella.delete().where(tabella.c.id.in_([riga["id"] for riga in righe])))
+            db.commit()
+
+        # le date archiviate escono dall'indice dell'occupazione e dalla cache della disponibilità
+        if tabella is PrenotazioniCampi.__table__:
+            for riga in righe:
+                occupancy.release(riga["data"], riga["tipologia"], riga["ora"])
+        availability.bump(*(riga["data"] for riga in righe))
+        return len(righe)
+
+    # prenotazioni dei membri indicati tra due date, dalle tabelle del servizio e dagli archivi delle
+    # stagioni comprese nell'intervallo, collegati alla connessione solo per la durata della lettura
+    def history(self, db: Session, cfs: list[str], dal: date, al: date) -> tuple[list, list]:
+        stagioni = [s for s in self.seasons() if dal.year <= s <= al.year] if dal < self.cutoff() else []
+        conn = db.connection()
+        campi, piscina = [], []
+        # il database principale va letto una sola volta, anche quando gli archivi sono divisi in più gruppi
+        gruppi = [stagioni[i:i + MAX_ATTACHED] for i in range(0, len(stagioni), MAX_ATTACHED)] or [[]]
+        for numero, gruppo in enumerate(gruppi):
+            schemi = (["main"] if numero == 0 else []) + [f"stagione_{s}" for s in gruppo]
+            for stagione in gruppo:
+                conn.exec_driver_sql(f"ATTACH DATABASE ? AS stagione_{stagione}", (self.path(stagione),))
+            try:
+                campi += conn.execute(_union(schemi, "cf, data, ora, tipologia", "PrenotazioniCampi", "data, ora"),
+                                      {"cfs": cfs, "dal": dal, "al": al}).all()
+                piscina += conn.execute(_union(schemi, "cf, data, lettini, ombrelloni", "PrenotazioniPiscina", "data"),
+                                        {"cfs": cfs, "dal": dal, "al": al}).all()
+            finally:
+                for stagione in gruppo:
+                    conn.exec_driver_sql(f"DETACH DATABASE stagione_{stagione}")
+        # UNION elimina i doppioni all'interno di un gruppo, qui quelli tra gruppi diversi
+        return sorted(set(campi), key=lambda r: (r[1], r[2])), sorted(set(piscina), key=lambda r: r[1])
+
+    def start(self, write_session: sessionmaker, read_session: sessionmaker) -> None:
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._loop, args=(write_session, read_session), name="archive", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self, write_session: sessionmaker, read_session: sessionmaker) -> None:
+        while not self._stop.is_set():
+            try:
+                spostate = self.run(write_session, read_session)
+                self.ultimo_errore = None
+                if any(spostate.values()):
+                    logger.info("Prenotazioni archiviate: %s", spostate)
+            except Exception as errore:
+                logger.exception("Errore nell'archiviazione delle prenotazioni")
+                self.ultimo_errore = str(errore)
+            self._stop.wait(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "stagioni": self.seasons(),
+            "limite": self.cutoff(),
+            "archiviate_campi": self.archiviate[PrenotazioniCampi.__tablename__],
+            "archiviate_piscina": self.archiviate[PrenotazioniPiscina.__tablename__],
+            "ultima_esecuzione": self.ultima_esecuzione,
+            "ultimo_errore": self.ultimo_errore,
+        }
+
+
+def _union(schemi: list[str], colonne: str, tabella: str, ordine: str):
+    parti = [f'SELECT {colonne} FROM {schema}."{tabella}" WHERE cf IN :cfs AND data BETWEEN :dal AND :al'
+             for schema in schemi]
+    return text(" UNION ".join(parti) + f" ORDER BY {ordine}").bindparams(
+        bindparam("cfs", expanding=True), bindparam("dal", type_=Date), bindparam("al", type_=Date)).columns(
+        data=Date)
+
+
+archive = Archive(
+    directory=os.environ.get("ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "db/archivio")),
+    keep_days=int(os.environ.get("ARCHIVE_KEEP_DAYS", "0")),
+    batch_size=int(os.environ.get("ARCHIVE_BATCH_SIZE", "1000")),
+    pause=float(os.environ.get("ARCHIVE_PAUSE", "0.05")),
+    # secondi tra un'archiviazione e la successiva; 0 disattiva il thread (archiviazione solo da riga di comando)
+    interval=float(os.environ.get("ARCHIVE_INTERVAL", "86400")),
+)
+
+
+# uso da riga di comando (ad esempio da cron con ARCHIVE_INTERVAL=0): `python archive.py` archivia
+# le prenotazioni precedenti al limite. Con il servizio in esecuzione l'indice dell'occupazione del
+# servizio non viene aggiornato, ma contiene solo date passate, che non si possono prenotare
+if __name__ == "__main__":
+    from db import SessionLocal, ReadSessionLocal
+
+    logging.basicConfig(level=logging.INFO)
+    print(archive.run(SessionLocal, ReadSessionLocal))
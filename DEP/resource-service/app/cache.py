@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from threading import Lock
+import os
+import time
+
+
+# cache LRU con scadenza (TTL) dell'esito delle verifiche sui membri:
+# memorizza sia gli esiti positivi che quelli negativi, i negativi con una durata
+# più breve perché un membro può iscriversi in qualsiasi momento
+class MemberCache:
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple[bool, float]]" = OrderedDict()
+        self._lock = Lock()
+
+    # restituisce l'esito memorizzato oppure None se assente o scaduto
+    def get(self, cf: str) -> bool | None:
+        with self._lock:
+            entry = self._entries.get(cf)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[cf]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cf)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, cf: str, exists: bool) -> None:
+        if self.maxsize <= 0:
+            return
+        scadenza = time.monotonic() + (self.ttl if exists else self.negative_ttl)
+        with self._lock:
+            self._entries[cf] = (exists, scadenza)
+            self._entries.move_to_end(cf)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, cf: str) -> None:
+        with self._lock:
+            self._entries.pop(cf, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            richieste = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "negative_ttl": self.negative_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / richieste if richieste else 0.0,
+            }
+
+
+member_cache = MemberCache(
+    maxsize=int(os.environ.get("MEMBER_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("MEMBER_CACHE_TTL", "300")),
+    negative_ttl=float(os.environ.get("MEMBER_CACHE_NEGATIVE_TTL", "5")),
+)
@@ -1,18 +1,48 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker
+from fastapi.concurrency import run_in_threadpool
+from storage import StorageConfig, create_engines, create_async_engines
+import metrics
 import os
+import profiling
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "db/resources.db")
-DATABASE_URL = f"sqlite:///{DB_PATH}"
+DB_PATH = os.environ.get("DB_PATH", os.path.join(os.path.dirname(__file__), "db/resources.db"))
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# "sync" esegue le query con l'engine sincrono nel threadpool, "async" con l'engine aiosqlite
+SERVICE_MODE = os.environ.get("SERVICE_MODE", "sync")
+ASYNC_MODE = SERVICE_MODE == "async"
+config = StorageConfig.from_env()
+
+# engine di scrittura (connessione unica) e engine di sola lettura con il proprio pool
+engine, read_engine = create_engines(DB_PATH, config)
+metrics.instrument_engine(engine, "write")
+metrics.instrument_engine(read_engine, "read")
+profiling.instrument_engine(engine, "write")
+profiling.instrument_engine(read_engine, "read")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# gli engine asincroni vengono creati solo in modalità async, così aiosqlite serve solo in quel caso
+if ASYNC_MODE:
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    async_engine, async_read_engine = create_async_engines(DB_PATH, config)
+    metrics.instrument_engine(async_engine.sync_engine, "write_async")
+    metrics.instrument_engine(async_read_engine.sync_engine, "read_async")
+    profiling.instrument_engine(async_engine.sync_engine, "write_async")
+    profiling.instrument_engine(async_read_engine.sync_engine, "read_async")
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
+
 
+def _call(session_factory: sessionmaker, fn, *args):
+    with session_factory() as db:
+        return fn(db, *args)
 
-def get_db() -> Session:
-    db: Session = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+# esegue fn(db, *args) con una sessione sincrona senza bloccare l'event loop: in modalità async
+# tramite AsyncSession.run_sync sull'engine aiosqlite, altrimenti in un thread del threadpool
+async def run_db(fn, *args, read: bool = False):
+    if ASYNC_MODE:
+        async with (AsyncReadSessionLocal if read else AsyncSessionLocal)() as db:
+            return await db.run_sync(fn, *args)
+    return await run_in_threadpool(_call, ReadSessionLocal if read else SessionLocal, fn, *args)
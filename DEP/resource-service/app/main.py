@@ -1,116 +1,365 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
-from db import engine, get_db
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response
+from db import engine, run_db, SessionLocal, ReadSessionLocal
 import uvicorn
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert
 from model import *
-import requests
 from schema import *
-from datetime import date
+from datetime import date, datetime, timedelta, timezone
+from typing import List
+from archive import archive
+from availability import availability
+from cache import member_cache
+from client import member_client, PEER_ERRORS
+from occupancy import occupancy
+import capacity
+import fastjson
+import metrics
+import migrations
+import profiling
 
 
 router = APIRouter(prefix="/resources", tags=["resources"])
 app = FastAPI(title="Resource Service")
+app.add_middleware(metrics.MetricsMiddleware)
+# traccia SQL per richiesta, solo con SQL_PROFILE=1
+if profiling.ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
 
 
 # Funzione di supporto per verificare se un membro esiste e quindi può effettuare prenotazioni
-def check_member(cf: str) -> bool:
-    member_service_url = f"http://member-service:5000/members/{cf}"
+async def check_member(cf: str) -> bool:
+    # esito già noto dalla cache
+    cached = member_cache.get(cf)
+    if cached is not None:
+        return cached
 
     try:
-        response = requests.get(member_service_url)
+        response = await member_client.aget(f"/members/{cf}", operation="check_member")
         if response.status_code == 404:
+            member_cache.set(cf, False)
             return False
         response.raise_for_status()  # solleva eccezione per altri errori
+        member_cache.set(cf, True)
         return True
-    except requests.exceptions.RequestException as e:
+    except PEER_ERRORS as e:
         raise HTTPException(status_code=503, detail=f"Cannot reach member service: {str(e)}")
 
 
-# mostra gli orari liberi di uno specifico campo in una certa data
-@router.get("/campiliberi/{data}/{tipologia}")
-def get_campo(data: date, tipologia: TipologiaEnum, db: Session = Depends(get_db)) -> Message:
+# versione di check_member per molti membri: i codici fiscali non presenti in cache
+# vengono verificati con una sola chiamata a member-service
+async def check_members(cfs: list[str]) -> dict[str, bool]:
+    esiti = {}
+    mancanti = []
+    for cf in {cf.upper() for cf in cfs}:
+        cached = member_cache.get(cf)
+        if cached is None:
+            mancanti.append(cf)
+        else:
+            esiti[cf] = cached
+    if not mancanti:
+        return esiti
+
+    try:
+        response = await member_client.apost("/members/exists", json={"cfs": mancanti}, idempotent=True,
+                                             operation="check_members")
+        response.raise_for_status()
+        for cf, exists in response.json()["exists"].items():
+            member_cache.set(cf, exists)
+            esiti[cf] = exists
+        return esiti
+    except PEER_ERRORS as e:
+        raise HTTPException(status_code=503, detail=f"Cannot reach member service: {str(e)}")
 
-    ore_disponibili = range(10, 22)
-    liberi = []
 
-    for ora in ore_disponibili:
-        prenotazione = (
-                db.query(PrenotazioniCampi).filter(
-                    PrenotazioniCampi.data == data,
-                    PrenotazioniCampi.ora == ora,
-                    PrenotazioniCampi.tipologia == tipologia).first()
-            )
+MAX_GIORNI_CALENDARIO = 92
+MAX_SLOT_PRENOTAZIONE = 36
+MAX_CF_CANCELLAZIONE = 1000
+MAX_STAGIONI_STORICO = 10
+
+
+# aggiorna lo schema dei database esistenti (vincolo di unicità sugli slot, indici), carica in memoria
+# l'occupazione dei campi, da cui vengono servite le letture, e riallinea i contatori giornalieri della piscina
+@app.on_event("startup")
+def load_occupancy():
+    migrations.migrate(engine)
+    db: Session = SessionLocal()
+    try:
+        occupancy.load(db)
+        capacity.rebuild(db)
+    finally:
+        db.close()
+
+
+# imposta l'ETag della risposta sulla disponibilità e restituisce una risposta 304 se il client
+# ha già la versione corrente (If-None-Match), così chi interroga periodicamente non riceve il corpo
+def not_modified(request: Request, response: Response, etag: str) -> Response | None:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    richiesti = {t.strip().removeprefix("W/") for t in request.headers.get("if-none-match", "").split(",")}
+    if "*" in richiesti or etag.removeprefix("W/") in richiesti:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
 
-        if not prenotazione:
-            liberi.append(ora)
 
-    liberi_str = ", ".join(str(ora) for ora in liberi)
-    return Message(detail=liberi_str)
+# in modalità veloce la cache della disponibilità contiene il corpo già codificato della risposta,
+# che viene restituito così com'è con gli header impostati da not_modified
+def encoded(corpo: bytes, response: Response) -> Response:
+    return fastjson.response(corpo, {"ETag": response.headers["etag"],
+                                     "Cache-Control": response.headers["cache-control"]})
+
+
+# mostra gli orari liberi di tutti i campi in una certa data
+@router.get("/campiliberi/{data}/all")
+async def get_campi(data: date, request: Request, response: Response) -> CampiLiberi:
+    versione = availability.version(data)
+    if risposta := not_modified(request, response, availability.etag(data, "all", versione)):
+        return risposta
+
+    liberi = availability.get(data, "all", versione)
+    if liberi is None:
+        orari = {t.value: ", ".join(str(ora) for ora in occupancy.free_hours(data, t.value)) for t in TipologiaEnum}
+        liberi = fastjson.dumps(orari) if fastjson.FAST else CampiLiberi(**orari)
+        availability.set(data, "all", versione, liberi)
+    return encoded(liberi, response) if fastjson.FAST else liberi
+
+
+# mostra gli orari liberi di uno specifico campo in una certa data
+@router.get("/campiliberi/{data}/{tipologia}")
+async def get_campo(data: date, tipologia: TipologiaEnum, request: Request, response: Response) -> Message:
+    versione = availability.version(data)
+    if risposta := not_modified(request, response, availability.etag(data, tipologia.value, versione)):
+        return risposta
+
+    liberi_str = availability.get(data, tipologia.value, versione)
+    if liberi_str is None:
+        liberi = occupancy.free_hours(data, tipologia.value)
+        liberi_str = ", ".join(str(ora) for ora in liberi)
+        if fastjson.FAST:
+            liberi_str = fastjson.dumps({"detail": liberi_str})
+        availability.set(data, tipologia.value, versione, liberi_str)
+    return encoded(liberi_str, response) if fastjson.FAST else Message(detail=liberi_str)
+
+
+# mostra, per ogni giorno dell'intervallo, gli orari liberi di tutti i campi e i posti liberi in piscina
+@router.get("/calendario")
+async def get_calendario(dal: date = Query(alias="from"), al: date = Query(alias="to")) -> Calendario:
+    if dal > al:
+        raise HTTPException(status_code=400, detail="La data iniziale deve precedere quella finale")
+    if (al - dal).days >= MAX_GIORNI_CALENDARIO:
+        raise HTTPException(status_code=400, detail=f"Intervallo massimo di {MAX_GIORNI_CALENDARIO} giorni")
+
+    # i campi sono letti dall'indice in memoria, la piscina dai contatori giornalieri con una sola query
+    piscina = await run_db(lambda db: db.query(
+        OccupazionePiscina.data, OccupazionePiscina.lettini, OccupazionePiscina.ombrelloni).filter(
+        OccupazionePiscina.data.between(dal, al)).all(), read=True)
+
+    prenotati = {data: (lettini, ombrelloni) for data, lettini, ombrelloni in piscina}
+
+    giorni = []
+    for i in range((al - dal).days + 1):
+        data = dal + timedelta(days=i)
+        aperta = (5, 20) <= (data.month, data.day) <= (9, 15)  # dal 20 maggio al 15 settembre
+        lettini, ombrelloni = prenotati.get(data, (0, 0))
+        giorni.append({
+            "data": data,
+            "campi": {t.value: occupancy.free_hours(data, t.value) for t in TipologiaEnum},
+            "piscina_aperta": aperta,
+            "lettini_liberi": capacity.LETTINI_TOTALI - lettini if aperta else 0,
+            "ombrelloni_liberi": capacity.OMBRELLONI_TOTALI - ombrelloni if aperta else 0
+        })
+    # i giorni sono costruiti dal servizio stesso: in modalità veloce non serve validarli con GiornoCalendario
+    if fastjson.FAST:
+        return fastjson.response(fastjson.dumps({"giorni": giorni}))
+    return Calendario(giorni=[GiornoCalendario(**giorno) for giorno in giorni])
 
 
 # aggiunge la prenotazione di un campo
 @router.post("/campo")
-def add_campo(booking: CampoBooking, db: Session = Depends(get_db)) -> Message:
+async def add_campo(booking: CampoBooking) -> Message:
     cf = booking.cf.upper()
 
     # verifica esistenza del membro
-    if not check_member(cf):
+    if not await check_member(cf):
         raise HTTPException(status_code=404, detail="Member doesn't exist")
 
-    # verifica se lo slot orario è già prenotato
-    existing = db.query(PrenotazioniCampi).filter_by(
-        data=booking.data,
-        ora=booking.ora,
-        tipologia=booking.tipologia
-    ).first()
-    if existing:
+    # verifica se lo slot orario è già prenotato, senza interrogare il database
+    if occupancy.is_taken(booking.data, booking.tipologia.value, booking.ora):
         raise HTTPException(status_code=409, detail="Slot già prenotato")
 
-    # creazione prenotazione
-    new = PrenotazioniCampi(
+    # creazione prenotazione: il vincolo di unicità sullo slot fa fallire l'inserimento
+    # se nel frattempo lo slot è stato prenotato da un'altra richiesta
+    new = insert(PrenotazioniCampi).values(
         cf=cf,
         data=booking.data,
         ora=booking.ora,
-        tipologia=booking.tipologia
-    )
-    db.add(new)
-    db.commit()
+        tipologia=booking.tipologia.value
+    ).on_conflict_do_nothing()
+
+    def inserisci(db: Session) -> int:
+        inserite = db.execute(new).rowcount
+        db.commit()
+        return inserite
+
+    inserite = await run_db(inserisci)
+    occupancy.book(booking.data, booking.tipologia.value, booking.ora)
+    availability.bump(booking.data)
+    if not inserite:
+        raise HTTPException(status_code=409, detail="Slot già prenotato")
     return Message(detail="Booking added")
 
 
+# prenota più slot in una volta (più ore consecutive o più campi): i membri vengono verificati una volta sola,
+# gli slot con una sola query e l'inserimento avviene in un'unica transazione, quindi o tutti o nessuno
+@router.post("/campi")
+async def add_campi(bookings: List[CampoBooking]) -> Message:
+    if not bookings:
+        raise HTTPException(status_code=400, detail="Nessuno slot richiesto")
+    if len(bookings) > MAX_SLOT_PRENOTAZIONE:
+        raise HTTPException(status_code=400, detail=f"Al massimo {MAX_SLOT_PRENOTAZIONE} slot per richiesta")
+
+    slots = [(b.data, b.tipologia.value, b.ora) for b in bookings]
+    if len(set(slots)) != len(slots):
+        raise HTTPException(status_code=400, detail="Slot ripetuto nella richiesta")
+
+    # verifica esistenza dei membri
+    esiti = await check_members([b.cf for b in bookings])
+    if not all(esiti.values()):
+        raise HTTPException(status_code=404, detail="Member doesn't exist")
+
+    # verifica se qualche slot è già prenotato: prima sull'indice in memoria, poi con una sola query
+    occupati = [s for s in slots if occupancy.is_taken(*s)]
+    if not occupati:
+        # OR di uguaglianze e non (data, tipologia, ora) IN (VALUES ...): SQLite usa l'indice degli slot
+        # solo nel primo caso, il secondo scorre l'intero indice
+        occupati = await run_db(lambda db: db.query(
+            PrenotazioniCampi.data, PrenotazioniCampi.tipologia, PrenotazioniCampi.ora).filter(
+            or_(*(and_(PrenotazioniCampi.data == data, PrenotazioniCampi.tipologia == tipologia,
+                       PrenotazioniCampi.ora == ora) for data, tipologia, ora in slots))).all())
+        for slot in occupati:
+            occupancy.book(*slot)  # l'indice non era aggiornato
+        availability.bump(*(data for data, _, _ in occupati))
+    if occupati:
+        dettaglio = ", ".join(f"{data} {tipologia} ore {ora}" for data, tipologia, ora in occupati)
+        raise HTTPException(status_code=409, detail=f"Slot già prenotato: {dettaglio}")
+
+    # inserimento di tutte le prenotazioni nella stessa transazione
+    def inserisci(db: Session) -> None:
+        try:
+            db.execute(insert(PrenotazioniCampi), [
+                {"cf": b.cf.upper(), "data": b.data, "ora": b.ora, "tipologia": b.tipologia.value} for b in bookings])
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            raise HTTPException(status_code=409, detail="Slot già prenotato")
+
+    await run_db(inserisci)
+
+    for slot in slots:
+        occupancy.book(*slot)
+    availability.bump(*(data for data, _, _ in slots))
+    return Message(detail=f"{len(bookings)} bookings added")
+
+
 # rimuove la prenotazione di un campo
 @router.delete("/campo/{cf}/{data}/{ora}/{tipologia}")
-def delete_campo(cf: str, data: date, ora: int, tipologia: TipologiaEnum, db: Session = Depends(get_db)) -> Message:
-    prenotazione = db.query(PrenotazioniCampi).filter_by(
-        cf=cf,
-        data=data,
-        ora=ora,
-        tipologia=tipologia).first()
-
-    # verifica se la prenotazione esiste
-    if prenotazione:
+async def delete_campo(cf: str, data: date, ora: int, tipologia: TipologiaEnum) -> Message:
+    def rimuovi(db: Session) -> bool:
+        prenotazione = db.query(PrenotazioniCampi).filter_by(
+            cf=cf,
+            data=data,
+            ora=ora,
+            tipologia=tipologia).first()
+        if not prenotazione:
+            return False
         db.delete(prenotazione)
         db.commit()
+        return True
+
+    # verifica se la prenotazione esiste
+    if await run_db(rimuovi):
+        occupancy.release(data, tipologia.value, ora)
+        availability.bump(data)
         return Message(detail="Booking deleted")
 
     raise HTTPException(status_code=404, detail="Booking not found")
 
 
+# rimuove le prenotazioni dei membri indicati dalla data corrente in poi, restituendo alla disponibilità
+# i posti della piscina nella stessa transazione; restituisce il numero di prenotazioni rimosse.
+# `cancellati` indica, per i cf tornati membri, l'istante in cui il membro è stato eliminato: le prenotazioni
+# create dopo appartengono al nuovo membro, registrato prima che la cancellazione arrivasse qui.
+# Gli istanti sono misurati da member-service, che invia anche il proprio orario di invio (`inviato`): la
+# differenza con l'orario di arrivo riporta i limiti sull'orologio di questo servizio, con cui è scritta `creata`
+# (la stima include anche la latenza della chiamata, di cui il limite risulta spostato in avanti)
+def remove_bookings(db: Session, cfs: List[str], cancellati: dict[str, datetime] | None = None,
+                    inviato: datetime | None = None) -> int:
+    cfs = sorted({cf.upper() for cf in cfs})
+
+    # confrontati in UTC senza fuso orario, come la colonna `creata`
+    def utc(istante: datetime) -> datetime:
+        return istante.astimezone(timezone.utc).replace(tzinfo=None) if istante.tzinfo else istante
+
+    scarto = datetime.utcnow() - utc(inviato) if inviato else timedelta(0)
+    limiti = {cf.upper(): utc(istante) + scarto for cf, istante in (cancellati or {}).items()}
+
+    def da_rimuovere(riga) -> bool:
+        limite = limiti.get(riga.cf)
+        return limite is None or riga.creata is None or riga.creata < limite
+
+    # orari da liberare nell'indice dei campi
+    campi = [riga for riga in db.query(
+        PrenotazioniCampi.id, PrenotazioniCampi.cf, PrenotazioniCampi.creata, PrenotazioniCampi.data,
+        PrenotazioniCampi.tipologia, PrenotazioniCampi.ora).filter(
+        PrenotazioniCampi.cf.in_(cfs), PrenotazioniCampi.data >= date.today()) if da_rimuovere(riga)]
+    db.query(PrenotazioniCampi).filter(PrenotazioniCampi.id.in_([riga.id for riga in campi])).delete(
+        synchronize_session=False)
+
+    # posti da restituire alla disponibilità della piscina
+    piscina = [riga for riga in db.query(
+        PrenotazioniPiscina.id, PrenotazioniPiscina.cf, PrenotazioniPiscina.creata, PrenotazioniPiscina.data,
+        PrenotazioniPiscina.lettini, PrenotazioniPiscina.ombrelloni).filter(
+        PrenotazioniPiscina.cf.in_(cfs), PrenotazioniPiscina.data >= date.today()) if da_rimuovere(riga)]
+    for riga in piscina:
+        capacity.release(db, riga.data, riga.lettini, riga.ombrelloni)
+    db.query(PrenotazioniPiscina).filter(PrenotazioniPiscina.id.in_([riga.id for riga in piscina])).delete(
+        synchronize_session=False)
+    db.commit()
+    for riga in campi:
+        occupancy.release(riga.data, riga.tipologia, riga.ora)
+    availability.bump(*(riga.data for riga in campi), *(riga.data for riga in piscina))
+
+    # i membri sono stati eliminati: gli esiti in cache non sono più validi
+    for cf in cfs:
+        member_cache.invalidate(cf)
+    return len(campi) + len(piscina)
+
+
 # rimuove tutte le prenotazioni di un membro dalla data corrente in poi
 @router.delete("/prenotazioni/{cf}", status_code=204)   # 204 ok, no content
-def delete_prenotazioni(cf: str, db: Session = Depends(get_db)):
-    db.query(PrenotazioniCampi).filter(PrenotazioniCampi.cf == cf,
-                                       PrenotazioniCampi.data >= date.today()).delete(synchronize_session=False)
-    db.query(PrenotazioniPiscina).filter(PrenotazioniPiscina.cf == cf,
-                                         PrenotazioniPiscina.data >= date.today()).delete(synchronize_session=False)
-    db.commit()
+async def delete_prenotazioni(cf: str):
+    await run_db(remove_bookings, [cf])
     return
 
 
+# rimuove in una sola transazione le prenotazioni di più membri eliminati; usata da member-service
+# per consegnare le cancellazioni a blocchi, può essere ripetuta senza effetti collaterali
+@router.post("/prenotazioni/cancella")
+async def delete_prenotazioni_batch(request: CancellaPrenotazioni) -> Message:
+    if len(request.cfs) > MAX_CF_CANCELLAZIONE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_CF_CANCELLAZIONE} CFs per request")
+    rimosse = await run_db(remove_bookings, request.cfs, request.cancellati, request.inviato)
+    return Message(detail=f"{rimosse} bookings deleted")
+
+
 # mostra il numero di lettini e ombrelloni liberi in una certa data
 @router.get("/piscinalibera/{data}", response_model=Message)
-def get_piscina(data: date, db: Session = Depends(get_db)) -> Message:
+async def get_piscina(data: date, request: Request, response: Response) -> Message:
+    versione = availability.version(data)
+    if risposta := not_modified(request, response, availability.etag(data, "piscina", versione)):
+        return risposta
 
     # verifica che la richiesta non sia per il periodo di chiusura
     mese, giorno = data.month, data.day
@@ -119,78 +368,172 @@ def get_piscina(data: date, db: Session = Depends(get_db)) -> Message:
     if not (inizio <= (mese, giorno) <= fine):
         return Message(detail="Piscina chiusa. Apertura nel periodo estivo dal 20 maggio al 15 settembre.")
 
-    # somma totale di lettini e ombrelloni prenotati nella data richiesta
-    totale_prenotazioni = db.query(
-        func.coalesce(func.sum(PrenotazioniPiscina.lettini), 0),
-        func.coalesce(func.sum(PrenotazioniPiscina.ombrelloni), 0)
-    ).filter(PrenotazioniPiscina.data == data).one()
+    liberi = availability.get(data, "piscina", versione)
+    if liberi is not None:
+        return encoded(liberi, response) if fastjson.FAST else liberi
 
-    prenotati_lettini, prenotati_ombrelloni = totale_prenotazioni
+    # lettini e ombrelloni prenotati nella data richiesta
+    prenotati_lettini, prenotati_ombrelloni = await run_db(capacity.booked, data, read=True)
 
-    lettini_liberi = 80 - prenotati_lettini
-    ombrelloni_liberi = 20 - prenotati_ombrelloni
+    lettini_liberi = capacity.LETTINI_TOTALI - prenotati_lettini
+    ombrelloni_liberi = capacity.OMBRELLONI_TOTALI - prenotati_ombrelloni
 
-    return Message(detail=f"{lettini_liberi} lettini e {ombrelloni_liberi} ombrelloni liberi")
+    detail = f"{lettini_liberi} lettini e {ombrelloni_liberi} ombrelloni liberi"
+    liberi = fastjson.dumps({"detail": detail}) if fastjson.FAST else Message(detail=detail)
+    availability.set(data, "piscina", versione, liberi)
+    return encoded(liberi, response) if fastjson.FAST else liberi
 
 
 # aggiunge una prenotazione in piscina
 @router.post("/piscina")
-def add_piscina(booking: PiscinaBooking, db: Session = Depends(get_db)) -> Message:
+async def add_piscina(booking: PiscinaBooking) -> Message:
     cf = booking.cf.upper()
 
     # verifica l'esistenza di un membro
-    if not check_member(cf):
+    if not await check_member(cf):
         raise HTTPException(status_code=404, detail="Member doesn't exist")
 
-    # verifica se il membro ha già una prenotazione per quella data
-    existing = db.query(PrenotazioniPiscina).filter_by(
-        data=booking.data,
-        cf=cf).first()
-    if existing:
-        raise HTTPException(status_code=409, detail="Member has already a reservation")
-
-    # verifica se ci sono abbastanza lettini
-    lettini_prenotati = db.query(func.sum(PrenotazioniPiscina.lettini)).filter(
-        PrenotazioniPiscina.data == booking.data).scalar() or 0
-    if lettini_prenotati + booking.lettini > 80:
-        lettini_disponibili = 80 - lettini_prenotati
-        raise HTTPException(status_code=409, detail=f"Only {lettini_disponibili} lettini available on {booking.data}")
-
-    # verifica se ci sono abbastanza ombrelloni
-    ombrelloni_prenotati = db.query(func.sum(PrenotazioniPiscina.ombrelloni)).filter(
-        PrenotazioniPiscina.data == booking.data).scalar() or 0
-    if ombrelloni_prenotati + booking.ombrelloni > 20:
-        ombrelloni_disponibili = 20 - ombrelloni_prenotati
-        raise HTTPException(status_code=409, detail=f"Only {ombrelloni_disponibili} ombrelloni available on {booking.data}")
-
-    # aggiunta della prenotazione
-    new = PrenotazioniPiscina(
-        cf=cf,
-        data=booking.data,
-        lettini=booking.lettini,
-        ombrelloni=booking.ombrelloni)
-    db.add(new)
-    db.commit()
+    def prenota(db: Session) -> None:
+        # verifica se il membro ha già una prenotazione per quella data
+        existing = db.query(PrenotazioniPiscina).filter_by(
+            data=booking.data,
+            cf=cf).first()
+        if existing:
+            raise HTTPException(status_code=409, detail="Member has already a reservation")
+
+        # riserva lettini e ombrelloni solo se ce ne sono abbastanza
+        if not capacity.reserve(db, booking.data, booking.lettini, booking.ombrelloni):
+            db.rollback()
+            lettini_prenotati, ombrelloni_prenotati = capacity.booked(db, booking.data)
+            if lettini_prenotati + booking.lettini > capacity.LETTINI_TOTALI:
+                lettini_disponibili = capacity.LETTINI_TOTALI - lettini_prenotati
+                raise HTTPException(status_code=409, detail=f"Only {lettini_disponibili} lettini available on {booking.data}")
+            ombrelloni_disponibili = capacity.OMBRELLONI_TOTALI - ombrelloni_prenotati
+            raise HTTPException(status_code=409, detail=f"Only {ombrelloni_disponibili} ombrelloni available on {booking.data}")
+
+        # aggiunta della prenotazione
+        new = PrenotazioniPiscina(
+            cf=cf,
+            data=booking.data,
+            lettini=booking.lettini,
+            ombrelloni=booking.ombrelloni)
+        db.add(new)
+        db.commit()
+
+    await run_db(prenota)
+    availability.bump(booking.data)
     return Message(detail="Booking added")
 
 
 # rimuove la prenotazione della piscina di un membro in una certa data
 @router.delete("/piscina/{cf}/{data}")
-def delete_piscina(cf: str, data: date, db: Session = Depends(get_db)) -> Message:
-    prenotazione = db.query(PrenotazioniPiscina).filter_by(
-        cf=cf.upper(),
-        data=data
-    ).delete(synchronize_session=False)
-    db.commit()
+async def delete_piscina(cf: str, data: date) -> Message:
+    def rimuovi(db: Session) -> None:
+        prenotazione = db.query(PrenotazioniPiscina).filter_by(
+            cf=cf.upper(),
+            data=data
+        ).first()
+
+        if not prenotazione:
+            raise HTTPException(status_code=404, detail="Booking not found")
+
+        # la cancellazione e il rilascio dei posti avvengono nella stessa transazione
+        capacity.release(db, data, prenotazione.lettini, prenotazione.ombrelloni)
+        db.delete(prenotazione)
+        db.commit()
 
-    if prenotazione == 0:
-        raise HTTPException(status_code=404, detail="Booking not found")
+    await run_db(rimuovi)
+    availability.bump(data)
     return Message(detail="Booking deleted")
 
 
+# prenotazioni di un membro tra due date (di default nell'ultimo anno), comprese quelle già spostate
+# negli archivi delle stagioni passate
+@router.get("/storico/{cf}")
+async def get_storico(cf: str, dal: date | None = None, al: date | None = None) -> StoricoMembro:
+    al = al or date.today()
+    dal = dal or al - timedelta(days=365)
+    if dal > al:
+        raise HTTPException(status_code=400, detail="La data iniziale deve precedere quella finale")
+    if al.year - dal.year >= MAX_STAGIONI_STORICO:
+        raise HTTPException(status_code=400, detail=f"Al massimo {MAX_STAGIONI_STORICO} stagioni per richiesta")
+
+    cf = cf.upper()
+    campi, piscina = await run_db(lambda db: archive.history(db, [cf], dal, al), read=True)
+    return StoricoMembro(
+        cf=cf,
+        campi=[StoricoCampo(data=data, ora=ora, tipologia=tipologia) for _, data, ora, tipologia in campi],
+        piscina=[StoricoPiscina(data=data, lettini=lettini, ombrelloni=ombrelloni)
+                 for _, data, lettini, ombrelloni in piscina],
+    )
+
+
+# statistiche della cache dei membri, utili per dimensionarla
+@router.get("/stats/cache")
+async def get_cache_stats() -> CacheStats:
+    return CacheStats(**member_cache.stats())
+
+
+# statistiche della cache delle risposte sulla disponibilità
+@router.get("/stats/availability")
+async def get_availability_stats() -> AvailabilityStats:
+    return AvailabilityStats(**availability.stats())
+
+
+# stagioni archiviate e stato dell'archiviazione delle prenotazioni passate
+@router.get("/stats/archivio")
+async def get_archive_stats() -> ArchivioStats:
+    return ArchivioStats(**archive.stats())
+
+
+# stato del circuit breaker e latenze delle chiamate a member-service
+@router.get("/stats/member-service")
+async def get_member_service_stats() -> ClientStats:
+    return ClientStats(**member_client.stats())
+
+
+# verifica che l'indice in memoria dei campi coincida con la tabella
+@router.get("/stats/occupazione")
+async def verify_occupancy() -> VerificaOccupazione:
+    differenze = await run_db(occupancy.verify, read=True)
+    return VerificaOccupazione(coerente=not differenze, differenze=differenze)
+
+
+# se l'indice in memoria dei campi non coincide con la tabella lo ricarica; restituisce le differenze trovate
+@router.post("/occupazione/ripara")
+async def repair_occupancy() -> VerificaOccupazione:
+    differenze = await run_db(occupancy.verify, read=True)
+    if differenze:
+        await run_db(occupancy.load, read=True)
+        availability.clear()
+    return VerificaOccupazione(coerente=not differenze, differenze=differenze)
+
+
 app.include_router(router)
 Base.metadata.create_all(bind=engine)
 
 
+# metriche in formato Prometheus: latenze per route, statement SQL per richiesta, chiamate agli altri servizi
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# sposta periodicamente negli archivi stagionali le prenotazioni passate (ARCHIVE_INTERVAL)
+@app.on_event("startup")
+def start_archive():
+    archive.start(SessionLocal, ReadSessionLocal)
+
+
+@app.on_event("shutdown")
+def stop_archive():
+    archive.stop()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await member_client.aclose()
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=5000, reload=True)
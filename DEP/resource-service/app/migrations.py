@@ -0,0 +1,131 @@
+from typing import Callable
+from sqlalchemy import func, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from model import PrenotazioniCampi, PrenotazioniPiscina
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+SLOT_INDEX = "ux_PrenotazioniCampi_slot"
+
+# indici a colonna singola creati dalle versioni precedenti del modello: non corrispondono alle query
+# del servizio e rallentano ogni inserimento
+OBSOLETE_INDEXES = (
+    "ix_PrenotazioniCampi_id", "ix_PrenotazioniCampi_cf", "ix_PrenotazioniCampi_data",
+    "ix_PrenotazioniCampi_ora", "ix_PrenotazioniCampi_tipologia",
+    "ix_PrenotazioniPiscina_id", "ix_PrenotazioniPiscina_cf", "ix_PrenotazioniPiscina_data",
+    "ix_PrenotazioniPiscina_lettini", "ix_PrenotazioniPiscina_ombrelloni",
+)
+
+
+# cerca gli slot dei campi prenotati più di una volta, che impediscono di creare il vincolo di unicità
+def find_duplicate_slots(db: Session) -> list[dict]:
+    duplicati = db.query(PrenotazioniCampi.data, PrenotazioniCampi.tipologia, PrenotazioniCampi.ora,
+                         func.group_concat(PrenotazioniCampi.id)).group_by(
+        PrenotazioniCampi.data, PrenotazioniCampi.tipologia, PrenotazioniCampi.ora).having(
+        func.count() > 1).all()
+    return [{"data": data, "tipologia": tipologia, "ora": ora, "id": [int(i) for i in ids.split(",")]}
+            for data, tipologia, ora, ids in duplicati]
+
+
+# aggiunge il vincolo di unicità sugli slot ai database creati prima della sua introduzione;
+# se ci sono duplicati il vincolo non viene creato e restituisce gli slot da sistemare a mano
+def ensure_unique_slots(engine: Engine) -> list[dict]:
+    with Session(engine) as db:
+        duplicati = find_duplicate_slots(db)
+    if duplicati:
+        for d in duplicati:
+            logger.warning("Slot %s %s ore %s prenotato più volte (id %s)", d["data"], d["tipologia"], d["ora"], d["id"])
+        return duplicati
+
+    indice = next(i for i in PrenotazioniCampi.__table__.indexes if i.name == SLOT_INDEX)
+    indice.create(bind=engine, checkfirst=True)
+    return []
+
+
+# sostituisce gli indici a colonna singola con quelli composti del modello; i nuovi indici vengono
+# creati prima di eliminare i vecchi, così le query non restano mai senza indice
+def composite_indexes(engine: Engine) -> bool:
+    for tabella in (PrenotazioniCampi.__table__, PrenotazioniPiscina.__table__):
+        for indice in tabella.indexes:
+            indice.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        for nome in OBSOLETE_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS "{nome}"'))
+        # statistiche per il pianificatore, che altrimenti sceglie tra gli indici senza conoscerne la selettività
+        conn.execute(text("ANALYZE"))
+    return True
+
+
+# aggiunge alle tabelle esistenti le colonne del modello che mancano (SQLite le aggiunge in fondo, vuote);
+# usata anche per i file dell'archivio creati da versioni precedenti del modello
+def add_missing_columns(engine: Engine, tabelle=(PrenotazioniCampi.__table__, PrenotazioniPiscina.__table__)) -> bool:
+    with engine.begin() as conn:
+        for tabella in tabelle:
+            presenti = {riga[1] for riga in conn.execute(text(f'PRAGMA table_info("{tabella.name}")'))}
+            for colonna in tabella.columns:
+                if colonna.name not in presenti:
+                    tipo = colonna.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE "{tabella.name}" ADD COLUMN "{colonna.name}" {tipo}'))
+    return True
+
+
+# migrazioni in ordine di versione; ognuna restituisce False se non può essere applicata.
+# Sono tutte idempotenti: SQLite esegue le DDL fuori dalla transazione del driver, quindi una migrazione
+# interrotta viene semplicemente ripetuta all'avvio successivo
+MIGRATIONS: list[tuple[int, str, Callable[[Engine], bool]]] = [
+    (1, "vincolo di unicità sugli slot dei campi", lambda engine: not ensure_unique_slots(engine)),
+    (2, "indici composti sulle prenotazioni", composite_indexes),
+    (3, "istante di creazione delle prenotazioni", add_missing_columns),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+# versione dello schema salvata nel file del database (0 per i database mai migrati)
+def schema_version(engine: Engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def pending(engine: Engine) -> list[tuple[int, str]]:
+    versione = schema_version(engine)
+    return [(numero, descrizione) for numero, descrizione, _ in MIGRATIONS if numero > versione]
+
+
+# applica le migrazioni mancanti fermandosi alla prima che non riesce; restituisce la versione raggiunta.
+# Le colonne del modello vengono aggiunte comunque prima di tutto: l'ORM le legge in ogni query, quindi non
+# possono aspettare una migrazione precedente bloccata (per esempio dagli slot duplicati della 1)
+def migrate(engine: Engine) -> int:
+    add_missing_columns(engine)
+    versione = schema_version(engine)
+    for numero, descrizione, migrazione in MIGRATIONS:
+        if numero <= versione:
+            continue
+        logger.info("Migrazione %d: %s", numero, descrizione)
+        if not migrazione(engine):
+            logger.warning("Migrazione %d non applicata, schema fermo alla versione %d", numero, versione)
+            break
+        with engine.begin() as conn:
+            conn.execute(text(f"PRAGMA user_version = {numero}"))
+        versione = numero
+    return versione
+
+
+# uso da riga di comando: `python migrations.py` aggiorna il database, `python migrations.py status`
+# mostra la versione e le migrazioni mancanti senza applicarle
+if __name__ == "__main__":
+    from db import engine
+
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["status"]:
+        print(f"Versione dello schema: {schema_version(engine)} (ultima {LATEST})")
+        for numero, descrizione in pending(engine):
+            print(f"  da applicare: {numero} {descrizione}")
+        raise SystemExit(0)
+    versione = migrate(engine)
+    if versione < LATEST:
+        print(f"Schema alla versione {versione}, migrazioni successive non applicate")
+        raise SystemExit(1)
+    print(f"Schema aggiornato alla versione {versione}")
@@ -1,22 +1,54 @@
-from sqlalchemy import Column, String, Integer, Date
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, Date, DateTime, CheckConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
 
+# gli indici seguono le query del servizio: gli slot si cercano per (data, tipologia, ora), le prenotazioni
+# di un membro per (cf, data). La chiave primaria è già il rowid e non ha bisogno di un indice
 class PrenotazioniCampi(Base):
     __tablename__ = "PrenotazioniCampi"
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    cf = Column(String(16), index=True, nullable=False)  # codice fiscale socio
-    data = Column(Date, index=True, nullable=False)
-    ora = Column(Integer, index=True, nullable=False)    # dalle 10 alle 21
-    tipologia = Column(String(50), index=True, nullable=False)  # beach, tennis, calcio
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cf = Column(String(16), nullable=False)  # codice fiscale socio
+    data = Column(Date, nullable=False)
+    ora = Column(Integer, nullable=False)    # dalle 10 alle 21
+    tipologia = Column(String(50), nullable=False)  # beach, tennis, calcio
+    # istante della prenotazione (UTC): le cancellazioni a cascata consegnate in ritardo non toccano le
+    # prenotazioni di un nuovo membro con lo stesso cf. Vuoto per le prenotazioni precedenti alla migrazione 3
+    creata = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # ogni slot orario di un campo può essere prenotato una sola volta
+        Index("ux_PrenotazioniCampi_slot", "data", "tipologia", "ora", unique=True),
+        # prenotazioni future di un membro e cancellazioni a cascata
+        Index("ix_PrenotazioniCampi_cf_data", "cf", "data"),
+    )
 
 
 class PrenotazioniPiscina(Base):
     __tablename__ = "PrenotazioniPiscina"
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    cf = Column(String(16), index=True, nullable=False)
-    data = Column(Date, index=True, nullable=False)
-    lettini = Column(Integer, index=True, nullable=False)     # max 80 in totale
-    ombrelloni = Column(Integer, index=True, nullable=False)  # max 20 in totale
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    cf = Column(String(16), nullable=False)
+    data = Column(Date, nullable=False)
+    lettini = Column(Integer, nullable=False)     # max 80 in totale
+    ombrelloni = Column(Integer, nullable=False)  # max 20 in totale
+    creata = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # prenotazione di un membro in una data, prenotazioni future e cancellazioni a cascata
+        Index("ix_PrenotazioniPiscina_cf_data", "cf", "data"),
+    )
+
+
+# lettini e ombrelloni già prenotati per ogni giorno, aggiornati insieme alle prenotazioni
+class OccupazionePiscina(Base):
+    __tablename__ = "OccupazionePiscina"
+    data = Column(Date, primary_key=True)
+    lettini = Column(Integer, nullable=False, default=0)
+    ombrelloni = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        CheckConstraint("lettini BETWEEN 0 AND 80"),
+        CheckConstraint("ombrelloni BETWEEN 0 AND 20"),
+    )
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, constr, conint, validator
-from datetime import date
+from typing import Dict, List, Optional
+from datetime import date, datetime
 from fastapi import HTTPException
 from enum import Enum
 
@@ -49,3 +50,102 @@ class PiscinaBooking(BaseModel):
 
 class Message(BaseModel):
     detail: str
+
+
+class CancellaPrenotazioni(BaseModel):
+    cfs: List[str]
+    # istante dell'eliminazione dei membri già registrati di nuovo: le prenotazioni create dopo non vengono rimosse
+    cancellati: Dict[str, datetime] = {}
+    # orario di invio secondo member-service, per riportare gli istanti sull'orologio di questo servizio
+    inviato: Optional[datetime] = None
+
+
+# orari liberi di ogni tipologia di campo, nello stesso formato di /campiliberi/{data}/{tipologia}
+class CampiLiberi(BaseModel):
+    tennis: str
+    beach: str
+    calcio: str
+
+
+class GiornoCalendario(BaseModel):
+    data: date
+    campi: Dict[str, List[int]]  # orari liberi per tipologia
+    piscina_aperta: bool
+    lettini_liberi: int
+    ombrelloni_liberi: int
+
+
+class Calendario(BaseModel):
+    giorni: List[GiornoCalendario]
+
+
+class DifferenzaOccupazione(BaseModel):
+    data: date
+    tipologia: str
+    indice: List[int]   # ore occupate secondo l'indice in memoria
+    tabella: List[int]  # ore occupate secondo il database
+
+
+class VerificaOccupazione(BaseModel):
+    coerente: bool
+    differenze: List[DifferenzaOccupazione]
+
+
+class CacheStats(BaseModel):
+    size: int
+    maxsize: int
+    ttl: float
+    negative_ttl: float
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+class AvailabilityStats(BaseModel):
+    size: int
+    maxsize: int
+    versioned_dates: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+class ClientStats(BaseModel):
+    url: str
+    state: str
+    consecutive_failures: int
+    requests: int
+    errors: int
+    retries: int
+    short_circuited: int
+    avg_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+class StoricoCampo(BaseModel):
+    data: date
+    ora: int
+    tipologia: str
+
+
+class StoricoPiscina(BaseModel):
+    data: date
+    lettini: int
+    ombrelloni: int
+
+
+class StoricoMembro(BaseModel):
+    cf: str
+    campi: List[StoricoCampo]
+    piscina: List[StoricoPiscina]
+
+
+class ArchivioStats(BaseModel):
+    stagioni: List[int]
+    limite: date  # le prenotazioni precedenti vengono archiviate
+    archiviate_campi: int
+    archiviate_piscina: int
+    ultima_esecuzione: Optional[datetime]
+    ultimo_errore: Optional[str]
@@ -1,13 +1,90 @@
-from fastapi import FastAPI
-from db import engine, get_db
+from fastapi import FastAPI, Response
+from db import engine, run_db, SessionLocal, ReadSessionLocal
 from model import Base, Member
+from sqlalchemy.orm import Session
 import strawberry
+from strawberry.dataloader import DataLoader
+from strawberry.extensions import MaxAliasesLimiter, ParserCache, QueryDepthLimiter, ValidationCache
 from strawberry.fastapi import GraphQLRouter
+from fastapi.concurrency import run_in_threadpool
 import uvicorn
-from typing import List
+from typing import Dict, List, Optional
 from schema import *
-from datetime import datetime
-import requests
+from datetime import date, datetime
+from client import resource_client, PEER_ERRORS
+import bulk
+import cost
+import fastjson
+import metrics
+import operation_metrics
+import os
+import outbox
+import persisted
+import profiling
+import queries
+import sql_trace
+
+MAX_PAGINA = 1000
+MAX_CF_VERIFICA = 5000
+# membri per mutation addMembers (cinque blocchi di inserimento): il costo della mutation non dipende
+# dalla dimensione della lista, quindi è questo limite a contenere il lavoro di una singola richiesta
+MAX_MEMBRI_IMPORT = 5 * bulk.BATCH_SIZE
+MAX_CF_PRENOTAZIONI = 1000  # limite della query prenotazioniMembri di resource-service
+DOCUMENT_CACHE_SIZE = int(os.environ.get("GRAPHQL_DOCUMENT_CACHE_SIZE", "256"))
+
+
+# cancella in resource-service le prenotazioni dei membri eliminati, con una sola mutation per blocco;
+# la cancellazione è idempotente, quindi può essere ripetuta senza effetti collaterali.
+# Per i cf tornati membri prima della consegna viene inviato l'istante dell'eliminazione, così le prenotazioni
+# del nuovo membro restano; per gli altri vengono rimosse tutte, comprese quelle accettate nel frattempo da
+# resource-service con un esito ancora in cache. `inviato` permette a resource-service di riportare gli istanti
+# sul proprio orologio invece di confrontarli direttamente con le sue prenotazioni
+def send_cancellazioni(cancellati: Dict[str, datetime]) -> None:
+    with ReadSessionLocal() as db:
+        riaggiunti = {cf for (cf,) in db.query(Member.cf).filter(Member.cf.in_(cancellati))}
+    resp = persisted.post(resource_client, queries.DELETE_PRENOTAZIONI_BATCH, {
+        "cfs": sorted(cancellati),
+        "cancellati": [{"cf": cf, "cancellato": istante.isoformat()} for cf, istante in cancellati.items()
+                       if cf in riaggiunti],
+        "inviato": datetime.utcnow().isoformat(),
+    }, idempotent=True, operation="cascade")
+    resp.raise_for_status()
+    data = resp.json()
+    if "errors" in data:
+        raise Exception(f"Impossibile eliminare prenotazioni: {data['errors']}")
+
+
+cancellazioni = outbox.dispatcher(SessionLocal, send_cancellazioni, outbox.CANCELLA_PRENOTAZIONI)
+
+
+# funzione di caricamento del DataLoader delle prenotazioni: riceve i cf richiesti durante la
+# risoluzione della query e li chiede a resource-service con una sola chiamata, nello stesso ordine
+async def load_prenotazioni(cfs: List[str]) -> List[Prenotazioni | Exception]:
+    try:
+        resp = await persisted.apost(resource_client, queries.PRENOTAZIONI_MEMBRI, {"cfs": cfs}, idempotent=True,
+                                     operation="prenotazioni")
+        resp.raise_for_status()
+        data = resp.json()
+    except PEER_ERRORS as e:
+        errore = Exception(f"resource-service non raggiungibile: {e}")
+        return [errore] * len(cfs)
+    if data.get("errors"):
+        errore = Exception(f"Impossibile leggere le prenotazioni: {data['errors']}")
+        return [errore] * len(cfs)
+
+    per_cf = {}
+    for p in data["data"]["prenotazioniMembri"]:
+        per_cf[p["cf"]] = Prenotazioni(
+            campi=[PrenotazioneCampo(data=date.fromisoformat(c["data"]), ora=c["ora"], tipologia=c["tipologia"])
+                   for c in p["campi"]],
+            piscina=[PrenotazionePiscina(data=date.fromisoformat(c["data"]), lettini=c["lettini"],
+                                         ombrelloni=c["ombrelloni"]) for c in p["piscina"]])
+    return [per_cf.get(cf, Prenotazioni(campi=[], piscina=[])) for cf in cfs]
+
+
+# ogni richiesta ha il proprio DataLoader, così i risultati non vengono condivisi tra richieste diverse
+async def get_context() -> dict:
+    return {"prenotazioni_loader": DataLoader(load_fn=load_prenotazioni, max_batch_size=MAX_CF_PRENOTAZIONI)}
 
 
 @strawberry.type
@@ -15,9 +92,8 @@ class Query:
 
     # verifica se una persona è associata al club
     @strawberry.field
-    def check_member(self, cf: str) -> MemberType | None:
-        with get_db() as db:
-            member = db.query(Member).filter(Member.cf == cf.upper()).first()
+    async def check_member(self, cf: str) -> MemberType | None:
+        member = await run_db(lambda db: db.query(Member).filter(Member.cf == cf.upper()).first(), read=True)
 
         if member:
             return MemberType(
@@ -28,11 +104,40 @@ class Query:
                 )
         return None
 
-    # mostra tutti i membri presenti
+    # verifica in una sola query quali dei codici fiscali indicati appartengono a un membro del club
     @strawberry.field
-    def all_members(self) -> List[MemberType]:
-        with get_db() as db:
-            members = db.query(Member).all()
+    async def members_exist(self, cfs: List[str]) -> List[MemberExists]:
+        if len(cfs) > MAX_CF_VERIFICA:
+            raise Exception(f"At most {MAX_CF_VERIFICA} CFs per request")
+
+        richiesti = {cf.upper() for cf in cfs}
+        esistenti = await run_db(lambda db: {cf for (cf,) in db.query(Member.cf).filter(Member.cf.in_(richiesti))},
+                                 read=True)
+        return [MemberExists(cf=cf, exists=cf in esistenti) for cf in sorted(richiesti)]
+
+    # mostra i membri presenti ordinati per codice fiscale: senza `limit` li restituisce tutti,
+    # altrimenti una pagina a partire dal cf successivo ad `after` (l'ultimo cf della pagina precedente)
+    @strawberry.field
+    async def all_members(self, limit: Optional[int] = None, after: Optional[str] = None) -> List[MemberType]:
+        if limit is not None and not 1 <= limit <= MAX_PAGINA:
+            raise Exception(f"limit deve essere compreso tra 1 e {MAX_PAGINA}")
+
+        def leggi(db: Session, *colonne) -> list:
+            query = db.query(*colonne).order_by(Member.cf)
+            if after:
+                query = query.filter(Member.cf > after.upper())
+            if limit is not None:
+                query = query.limit(limit)
+            return query.all()
+
+        # modalità veloce: i MemberType vengono creati direttamente dalle tuple lette dal database,
+        # senza passare dagli oggetti dell'ORM
+        if fastjson.FAST:
+            righe = await run_db(leggi, Member.cf, Member.name, Member.surname, Member.registration_date, read=True)
+            return [MemberType(cf=cf, name=name, surname=surname, registration_date=registration_date)
+                    for cf, name, surname, registration_date in righe]
+
+        members = await run_db(leggi, Member, read=True)
 
         if not members:
             return []
@@ -46,21 +151,36 @@ class Query:
                 for m in members
             ]
 
+    # stato del circuit breaker e latenze delle chiamate a resource-service
+    @strawberry.field
+    def resource_service_stats(self) -> ClientStats:
+        return ClientStats(**resource_client.stats())
+
+    # query persistite conosciute e utilizzo della cache APQ
+    @strawberry.field
+    def persisted_query_stats(self) -> PersistedQueryStats:
+        return PersistedQueryStats(**persisted.persisted_queries.stats())
+
+    # cancellazioni di prenotazioni in attesa di essere consegnate a resource-service
+    @strawberry.field
+    async def outbox_stats(self) -> OutboxStats:
+        return OutboxStats(**await run_db(cancellazioni.stats, read=True))
+
 
 @strawberry.type
 class Mutation:
 
     # aggiunge un nuovo membro al club
     @strawberry.mutation
-    def add_member(self, member: MemberInput) -> str:
-        cf = member.cf.upper()
-
-        # controlla se il cf è valido
-        if len(cf) != 16:
-            raise Exception("CF must be exactly 16 characters long")
-
-        with get_db() as db:
+    async def add_member(self, member: MemberInput) -> str:
+        # controlla i dati con le stesse regole dell'importazione
+        try:
+            dati = bulk.validate_member({"cf": member.cf, "name": member.name, "surname": member.surname})
+        except ValueError as e:
+            raise Exception(str(e))
+        cf = dati["cf"]
 
+        def aggiungi(db: Session) -> None:
             # controlla se il membro esiste già
             existing = db.query(Member).filter(Member.cf == cf).first()
             if existing:
@@ -69,52 +189,129 @@ class Mutation:
             # aggiunge il membro
             new_member = Member(
                 cf=cf,
-                name=member.name,
-                surname=member.surname,
+                name=dati["name"],
+                surname=dati["surname"],
                 registration_date=datetime.utcnow().date()
             )
             db.add(new_member)
             db.commit()
+
+        await run_db(aggiungi)
         return "Member added"
 
-    # rimuove un membro dal club
+    # importa molti membri in blocchi transazionali; restituisce il numero di membri aggiunti
+    # e l'esito delle righe scartate (duplicati e dati non validi)
     @strawberry.mutation
-    def delete_member(self, cf: str) -> str:
-        with get_db() as db:
+    async def add_members(self, members: List[MemberInput]) -> ImportResult:
+        if len(members) > MAX_MEMBRI_IMPORT:
+            raise Exception(f"At most {MAX_MEMBRI_IMPORT} members per request")
+
+        importer = bulk.MemberImport(SessionLocal, bulk.validate_member)
+        for numero, member in enumerate(members, start=1):
+            dati = {"cf": member.cf, "name": member.name, "surname": member.surname}
+            if importer.add(numero, dati):
+                await run_in_threadpool(importer.flush)
+        await run_in_threadpool(importer.flush)
+
+        risultato = importer.result()
+        return ImportResult(aggiunti=risultato["aggiunti"],
+                            duplicati=risultato["duplicati"],
+                            non_validi=risultato["non_validi"],
+                            errori=[RigaScartata(**e) for e in risultato["errori"]])
+
+    # rimuove un membro dal club; la cancellazione delle sue prenotazioni viene registrata nell'outbox
+    # nella stessa transazione e consegnata a resource-service in background
+    @strawberry.mutation
+    async def delete_member(self, cf: str) -> str:
+        def rimuovi(db: Session) -> None:
             member = db.query(Member).filter(Member.cf == cf.upper()).first()
 
             # verifica l'esistenza del membro
             if not member:
                 raise Exception("Member not found")
             db.delete(member)
+            outbox.enqueue(db, outbox.CANCELLA_PRENOTAZIONI, cf.upper())
             db.commit()
 
-        # elimina tutte le prenotazioni effettuate dal membro eliminato
-        graphql_url = "http://resource-service:5000/graphql"
-        mutation = """
-                mutation ($cf: String!) {
-                deletePrenotazioni(cf: $cf) 
-                }
-                """
-        variables = {"cf": cf.upper()}
-        try:
-            resp = requests.post(graphql_url, json={"query": mutation, "variables": variables})
-            resp.raise_for_status()
-            data = resp.json()
-            if "errors" in data:
-                raise Exception(f"Warning: impossibile eliminare prenotazioni: {data['errors']}")
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Warning: resource-service non raggiungibile: {e}")
+        await run_db(rimuovi)
+        cancellazioni.notify()
 
         return "Member deleted"
 
 
-schema = strawberry.Schema(query=Query, mutation=Mutation)
+# pesi dei campi che accedono al database o a resource-service; senza `limit` allMembers
+# restituisce tutti i membri, stimati come una pagina della dimensione massima
+modello_costo = cost.CostModel(
+    weights={
+        "Query.checkMember": 2,
+        "Query.membersExist": 5,
+        "Query.allMembers": 5,
+        "Query.outboxStats": 2,
+        "MemberType.prenotazioni": 1,
+        "Mutation.addMember": 5,
+        "Mutation.addMembers": 50,
+        "Mutation.deleteMember": 5,
+        # già caricate dal DataLoader insieme a prenotazioni
+        "Prenotazioni.campi": 0,
+        "Prenotazioni.piscina": 0,
+    },
+    list_sizes={
+        "Query.allMembers": lambda a: a.get("limit") or MAX_PAGINA,
+        "Query.membersExist": lambda a: len(a["cfs"]),
+    },
+)
+
+# in modalità veloce le risposte GraphQL vengono codificate con orjson invece che con il modulo json
+class FastGraphQLRouter(GraphQLRouter):
+
+    def encode_json(self, data: object) -> bytes:
+        return fastjson.dumps(data)
+
+
+# APQ, durata delle operazioni, traccia SQL, cache LRU dei documenti già analizzati e validati, limiti di profondità, alias e costo
+schema = strawberry.Schema(query=Query, mutation=Mutation, extensions=[
+    persisted.PersistedQueryExtension,
+    operation_metrics.OperationMetrics,
+    sql_trace.SQLTrace,
+    lambda: ParserCache(maxsize=DOCUMENT_CACHE_SIZE),
+    lambda: ValidationCache(maxsize=DOCUMENT_CACHE_SIZE),
+    QueryDepthLimiter(max_depth=cost.MAX_DEPTH),
+    MaxAliasesLimiter(max_alias_count=cost.MAX_ALIASES),
+    lambda: cost.CostLimiter(modello_costo, cost.MAX_COST),
+])
 app = FastAPI(title="Member Service - GraphQL")
-graphql_app = GraphQLRouter(schema)
+app.add_middleware(metrics.MetricsMiddleware)
+# traccia SQL per richiesta, solo con SQL_PROFILE=1
+if profiling.ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
+graphql_app = (FastGraphQLRouter if fastjson.FAST else GraphQLRouter)(schema, context_getter=get_context)
 app.include_router(graphql_app, prefix="/graphql")
 
 
+# metriche in formato Prometheus: latenze per route e per operazione GraphQL, statement SQL per richiesta,
+# chiamate agli altri servizi
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# consegna le cancellazioni rimaste in sospeso e quelle registrate da qui in avanti
+@app.on_event("startup")
+def start_outbox():
+    cancellazioni.start()
+
+
+# le query inviate da resource-service sono note: registrandole la prima chiamata non deve inviarne il testo
+@app.on_event("startup")
+def register_queries():
+    persisted.persisted_queries.register(queries.CHECK_MEMBER, queries.MEMBERS_EXIST)
+
+
+@app.on_event("shutdown")
+def stop_outbox():
+    cancellazioni.stop()
+
+
 if __name__ == "__main__":
     Base.metadata.create_all(bind=engine)
     uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,282 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock, current_thread, local
+from time import perf_counter
+from typing import Callable, Iterable
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# limiti superiori dei bucket degli istogrammi di durata, in secondi
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+
+# valori di una metrica divisi per thread: ogni thread scrive solo nella propria parte senza lock,
+# le parti vengono sommate solo alla lettura. Le parti dei thread terminati (es. i thread del
+# threadpool chiusi dopo un periodo di inattività) vengono accorpate per non accumularle
+class _Shards:
+
+    def __init__(self, width: int):
+        self.width = width
+        self._local = local()
+        self._shards: list[tuple[object, dict]] = []
+        self._retired: dict[tuple, list] = {}
+        self._lock = Lock()
+
+    def get(self) -> dict[tuple, list]:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((current_thread(), shard))
+            return shard
+
+    def cell(self, labels: tuple) -> list:
+        shard = self.get()
+        cell = shard.get(labels)
+        if cell is None:
+            cell = shard[labels] = [0] * self.width
+        return cell
+
+    # somma delle parti per ogni combinazione di etichette
+    def collect(self) -> dict[tuple, list]:
+        with self._lock:
+            vivi = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    vivi.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = vivi
+            totale = {labels: list(cell) for labels, cell in self._retired.items()}
+            for _, shard in vivi:
+                self._merge(totale, shard)
+        return totale
+
+    @staticmethod
+    def _merge(dest: dict, shard: dict) -> None:
+        for labels, cell in list(shard.items()):
+            somma = dest.get(labels)
+            if somma is None:
+                dest[labels] = list(cell)
+            else:
+                for i, valore in enumerate(cell):
+                    somma[i] += valore
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._shards = _Shards(1)
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        self._shards.cell(labels)[0] += amount
+
+    def samples(self) -> Iterable[tuple[str, tuple, float]]:
+        for labels, (valore,) in sorted(self._shards.collect().items()):
+            yield self.name, labels, valore
+
+
+# gauge che può essere incrementato e decrementato da thread diversi (es. richieste in corso)
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1) -> None:
+        self._shards.cell(labels)[0] -= amount
+
+
+# gauge il cui valore viene letto solo al momento dell'esportazione
+class CallbackGauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...], callback: Callable[[], dict]):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.callbacks = [callback]
+
+    def samples(self) -> Iterable[tuple[str, tuple, float]]:
+        for callback in self.callbacks:
+            for labels, valore in sorted(callback().items()):
+                yield self.name, labels, valore
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # un contatore per bucket più quello oltre l'ultimo limite, poi somma e numero delle osservazioni
+        self._shards = _Shards(len(self.buckets) + 3)
+
+    def observe(self, valore: float, labels: tuple = ()) -> None:
+        cell = self._shards.cell(labels)
+        cell[bisect_left(self.buckets, valore)] += 1
+        cell[-2] += valore
+        cell[-1] += 1
+
+    def samples(self) -> Iterable[tuple[str, tuple, float]]:
+        for labels, cell in sorted(self._shards.collect().items()):
+            cumulato = 0
+            for limite, conteggio in zip(self.buckets, cell):
+                cumulato += conteggio
+                yield f"{self.name}_bucket", labels + (("le", _number(limite)),), cumulato
+            yield f"{self.name}_bucket", labels + (("le", "+Inf"),), cell[-1]
+            yield f"{self.name}_sum", labels, cell[-2]
+            yield f"{self.name}_count", labels, cell[-1]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DURATION_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    # più callback con lo stesso nome vengono esportati come un'unica metrica
+    def gauge_callback(self, name: str, help: str, labelnames: tuple[str, ...], callback: Callable[[], dict]) -> None:
+        if name in self._metrics:
+            self._metrics[name].callbacks.append(callback)
+        else:
+            self.register(CallbackGauge(name, help, labelnames, callback))
+
+    # formato di esposizione testuale di Prometheus
+    def render(self) -> str:
+        righe = []
+        for metric in self._metrics.values():
+            righe.append(f"# HELP {metric.name} {metric.help}")
+            righe.append(f"# TYPE {metric.name} {metric.type}")
+            for nome, labels, valore in metric.samples():
+                coppie = list(zip(metric.labelnames, labels[:len(metric.labelnames)])) + list(labels[len(metric.labelnames):])
+                etichette = ",".join(f'{k}="{_escape(v)}"' for k, v in coppie)
+                righe.append(f"{nome}{{{etichette}}} {_number(valore)}" if etichette else f"{nome} {_number(valore)}")
+        return "\n".join(righe) + "\n"
+
+
+def _escape(valore) -> str:
+    return str(valore).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(valore: float) -> str:
+    if isinstance(valore, float) and valore.is_integer():
+        return str(int(valore))
+    return repr(valore) if isinstance(valore, float) else str(valore)
+
+
+registry = Registry()
+
+REQUESTS = registry.counter("http_requests_total", "Richieste HTTP completate", ("method", "route", "status"))
+REQUEST_DURATION = registry.histogram("http_request_duration_seconds", "Durata delle richieste HTTP",
+                                      ("method", "route"))
+IN_FLIGHT = registry.gauge("http_requests_in_flight", "Richieste HTTP in corso")
+REQUEST_STATEMENTS = registry.histogram("http_request_db_statements", "Statement SQL eseguiti per richiesta",
+                                        ("method", "route"), COUNT_BUCKETS)
+REQUEST_DB_TIME = registry.histogram("http_request_db_seconds", "Tempo speso in SQL per richiesta",
+                                     ("method", "route"))
+STATEMENTS = registry.counter("db_statements_total", "Statement SQL eseguiti", ("engine",))
+STATEMENT_DURATION = registry.histogram("db_statement_duration_seconds", "Durata degli statement SQL", ("engine",))
+PEER_REQUESTS = registry.counter("peer_requests_total", "Chiamate agli altri servizi",
+                                 ("peer", "operation", "outcome"))
+PEER_DURATION = registry.histogram("peer_request_duration_seconds",
+                                   "Durata delle chiamate agli altri servizi, retry compresi", ("peer", "operation"))
+
+# statement SQL e tempo in SQL della richiesta in corso; la lista è condivisa con i thread del threadpool,
+# che ricevono una copia del contesto
+_richiesta: ContextVar[list | None] = ContextVar("metrics_richiesta", default=None)
+
+
+# registra numero e durata degli statement SQL di un engine e l'occupazione del suo pool
+def instrument_engine(engine: Engine, nome: str) -> None:
+    labels = (nome,)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        durata = perf_counter() - conn.info["metrics_start"].pop()
+        STATEMENTS.inc(labels)
+        STATEMENT_DURATION.observe(durata, labels)
+        accumulo = _richiesta.get()
+        if accumulo is not None:
+            accumulo[0] += 1
+            accumulo[1] += durata
+
+    @event.listens_for(engine, "handle_error")
+    def error(context):
+        if context.connection is not None and context.connection.info.get("metrics_start"):
+            context.connection.info["metrics_start"].pop()
+
+    pool = engine.pool
+    registry.gauge_callback("db_pool_checked_out", "Connessioni del pool in uso", ("engine",),
+                            lambda: {labels: pool.checkedout()})
+    registry.gauge_callback("db_pool_size", "Connessioni stabili del pool", ("engine",),
+                            lambda: {labels: pool.size()})
+    registry.gauge_callback("db_pool_overflow", "Connessioni oltre la dimensione del pool", ("engine",),
+                            lambda: {labels: max(0, pool.overflow())})
+
+
+# registra una chiamata a un altro servizio; outcome è "ok", "error" o "short_circuit"
+def observe_peer(peer: str, operation: str, seconds: float, outcome: str) -> None:
+    PEER_REQUESTS.inc((peer, operation, outcome))
+    PEER_DURATION.observe(seconds, (peer, operation))
+
+
+# middleware ASGI: durata, esito, statement e tempo SQL di ogni richiesta HTTP, per metodo e route
+# (il percorso con i parametri, es. /members/{cf}, così le etichette restano poche)
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stato = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                stato[0] = message["status"]
+            await send(message)
+
+        accumulo = [0, 0.0]
+        token = _richiesta.set(accumulo)
+        IN_FLIGHT.inc()
+        inizio = perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            durata = perf_counter() - inizio
+            IN_FLIGHT.dec()
+            _richiesta.reset(token)
+            # le route incluse con un prefisso (es. GraphQLRouter su /graphql) hanno un percorso vuoto:
+            # il loro percorso è fisso, quindi si usa quello della richiesta
+            route = scope.get("route")
+            labels = (scope["method"], (route.path or scope["path"]) if route is not None else "unmatched")
+            REQUESTS.inc(labels + (stato[0],))
+            REQUEST_DURATION.observe(durata, labels)
+            REQUEST_STATEMENTS.observe(accumulo[0], labels)
+            REQUEST_DB_TIME.observe(accumulo[1], labels)
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from typing import Callable
+from sqlalchemy import func
+from sqlalchemy.orm import Session, sessionmaker
+from model import Outbox
+import logging
+import os
+import random
+
+logger = logging.getLogger(__name__)
+
+CANCELLA_PRENOTAZIONI = "cancella_prenotazioni"
+
+
+# registra un evento nella sessione del chiamante: viene salvato solo se la transazione va a buon fine
+def enqueue(db: Session, tipo: str, cf: str) -> None:
+    adesso = datetime.utcnow()
+    db.add(Outbox(tipo=tipo, cf=cf, creato=adesso, tentativi=0, prossimo_tentativo=adesso))
+
+
+# consegna in background gli eventi dell'outbox: li legge a blocchi, li invia con una sola chiamata
+# e li elimina solo dopo la conferma del servizio. In caso di errore il blocco viene ritentato con
+# backoff esponenziale; la consegna è almeno una volta, quindi `send` deve essere idempotente.
+# `send` riceve per ogni cf l'istante dell'evento più recente: la consegna può arrivare molto dopo,
+# quando con lo stesso cf è già stato registrato un nuovo membro, e il servizio che la riceve
+# deve ignorare quanto creato dopo quell'istante
+class Dispatcher:
+
+    def __init__(self, session_factory: sessionmaker, send: Callable[[dict[str, datetime]], None], tipo: str,
+                 batch_size: int, poll_interval: float, backoff: float, max_backoff: float):
+        self.session_factory = session_factory
+        self.send = send
+        self.tipo = tipo
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.consegnati = 0
+        self.errori = 0
+        self.ultimo_errore: str | None = None
+        self._wakeup = Event()
+        self._stop = Event()
+        self._lock = Lock()
+        self._thread: Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, name=f"outbox-{self.tipo}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # da chiamare dopo il commit di un nuovo evento, per consegnarlo senza attendere il prossimo controllo
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            # azzerato prima di leggere il blocco: un notify che arriva durante la consegna fa ripartire
+            # subito il ciclo invece di andare perso fino al prossimo controllo
+            self._wakeup.clear()
+            try:
+                consegnati = self.dispatch()
+            except Exception:
+                logger.exception("Errore nella lettura dell'outbox")
+                consegnati = 0
+            # se il blocco era pieno potrebbero esserci altri eventi pronti
+            if consegnati < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+    # consegna un blocco di eventi pronti; restituisce quanti eventi sono stati consegnati.
+    # Le sessioni usano l'unica connessione di scrittura del servizio, quindi restano aperte solo per leggere
+    # il blocco e per registrarne l'esito: durante la chiamata a `send` le altre scritture non attendono
+    def dispatch(self) -> int:
+        with self.session_factory() as db:
+            eventi = db.query(Outbox.id, Outbox.cf, Outbox.creato, Outbox.tentativi).filter(
+                Outbox.tipo == self.tipo, Outbox.prossimo_tentativo <= datetime.utcnow()).order_by(
+                Outbox.id).limit(self.batch_size).all()
+        if not eventi:
+            return 0
+        ids = [evento.id for evento in eventi]
+        istanti: dict[str, datetime] = {}
+        for evento in eventi:
+            istanti[evento.cf] = max(evento.creato, istanti.get(evento.cf, evento.creato))
+
+        try:
+            self.send(istanti)
+        except Exception as e:
+            errore = str(e)[:500]
+            # lo stesso istante per tutto il blocco, così al prossimo tentativo viene consegnato insieme
+            tentativi = max(evento.tentativi for evento in eventi) + 1
+            prossimo = datetime.utcnow() + timedelta(seconds=self._pausa(tentativi))
+            with self.session_factory() as db:
+                db.query(Outbox).filter(Outbox.id.in_(ids)).update(
+                    {Outbox.tentativi: Outbox.tentativi + 1, Outbox.ultimo_errore: errore,
+                     Outbox.prossimo_tentativo: prossimo}, synchronize_session=False)
+                db.commit()
+            with self._lock:
+                self.errori += 1
+                self.ultimo_errore = errore
+            logger.warning("Consegna di %d eventi %s fallita: %s", len(eventi), self.tipo, errore)
+            return 0
+
+        with self.session_factory() as db:
+            db.query(Outbox).filter(Outbox.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+        with self._lock:
+            self.consegnati += len(eventi)
+        return len(eventi)
+
+    def _pausa(self, tentativi: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (tentativi - 1)))  # full jitter
+
+    # da eseguire con una sessione di sola lettura, ad esempio tramite run_db(..., read=True)
+    def stats(self, db: Session) -> dict:
+        in_attesa, meno_recente = db.query(func.count(Outbox.id), func.min(Outbox.creato)).filter(
+            Outbox.tipo == self.tipo).one()
+        with self._lock:
+            return {"tipo": self.tipo, "in_attesa": in_attesa,
+                    "attesa_massima_s": (datetime.utcnow() - meno_recente).total_seconds() if meno_recente else 0.0,
+                    "consegnati": self.consegnati, "errori": self.errori, "ultimo_errore": self.ultimo_errore}
+
+
+# crea il dispatcher leggendo la configurazione dalle variabili d'ambiente
+def dispatcher(session_factory: sessionmaker, send: Callable[[dict[str, datetime]], None], tipo: str) -> Dispatcher:
+    return Dispatcher(
+        session_factory=session_factory,
+        send=send,
+        tipo=tipo,
+        batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", "100")),
+        poll_interval=float(os.environ.get("OUTBOX_POLL_INTERVAL", "5")),
+        backoff=float(os.environ.get("OUTBOX_BACKOFF", "1")),
+        max_backoff=float(os.environ.get("OUTBOX_MAX_BACKOFF", "300")),
+    )
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Iterator
+from graphql import GraphQLError
+from strawberry.extensions import SchemaExtension
+import hashlib
+import json
+import os
+
+NOT_FOUND = "PERSISTED_QUERY_NOT_FOUND"
+
+
+def sha256(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+# testi delle query persistite (APQ) indicizzati per hash SHA-256: LRU limitata per quelle
+# inviate dai client, più quelle registrate all'avvio che non vengono mai rimosse
+class PersistedQueries:
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._registered: dict[str, str] = {}
+        self._lock = Lock()
+
+    def get(self, digest: str) -> str | None:
+        with self._lock:
+            query = self._registered.get(digest)
+            if query is None:
+                query = self._entries.get(digest)
+                if query is not None:
+                    self._entries.move_to_end(digest)
+            if query is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return query
+
+    def put(self, digest: str, query: str) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if digest in self._registered:
+                return
+            self._entries[digest] = query
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # registra in modo permanente le query note in anticipo (es. quelle tra i microservizi)
+    def register(self, *queries: str) -> None:
+        with self._lock:
+            for query in queries:
+                self._registered[sha256(query)] = query
+
+    # registra le query elencate in un file JSON (una lista di documenti)
+    def register_file(self, path: str) -> None:
+        with open(path) as f:
+            self.register(*json.load(f))
+
+    def stats(self) -> dict:
+        with self._lock:
+            richieste = self.hits + self.misses
+            return {"size": len(self._entries), "maxsize": self.maxsize, "registered": len(self._registered),
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / richieste if richieste else 0.0}
+
+
+persisted_queries = PersistedQueries(int(os.environ.get("APQ_CACHE_SIZE", "1000")))
+if os.environ.get("APQ_PRELOAD"):
+    persisted_queries.register_file(os.environ["APQ_PRELOAD"])
+
+
+# protocollo APQ: se la richiesta contiene extensions.persistedQuery senza il testo della query, il testo
+# viene preso dall'hash; se c'è anche il testo viene verificato e memorizzato per le richieste successive
+class PersistedQueryExtension(SchemaExtension):
+
+    def on_operation(self) -> Iterator[None]:
+        context = self.execution_context
+        persisted = (context.operation_extensions or {}).get("persistedQuery")
+        if isinstance(persisted, dict) and persisted.get("sha256Hash"):
+            digest = persisted["sha256Hash"]
+            if context.query:
+                if sha256(context.query) != digest:
+                    raise GraphQLError("provided sha does not match query",
+                                       extensions={"code": "PERSISTED_QUERY_HASH_MISMATCH"})
+                persisted_queries.put(digest, context.query)
+            else:
+                query = persisted_queries.get(digest)
+                if query is None:
+                    raise GraphQLError("PersistedQueryNotFound", extensions={"code": NOT_FOUND})
+                context.query = query
+        yield
+
+
+def _body(query: str, variables: dict, with_query: bool) -> dict:
+    body = {"variables": variables,
+            "extensions": {"persistedQuery": {"version": 1, "sha256Hash": sha256(query)}}}
+    if with_query:
+        body["query"] = query
+    return body
+
+
+def _not_found(response) -> bool:
+    try:
+        errors = response.json().get("errors") or []
+    except ValueError:
+        return False
+    return any((e.get("extensions") or {}).get("code") == NOT_FOUND for e in errors)
+
+
+# invia una query a un altro servizio GraphQL con il protocollo APQ: prima il solo hash,
+# poi anche il testo solo se il servizio non la conosce ancora
+async def apost(client, query: str, variables: dict, **kwargs):
+    response = await client.apost("/graphql", json=_body(query, variables, False), **kwargs)
+    if _not_found(response):
+        response = await client.apost("/graphql", json=_body(query, variables, True), **kwargs)
+    return response
+
+
+# versione sincrona di apost, per i thread in background
+def post(client, query: str, variables: dict, **kwargs):
+    response = client.post("/graphql", json=_body(query, variables, False), **kwargs)
+    if _not_found(response):
+        response = client.post("/graphql", json=_body(query, variables, True), **kwargs)
+    return response
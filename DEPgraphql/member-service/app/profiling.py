@@ -0,0 +1,162 @@
+from contextvars import ContextVar
+from time import perf_counter
+import json
+import logging
+import os
+import re
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# profilazione SQL su richiesta: disattivata non registra nessun evento sugli engine
+ENABLED = os.environ.get("SQL_PROFILE", "0") == "1"
+# statement più lenti di questa soglia vengono registrati nel log con il loro piano di esecuzione
+SLOW_MS = float(os.environ.get("SQL_PROFILE_SLOW_MS", "100"))
+# numero di esecuzioni della stessa forma di statement in una richiesta oltre il quale si sospetta un N+1
+N_PLUS_ONE = int(os.environ.get("SQL_PROFILE_N_PLUS_ONE", "5"))
+
+# il client chiede la traccia della richiesta con questo header e la riceve nello stesso header della risposta
+TRACE_HEADER = "x-sql-trace"
+# limiti della traccia nell'header, che i proxy non accettano oltre qualche KB
+HEADER_STATEMENTS = 50
+HEADER_SQL_CHARS = 200
+
+_SPAZI = re.compile(r"\s+")
+_LISTA_PARAMETRI = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+_COLONNE = re.compile(r"^SELECT (?:DISTINCT )?.+? FROM ")
+_CON_PIANO = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+# forma dello statement: il testo con i parametri, senza spazi superflui e con le liste IN (?, ?, ...)
+# ridotte a (?), così la stessa query con un numero diverso di valori conta come una sola
+def shape(statement: str) -> str:
+    return _LISTA_PARAMETRI.sub("(?)", _SPAZI.sub(" ", statement).strip())
+
+
+# forma da mostrare nel log e nella traccia: l'elenco delle colonne generato dall'ORM non serve a
+# riconoscere la query e occuperebbe tutto lo spazio
+def short(forma: str) -> str:
+    return _COLONNE.sub("SELECT ... FROM ", forma, count=1)
+
+
+# statement eseguiti durante una richiesta
+class Traccia:
+
+    def __init__(self, richiesta: str, dettaglio: bool):
+        self.richiesta = richiesta
+        self.dettaglio = dettaglio
+        self.statements: list[tuple[str, str, float, int | None]] = []
+
+    def add(self, engine: str, statement: str, durata: float, righe: int | None) -> None:
+        self.statements.append((engine, statement, durata, righe))
+
+    # forme eseguite almeno N_PLUS_ONE volte, dalla più ripetuta
+    def ripetute(self) -> list[tuple[str, int]]:
+        conteggi: dict[str, int] = {}
+        for _, statement, _, _ in self.statements:
+            forma = shape(statement)
+            conteggi[forma] = conteggi.get(forma, 0) + 1
+        return sorted(((f, n) for f, n in conteggi.items() if n >= N_PLUS_ONE), key=lambda c: -c[1])
+
+    def summary(self) -> dict:
+        return {
+            "statements": len(self.statements),
+            "ms": round(sum(s[2] for s in self.statements) * 1000, 3),
+            "n_plus_one": [{"sql": short(forma), "count": n} for forma, n in self.ripetute()],
+        }
+
+    def to_dict(self) -> dict:
+        dati = self.summary()
+        dati["trace"] = [
+            {"engine": engine, "sql": short(shape(statement)), "ms": round(durata * 1000, 3), "rows": righe}
+            for engine, statement, durata, righe in self.statements
+        ]
+        return dati
+
+    # versione compatta per l'header della risposta: al più HEADER_STATEMENTS statement troncati
+    def header(self) -> str:
+        dati = self.summary()
+        dati["trace"] = [[round(durata * 1000, 3), short(shape(statement))[:HEADER_SQL_CHARS]]
+                         for _, statement, durata, _ in self.statements[:HEADER_STATEMENTS]]
+        return json.dumps(dati, separators=(",", ":"))
+
+
+# traccia della richiesta in corso; i thread del threadpool ricevono una copia del contesto
+# ma condividono lo stesso oggetto
+_traccia: ContextVar[Traccia | None] = ContextVar("profiling_traccia", default=None)
+
+
+def current() -> Traccia | None:
+    return _traccia.get()
+
+
+def _explain(conn, statement: str, parameters) -> str:
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return "\n".join(f"  {riga[-1]}" for riga in cursor.fetchall())
+    except Exception as errore:
+        return f"  piano non disponibile: {errore}"
+    finally:
+        cursor.close()
+
+
+# registra ogni statement nella traccia della richiesta e scrive nel log quelli lenti con il piano di esecuzione
+def instrument_engine(engine: Engine, nome: str) -> None:
+    if not ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profiling_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        durata = perf_counter() - conn.info["profiling_start"].pop()
+        traccia = _traccia.get()
+        if traccia is not None:
+            traccia.add(nome, statement, durata, cursor.rowcount if cursor.rowcount >= 0 else None)
+        if durata * 1000 >= SLOW_MS:
+            forma = shape(statement)
+            piano = ""
+            if forma.upper().startswith(_CON_PIANO):
+                piano = _explain(conn, statement, parameters[0] if executemany and parameters else parameters)
+            logger.warning("Statement lento (%.1f ms, engine %s, richiesta %s): %s%s", durata * 1000, nome,
+                           traccia.richiesta if traccia is not None else "-", short(forma),
+                           f"\n{piano}" if piano else "")
+
+    @event.listens_for(engine, "handle_error")
+    def error(context):
+        if context.connection is not None and context.connection.info.get("profiling_start"):
+            context.connection.info["profiling_start"].pop()
+
+
+# middleware ASGI: raccoglie gli statement di ogni richiesta HTTP, segnala le forme ripetute (possibili N+1)
+# e, se la richiesta contiene l'header x-sql-trace, restituisce la traccia nell'omonimo header della risposta.
+# Le risposte in streaming inviano gli header prima di eseguire le query, quindi la loro traccia è parziale
+class ProfilingMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        dettaglio = any(nome == TRACE_HEADER.encode() for nome, _ in scope["headers"])
+        traccia = Traccia(f"{scope['method']} {scope['path']}", dettaglio)
+
+        async def send_trace(message):
+            if message["type"] == "http.response.start" and dettaglio:
+                message["headers"] = list(message.get("headers", [])) + [
+                    (TRACE_HEADER.encode(), traccia.header().encode("latin-1", "replace"))]
+            await send(message)
+
+        token = _traccia.set(traccia)
+        try:
+            await self.app(scope, receive, send_trace)
+        finally:
+            _traccia.reset(token)
+            for forma, n in traccia.ripetute():
+                logger.warning("Possibile N+1 in %s: %d esecuzioni di %s", traccia.richiesta, n, short(forma))
@@ -0,0 +1,40 @@
+# documenti GraphQL scambiati tra member-service e resource-service: sono uguali nei due servizi,
+# così chi li riceve può registrarli all'avvio e chi li invia può mandare solo l'hash (APQ)
+
+# serviti da member-service
+CHECK_MEMBER = """
+query ($cf: String!) {
+    checkMember(cf: $cf) {
+        cf
+        name
+        surname
+        registrationDate
+    }
+}
+"""
+
+MEMBERS_EXIST = """
+query ($cfs: [String!]!) {
+    membersExist(cfs: $cfs) {
+        cf
+        exists
+    }
+}
+"""
+
+# serviti da resource-service
+DELETE_PRENOTAZIONI_BATCH = """
+mutation ($cfs: [String!]!, $cancellati: [MembroCancellatoInput!], $inviato: DateTime) {
+    deletePrenotazioniBatch(cfs: $cfs, cancellati: $cancellati, inviato: $inviato)
+}
+"""
+
+PRENOTAZIONI_MEMBRI = """
+query ($cfs: [String!]!) {
+    prenotazioniMembri(cfs: $cfs) {
+        cf
+        campi { data ora tipologia }
+        piscina { data lettini ombrelloni }
+    }
+}
+"""
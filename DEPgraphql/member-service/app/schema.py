@@ -1,7 +1,28 @@
+from pydantic import BaseModel, constr
 import strawberry
 from datetime import date
 
 
+@strawberry.type
+class PrenotazioneCampo:
+    data: date
+    ora: int
+    tipologia: str
+
+
+@strawberry.type
+class PrenotazionePiscina:
+    data: date
+    lettini: int
+    ombrelloni: int
+
+
+@strawberry.type
+class Prenotazioni:
+    campi: list[PrenotazioneCampo]
+    piscina: list[PrenotazionePiscina]
+
+
 @strawberry.type
 class MemberType:
     cf: str
@@ -9,6 +30,20 @@ class MemberType:
     surname: str
     registration_date: date
 
+    # prenotazioni del membro da oggi in poi: il loader nel contesto della richiesta raccoglie i cf
+    # di tutti i membri restituiti e li chiede a resource-service con una sola chiamata
+    @strawberry.field
+    async def prenotazioni(self, info: strawberry.Info) -> Prenotazioni | None:
+        return await info.context["prenotazioni_loader"].load(self.cf)
+
+
+# regole di validazione di un nuovo membro, le stesse di MemberCreate nel servizio REST;
+# applicate da bulk.validate_member sia a addMember che a addMembers
+class MemberCreate(BaseModel):
+    cf: constr(strip_whitespace=True, min_length=16, max_length=16)
+    name: constr(strip_whitespace=True, min_length=1)
+    surname: constr(strip_whitespace=True, min_length=1)
+
 
 @strawberry.input
 class MemberInput:
@@ -17,6 +52,58 @@ class MemberInput:
     surname: str
 
 
+@strawberry.type
+class MemberExists:
+    cf: str
+    exists: bool
 
 
+@strawberry.type
+class RigaScartata:
+    riga: int
+    cf: str
+    esito: str  # duplicate oppure invalid
+    detail: str
 
+
+@strawberry.type
+class ImportResult:
+    aggiunti: int
+    duplicati: int
+    non_validi: int
+    errori: list[RigaScartata]
+
+
+@strawberry.type
+class PersistedQueryStats:
+    size: int
+    maxsize: int
+    registered: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+@strawberry.type
+class ClientStats:
+    url: str
+    state: str
+    consecutive_failures: int
+    requests: int
+    errors: int
+    retries: int
+    short_circuited: int
+    avg_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+@strawberry.type
+class OutboxStats:
+    tipo: str
+    in_attesa: int
+    attesa_massima_s: float
+    consegnati: int
+    errori: int
+    ultimo_errore: str | None
@@ -0,0 +1,14 @@
+from typing import Any
+from strawberry.extensions import SchemaExtension
+import profiling
+
+
+# con la profilazione attiva e l'header x-sql-trace nella richiesta, aggiunge agli extensions della
+# risposta la traccia completa degli statement eseguiti, senza i limiti dell'header
+class SQLTrace(SchemaExtension):
+
+    def get_results(self) -> dict[str, Any]:
+        traccia = profiling.current()
+        if traccia is None or not traccia.dettaglio:
+            return {}
+        return {"sqlTrace": traccia.to_dict()}
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from datetime import date
+from threading import Lock
+from typing import Any
+import os
+import secrets
+
+
+# cache delle risposte sulla disponibilità (orari liberi dei campi, posti liberi in piscina).
+# Ogni data ha un numero di versione incrementato da ogni prenotazione o cancellazione in quella data,
+# dopo il commit; le risposte sono memorizzate con chiave (data, tipo, versione), quindi una scrittura
+# le rende irraggiungibili senza doverle cercare e le versioni vecchie escono dalla LRU.
+# Le versioni vivono nel processo, come l'indice dell'occupazione, quindi il servizio deve girare con
+# un solo worker; l'epoca casuale nell'ETag evita che dopo un riavvio un ETag vecchio risulti valido
+class AvailabilityCache:
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._epoca = secrets.token_hex(4)
+        self._versioni: dict[date, int] = {}
+        self._entries: "OrderedDict[tuple[date, str, int], Any]" = OrderedDict()
+        self._lock = Lock()
+
+    def version(self, data: date) -> int:
+        return self._versioni.get(data, 0)
+
+    # da chiamare dopo il commit di ogni scrittura che cambia la disponibilità delle date indicate
+    def bump(self, *date_: date) -> None:
+        with self._lock:
+            for data in set(date_):
+                self._versioni[data] = self._versioni.get(data, 0) + 1
+
+    # invalida tutte le date, ad esempio dopo aver ricaricato l'indice dell'occupazione
+    def clear(self) -> None:
+        with self._lock:
+            self._epoca = secrets.token_hex(4)
+            self._versioni.clear()
+            self._entries.clear()
+
+    def etag(self, data: date, tipo: str, versione: int) -> str:
+        return f'W/"{self._epoca}-{data.isoformat()}-{tipo}-{versione}"'
+
+    # restituisce la risposta memorizzata per la versione indicata oppure None
+    def get(self, data: date, tipo: str, versione: int) -> Any:
+        with self._lock:
+            valore = self._entries.get((data, tipo, versione))
+            if valore is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((data, tipo, versione))
+            self.hits += 1
+            return valore
+
+    # la versione va letta prima di calcolare la risposta: se nel frattempo una scrittura la incrementa,
+    # la risposta resta associata alla versione precedente e non viene più servita
+    def set(self, data: date, tipo: str, versione: int, valore: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[(data, tipo, versione)] = valore
+            self._entries.move_to_end((data, tipo, versione))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            richieste = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "versioned_dates": len(self._versioni),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / richieste if richieste else 0.0,
+            }
+
+
+availability = AvailabilityCache(int(os.environ.get("AVAILABILITY_CACHE_SIZE", "4096")))
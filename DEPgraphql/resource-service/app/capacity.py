@@ -0,0 +1,65 @@
+from datetime import date
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from model import PrenotazioniPiscina, OccupazionePiscina
+import logging
+
+logger = logging.getLogger(__name__)
+
+LETTINI_TOTALI = 80
+OMBRELLONI_TOTALI = 20
+
+
+# ricostruisce i contatori giornalieri della piscina a partire dalle prenotazioni. I giorni già venduti
+# oltre la capienza (prenotazioni precedenti ai contatori) non rispettano i vincoli della tabella: il contatore
+# viene fermato alla capienza, così il giorno risulta pieno, e li restituisce perché vengano sistemati a mano
+def rebuild(db: Session) -> list[dict]:
+    db.query(OccupazionePiscina).delete(synchronize_session=False)
+    totali = db.query(PrenotazioniPiscina.data,
+                      func.sum(PrenotazioniPiscina.lettini),
+                      func.sum(PrenotazioniPiscina.ombrelloni)).group_by(PrenotazioniPiscina.data).all()
+    oltre = [{"data": data, "lettini": lettini, "ombrelloni": ombrelloni} for data, lettini, ombrelloni in totali
+             if lettini > LETTINI_TOTALI or ombrelloni > OMBRELLONI_TOTALI]
+    for giorno in oltre:
+        logger.warning("Piscina oltre la capienza il %s: %d lettini e %d ombrelloni prenotati",
+                       giorno["data"], giorno["lettini"], giorno["ombrelloni"])
+    db.add_all(OccupazionePiscina(data=data, lettini=min(lettini, LETTINI_TOTALI),
+                                  ombrelloni=min(ombrelloni, OMBRELLONI_TOTALI))
+               for data, lettini, ombrelloni in totali)
+    db.commit()
+    return oltre
+
+
+# lettini e ombrelloni già prenotati in una certa data
+def booked(db: Session, data: date) -> tuple[int, int]:
+    occupazione = db.get(OccupazionePiscina, data)
+    if not occupazione:
+        return 0, 0
+    return occupazione.lettini, occupazione.ombrelloni
+
+
+# riserva lettini e ombrelloni con un solo statement condizionale, che fallisce se supererebbe
+# la capienza; non esegue il commit, così la riserva fa parte della transazione della prenotazione
+def reserve(db: Session, data: date, lettini: int, ombrelloni: int) -> bool:
+    if lettini > LETTINI_TOTALI or ombrelloni > OMBRELLONI_TOTALI:
+        return False
+    tabella = OccupazionePiscina.__table__
+    statement = insert(tabella).values(data=data, lettini=lettini, ombrelloni=ombrelloni)
+    statement = statement.on_conflict_do_update(
+        index_elements=[tabella.c.data],
+        set_={"lettini": tabella.c.lettini + statement.excluded.lettini,
+              "ombrelloni": tabella.c.ombrelloni + statement.excluded.ombrelloni},
+        where=(tabella.c.lettini + statement.excluded.lettini <= LETTINI_TOTALI)
+        & (tabella.c.ombrelloni + statement.excluded.ombrelloni <= OMBRELLONI_TOTALI)
+    )
+    return db.execute(statement).rowcount == 1
+
+
+# restituisce alla disponibilità i posti di una prenotazione cancellata, senza commit; non scende sotto zero
+# nei giorni il cui contatore è stato fermato alla capienza da rebuild
+def release(db: Session, data: date, lettini: int, ombrelloni: int) -> None:
+    db.query(OccupazionePiscina).filter(OccupazionePiscina.data == data).update({
+        OccupazionePiscina.lettini: func.max(OccupazionePiscina.lettini - lettini, 0),
+        OccupazionePiscina.ombrelloni: func.max(OccupazionePiscina.ombrelloni - ombrelloni, 0),
+    }, synchronize_session=False)
@@ -0,0 +1,115 @@
+from typing import Callable, Iterator
+from graphql import (FieldNode, FragmentSpreadNode, GraphQLError, GraphQLList, GraphQLObjectType,
+                     InlineFragmentNode, SelectionSetNode, get_named_type, get_nullable_type, is_leaf_type)
+from graphql.execution.values import get_argument_values, get_variable_values
+from graphql.utilities import get_operation_ast
+from strawberry.extensions import SchemaExtension
+import os
+
+DEFAULT_LIST_SIZE = 10
+
+
+# modello di costo di una richiesta GraphQL, calcolato sul documento prima dell'esecuzione:
+# - ogni campo di primo livello e ogni campo che restituisce un oggetto costa il suo peso (1 se non indicato),
+#   gli altri campi scalari 0 salvo un peso esplicito; ogni alias di un campo si paga per intero
+# - per i campi lista il costo dei sottocampi viene moltiplicato per la dimensione attesa della lista,
+#   presa dall'argomento `limit`, da `list_sizes` oppure DEFAULT_LIST_SIZE
+class CostModel:
+
+    def __init__(self, weights: dict[str, int] | None = None,
+                 list_sizes: dict[str, Callable[[dict], int]] | None = None,
+                 default_list_size: int = DEFAULT_LIST_SIZE):
+        self.weights = weights or {}
+        self.list_sizes = list_sizes or {}
+        self.default_list_size = default_list_size
+
+    def cost(self, schema, document, operation_name: str | None, variables: dict | None) -> int:
+        operation = get_operation_ast(document, operation_name)
+        if operation is None:
+            return 0
+        fragments = {d.name.value: d for d in document.definitions if d.kind == "fragment_definition"}
+        root = schema.get_root_type(operation.operation)
+        # variabili convertite come in esecuzione; se non sono valide gli argomenti che le usano vengono ignorati
+        coerced = get_variable_values(schema, operation.variable_definitions or [], variables or {})
+        if isinstance(coerced, list):
+            coerced = None
+        return self._selection_cost(schema, root, operation.selection_set, fragments, coerced)
+
+    def _selection_cost(self, schema, parent: GraphQLObjectType, selection_set: SelectionSetNode | None,
+                        fragments: dict, variables) -> int:
+        if selection_set is None:
+            return 0
+        totale = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                totale += self._field_cost(schema, parent, selection, fragments, variables)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = fragments.get(selection.name.value)
+                if fragment is not None:
+                    tipo = schema.get_type(fragment.type_condition.name.value)
+                    totale += self._selection_cost(schema, tipo, fragment.selection_set, fragments, variables)
+            elif isinstance(selection, InlineFragmentNode):
+                tipo = schema.get_type(selection.type_condition.name.value) if selection.type_condition else parent
+                totale += self._selection_cost(schema, tipo, selection.selection_set, fragments, variables)
+        return totale
+
+    def _field_cost(self, schema, parent: GraphQLObjectType, node: FieldNode, fragments: dict, variables) -> int:
+        nome = node.name.value
+        field = getattr(parent, "fields", {}).get(nome)
+        if field is None:
+            return 0  # __typename o campi inesistenti, segnalati dalla validazione
+
+        chiave = f"{parent.name}.{nome}"
+        tipo = get_nullable_type(field.type)
+        radice = parent in (schema.query_type, schema.mutation_type, schema.subscription_type)
+        peso = self.weights.get(chiave, 0 if is_leaf_type(get_named_type(tipo)) and not radice else 1)
+
+        figli = self._selection_cost(schema, get_named_type(tipo), node.selection_set, fragments, variables)
+        if isinstance(tipo, GraphQLList):
+            try:
+                argomenti = get_argument_values(field, node, variables)
+            except GraphQLError:
+                argomenti = {}
+            figli *= self._list_size(chiave, argomenti)
+        return peso + figli
+
+    def _list_size(self, chiave: str, argomenti: dict) -> int:
+        if chiave in self.list_sizes:
+            try:
+                return max(1, self.list_sizes[chiave](argomenti))
+            except (KeyError, TypeError):
+                return self.default_list_size
+        if isinstance(argomenti.get("limit"), int):
+            return max(1, argomenti["limit"])
+        return self.default_list_size
+
+
+# rifiuta prima dell'esecuzione le richieste che superano il costo massimo e riporta il costo
+# calcolato in `extensions.cost` di ogni risposta
+class CostLimiter(SchemaExtension):
+
+    def __init__(self, model: CostModel, max_cost: int):
+        super().__init__()
+        self.model = model
+        self.max_cost = max_cost
+        self.requested: int | None = None
+
+    def on_execute(self) -> Iterator[None]:
+        context = self.execution_context
+        self.requested = self.model.cost(context.schema._schema, context.graphql_document,
+                                         context.operation_name, context.variables)
+        if self.requested > self.max_cost:
+            raise GraphQLError(f"Query cost {self.requested} exceeds the maximum of {self.max_cost}",
+                               extensions={"code": "QUERY_TOO_EXPENSIVE"})
+        yield
+
+    def get_results(self) -> dict:
+        if self.requested is None:
+            return {}
+        return {"cost": {"requested": self.requested, "maximum": self.max_cost}}
+
+
+# limiti letti dalle variabili d'ambiente
+MAX_COST = int(os.environ.get("GRAPHQL_MAX_COST", "5000"))
+MAX_DEPTH = int(os.environ.get("GRAPHQL_MAX_DEPTH", "8"))
+MAX_ALIASES = int(os.environ.get("GRAPHQL_MAX_ALIASES", "15"))
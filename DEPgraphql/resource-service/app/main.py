@@ -1,71 +1,314 @@
 import strawberry
-from sqlalchemy import func
+from typing import Annotated, AsyncGenerator, Iterable
 from sqlalchemy.orm import Session
-from db import get_db, engine
-from model import PrenotazioniCampi, PrenotazioniPiscina
-import requests
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert
+from db import run_db, engine, SessionLocal, ReadSessionLocal
+from model import PrenotazioniCampi, PrenotazioniPiscina, OccupazionePiscina
 import uvicorn
 from model import Base
 from schema import *
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from strawberry.extensions import MaxAliasesLimiter, ParserCache, QueryDepthLimiter, ValidationCache
 from strawberry.fastapi import GraphQLRouter
+from datetime import date, datetime, timedelta, timezone
+from archive import archive
+from availability import availability
+from cache import member_cache
+from client import member_client, PEER_ERRORS
+from occupancy import occupancy
+from pubsub import broker, PISCINA
+import asyncio
+import capacity
+import cost
+import fastjson
+import metrics
+import migrations
+import operation_metrics
+import os
+import persisted
+import profiling
+import queries
+import sql_trace
+
+
+MAX_GIORNI_CALENDARIO = 92
+MAX_SLOT_PRENOTAZIONE = 36
+MAX_CF_CANCELLAZIONE = 1000
+MAX_CF_PRENOTAZIONI = 1000
+MAX_STAGIONI_STORICO = 10
+MAX_GIORNI_ISCRIZIONE = 31
+DOCUMENT_CACHE_SIZE = int(os.environ.get("GRAPHQL_DOCUMENT_CACHE_SIZE", "256"))
+
+
+# campo richiesto dalla risposta GraphQL di member-service. Una risposta con `errors` e senza dati (ad esempio
+# una query rifiutata dai limiti di profondità, alias o costo) viene trattata come un servizio non
+# raggiungibile: il membro non può essere verificato e nessun esito viene salvato in cache
+def member_data(response, campo: str):
+    data = response.json()
+    if data.get("errors") or data.get("data") is None:
+        raise Exception(f"Cannot reach member service: {data.get('errors') or 'risposta senza dati'}")
+    return data["data"][campo]
 
 
 # Funzione di supporto per verificare se un membro esiste e quindi può effettuare prenotazioni
-def check_member(cf: str) -> bool:
+async def check_member(cf: str) -> bool:
+    # esito già noto dalla cache
+    cached = member_cache.get(cf)
+    if cached is not None:
+        return cached
+
     try:
-        url = "http://member-service:5000/graphql"
-        query = """
-        query ($cf: String!) {
-            checkMember(cf: $cf) {
-                cf
-                name
-                surname
-                registrationDate
-            }
-        }
-        """
-        variables = {"cf": cf}
-        response = requests.post(url, json={"query": query, "variables": variables})
+        response = await persisted.apost(member_client, queries.CHECK_MEMBER, {"cf": cf}, idempotent=True,
+                                         operation="check_member")
         response.raise_for_status()
-        data = response.json()
-        return data["data"]["checkMember"] is not None
-    except requests.exceptions.RequestException as e:
+        exists = member_data(response, "checkMember") is not None
+        member_cache.set(cf, exists)
+        return exists
+    except PEER_ERRORS as e:
         raise Exception(f"Cannot reach member service: {str(e)}")
 
 
+# versione di check_member per molti membri: i codici fiscali non presenti in cache
+# vengono verificati con una sola chiamata a member-service
+async def check_members(cfs: list[str]) -> dict[str, bool]:
+    esiti = {}
+    mancanti = []
+    for cf in {cf.upper() for cf in cfs}:
+        cached = member_cache.get(cf)
+        if cached is None:
+            mancanti.append(cf)
+        else:
+            esiti[cf] = cached
+    if not mancanti:
+        return esiti
+
+    try:
+        response = await persisted.apost(member_client, queries.MEMBERS_EXIST, {"cfs": mancanti},
+                                         idempotent=True, operation="check_members")
+        response.raise_for_status()
+        for esito in member_data(response, "membersExist"):
+            member_cache.set(esito["cf"], esito["exists"])
+            esiti[esito["cf"]] = esito["exists"]
+        return esiti
+    except PEER_ERRORS as e:
+        raise Exception(f"Cannot reach member service: {str(e)}")
+
+
+# rimuove le prenotazioni dei membri indicati dalla data corrente in poi, restituendo alla disponibilità
+# i posti della piscina nella stessa transazione; restituisce il numero di prenotazioni rimosse.
+# `cancellati` indica, per i cf tornati membri, l'istante in cui il membro è stato eliminato: le prenotazioni
+# create dopo appartengono al nuovo membro, registrato prima che la cancellazione arrivasse qui.
+# Gli istanti sono misurati da member-service, che invia anche il proprio orario di invio (`inviato`): la
+# differenza con l'orario di arrivo riporta i limiti sull'orologio di questo servizio, con cui è scritta `creata`
+# (la stima include anche la latenza della chiamata, di cui il limite risulta spostato in avanti)
+def remove_bookings(db: Session, cfs: list[str], cancellati: dict[str, datetime] | None = None,
+                    inviato: datetime | None = None) -> int:
+    cfs = sorted({cf.upper() for cf in cfs})
+
+    # confrontati in UTC senza fuso orario, come la colonna `creata`
+    def utc(istante: datetime) -> datetime:
+        return istante.astimezone(timezone.utc).replace(tzinfo=None) if istante.tzinfo else istante
+
+    scarto = datetime.utcnow() - utc(inviato) if inviato else timedelta(0)
+    limiti = {cf.upper(): utc(istante) + scarto for cf, istante in (cancellati or {}).items()}
+
+    def da_rimuovere(riga) -> bool:
+        limite = limiti.get(riga.cf)
+        return limite is None or riga.creata is None or riga.creata < limite
+
+    # orari da liberare nell'indice dei campi
+    campi = [riga for riga in db.query(
+        PrenotazioniCampi.id, PrenotazioniCampi.cf, PrenotazioniCampi.creata, PrenotazioniCampi.data,
+        PrenotazioniCampi.tipologia, PrenotazioniCampi.ora).filter(
+        PrenotazioniCampi.cf.in_(cfs), PrenotazioniCampi.data >= date.today()) if da_rimuovere(riga)]
+    db.query(PrenotazioniCampi).filter(PrenotazioniCampi.id.in_([riga.id for riga in campi])).delete(
+        synchronize_session=False)
+
+    # posti da restituire alla disponibilità della piscina
+    piscina = [riga for riga in db.query(
+        PrenotazioniPiscina.id, PrenotazioniPiscina.cf, PrenotazioniPiscina.creata, PrenotazioniPiscina.data,
+        PrenotazioniPiscina.lettini, PrenotazioniPiscina.ombrelloni).filter(
+        PrenotazioniPiscina.cf.in_(cfs), PrenotazioniPiscina.data >= date.today()) if da_rimuovere(riga)]
+    for riga in piscina:
+        capacity.release(db, riga.data, riga.lettini, riga.ombrelloni)
+    db.query(PrenotazioniPiscina).filter(PrenotazioniPiscina.id.in_([riga.id for riga in piscina])).delete(
+        synchronize_session=False)
+    db.commit()
+    for riga in campi:
+        occupancy.release(riga.data, riga.tipologia, riga.ora)
+    changed([(riga.data, riga.tipologia) for riga in campi] + [(riga.data, PISCINA) for riga in piscina])
+
+    # i membri sono stati eliminati: gli esiti in cache non sono più validi
+    for cf in cfs:
+        member_cache.invalidate(cf)
+    return len(campi) + len(piscina)
+
+
+# da chiamare dopo il commit di ogni scrittura con le coppie (data, tipologia) modificate, dove la tipologia
+# è quella del campo oppure PISCINA: invalida le risposte in cache e avvisa gli iscritti a quelle date
+def changed(modifiche: Iterable[tuple[date, str]]) -> None:
+    modifiche = list(modifiche)
+    availability.bump(*(data for data, _ in modifiche))
+    broker.publish(modifiche)
+
+
+# orari liberi di un campo, dalla cache delle risposte o dall'indice in memoria
+def campi_liberi(data: date, tipologia: TipologiaCampo) -> list[int]:
+    versione = availability.version(data)
+    liberi = availability.get(data, tipologia.value, versione)
+    if liberi is None:
+        liberi = occupancy.free_hours(data, tipologia.value)
+        availability.set(data, tipologia.value, versione, liberi)
+    return liberi
+
+
+# letture dei contatori della piscina in corso, per (data, versione)
+letture_piscina: dict[tuple[date, int], asyncio.Future] = {}
+
+
+async def leggi_piscina(data: date, versione: int) -> PiscinaLibera:
+    lettini_prenotati, ombrelloni_prenotati = await run_db(capacity.booked, data, read=True)
+
+    liberi = PiscinaLibera(lettini_liberi=max(0, capacity.LETTINI_TOTALI - lettini_prenotati),
+                           ombrelloni_liberi=max(0, capacity.OMBRELLONI_TOTALI - ombrelloni_prenotati))
+    availability.set(data, PISCINA, versione, liberi)
+    return liberi
+
+
+# lettini e ombrelloni liberi, dalla cache delle risposte o dai contatori giornalieri
+async def piscina_libera(data: date) -> PiscinaLibera:
+
+    # verifica che la richiesta non sia per il periodo di chiusura
+    mese, giorno = data.month, data.day
+    inizio = (5, 20)  # 20 maggio
+    fine = (9, 15)  # 15 settembre
+    if not (inizio <= (mese, giorno) <= fine):
+        return PiscinaLibera(lettini_liberi=0, ombrelloni_liberi=0)
+
+    versione = availability.version(data)
+    liberi = availability.get(data, PISCINA, versione)
+    if liberi is not None:
+        return liberi
+
+    # le richieste contemporanee per la stessa versione, come gli iscritti svegliati dalla stessa
+    # prenotazione, attendono un'unica lettura invece di interrogare il database una volta ciascuna
+    chiave = (data, versione)
+    lettura = letture_piscina.get(chiave)
+    if lettura is None:
+        lettura = letture_piscina[chiave] = asyncio.ensure_future(leggi_piscina(data, versione))
+        lettura.add_done_callback(lambda _: letture_piscina.pop(chiave, None))
+    return await asyncio.shield(lettura)
+
+
 @strawberry.type
 class Query:
 
     # mostra gli orari liberi di uno specifico campo in una certa data
     @strawberry.field
     def get_campiliberi(self, data: date, tipologia: TipologiaCampo) -> list[int]:
-        with get_db() as db:
-            prenotazioni = db.query(PrenotazioniCampi.ora).filter(
-                                PrenotazioniCampi.data == data,
-                                PrenotazioniCampi.tipologia == tipologia.value).all()
-            occupate = {p.ora for p in prenotazioni}
+        return campi_liberi(data, tipologia)
 
-        return [ora for ora in range(10, 22) if ora not in occupate]
+    # mostra, per ogni giorno dell'intervallo, gli orari liberi di tutti i campi e i posti liberi in piscina
+    @strawberry.field
+    async def get_calendario(self, dal: Annotated[date, strawberry.argument(name="from")],
+                             al: Annotated[date, strawberry.argument(name="to")]) -> list[GiornoCalendario]:
+        if dal > al:
+            raise Exception("La data iniziale deve precedere quella finale")
+        if (al - dal).days >= MAX_GIORNI_CALENDARIO:
+            raise Exception(f"Intervallo massimo di {MAX_GIORNI_CALENDARIO} giorni")
+
+        # i campi sono letti dall'indice in memoria, la piscina dai contatori giornalieri con una sola query
+        piscina = await run_db(lambda db: db.query(
+            OccupazionePiscina.data, OccupazionePiscina.lettini, OccupazionePiscina.ombrelloni).filter(
+            OccupazionePiscina.data.between(dal, al)).all(), read=True)
+
+        prenotati = {data: (lettini, ombrelloni) for data, lettini, ombrelloni in piscina}
+
+        giorni = []
+        for i in range((al - dal).days + 1):
+            data = dal + timedelta(days=i)
+            aperta = (5, 20) <= (data.month, data.day) <= (9, 15)  # dal 20 maggio al 15 settembre
+            lettini, ombrelloni = prenotati.get(data, (0, 0))
+            giorni.append(GiornoCalendario(
+                data=data,
+                campi=CampiLiberi(beach=occupancy.free_hours(data, TipologiaCampo.beach.value),
+                                  calcio=occupancy.free_hours(data, TipologiaCampo.calcio.value),
+                                  tennis=occupancy.free_hours(data, TipologiaCampo.tennis.value)),
+                piscina_aperta=aperta,
+                lettini_liberi=max(0, capacity.LETTINI_TOTALI - lettini) if aperta else 0,
+                ombrelloni_liberi=max(0, capacity.OMBRELLONI_TOTALI - ombrelloni) if aperta else 0
+            ))
+        return giorni
 
     # mostra il numero di lettini e ombrelloni liberi in una certa data
     @strawberry.field
-    def get_piscinalibera(self, data: date) -> PiscinaLibera:
+    async def get_piscinalibera(self, data: date) -> PiscinaLibera:
+        return await piscina_libera(data)
 
-        # verifica che la richiesta non sia per il periodo di chiusura
-        mese, giorno = data.month, data.day
-        inizio = (5, 20)  # 20 maggio
-        fine = (9, 15)  # 15 settembre
-        if not (inizio <= (mese, giorno) <= fine):
-            return PiscinaLibera(lettini_liberi=0, ombrelloni_liberi=0)
+    # prenotazioni dei membri indicati tra due date (di default da oggi in poi), lette con una query
+    # per tabella qualunque sia il numero di membri; usata da member-service per il campo `prenotazioni`.
+    # Se l'intervallo comprende date già archiviate vengono lette anche le stagioni archiviate
+    @strawberry.field
+    async def prenotazioni_membri(self, cfs: list[str],
+                                  dal: Annotated[date | None, strawberry.argument(name="from")] = None,
+                                  al: Annotated[date | None, strawberry.argument(name="to")] = None
+                                  ) -> list[PrenotazioniMembro]:
+        if len(cfs) > MAX_CF_PRENOTAZIONI:
+            raise Exception(f"At most {MAX_CF_PRENOTAZIONI} CFs per request")
+        richiesti = sorted({cf.upper() for cf in cfs})
+        dal = dal or date.today()
+        al = al or date.max
+        if dal > al:
+            raise Exception("La data iniziale deve precedere quella finale")
+        if dal < archive.cutoff() and min(al, date.today()).year - dal.year >= MAX_STAGIONI_STORICO:
+            raise Exception(f"Al massimo {MAX_STAGIONI_STORICO} stagioni archiviate per richiesta")
+
+        campi, piscina = await run_db(lambda db: archive.history(db, richiesti, dal, al), read=True)
+        prenotazioni = {cf: PrenotazioniMembro(cf=cf, campi=[], piscina=[]) for cf in richiesti}
+        for cf, data, ora, tipologia in campi:
+            prenotazioni[cf].campi.append(PrenotazioneCampo(data=data, ora=ora, tipologia=TipologiaCampo(tipologia)))
+        for cf, data, lettini, ombrelloni in piscina:
+            prenotazioni[cf].piscina.append(PrenotazionePiscina(data=data, lettini=lettini, ombrelloni=ombrelloni))
+        return list(prenotazioni.values())
+
+    # statistiche della cache dei membri, utili per dimensionarla
+    @strawberry.field
+    def member_cache_stats(self) -> CacheStats:
+        return CacheStats(**member_cache.stats())
+
+    # statistiche della cache delle risposte sulla disponibilità
+    @strawberry.field
+    def availability_stats(self) -> AvailabilityStats:
+        return AvailabilityStats(**availability.stats())
 
-        with get_db() as db:
-            prenotazioni = db.query(PrenotazioniPiscina).filter(PrenotazioniPiscina.data == data).all()
-            lettini_prenotati = sum(p.lettini for p in prenotazioni)
-            ombrelloni_prenotati = sum(p.ombrelloni for p in prenotazioni)
+    # stagioni archiviate e stato dell'archiviazione delle prenotazioni passate
+    @strawberry.field
+    def archivio_stats(self) -> ArchivioStats:
+        return ArchivioStats(**archive.stats())
 
-        return PiscinaLibera(lettini_liberi=max(0, 80 - lettini_prenotati),
-                             ombrelloni_liberi=max(0, 20 - ombrelloni_prenotati))
+    # iscrizioni attive agli aggiornamenti della disponibilità
+    @strawberry.field
+    def subscription_stats(self) -> SubscriptionStats:
+        return SubscriptionStats(**broker.stats())
+
+    # verifica che l'indice in memoria dei campi coincida con la tabella
+    @strawberry.field
+    async def verifica_occupazione(self) -> VerificaOccupazione:
+        differenze = await run_db(occupancy.verify, read=True)
+        return VerificaOccupazione(coerente=not differenze,
+                                   differenze=[DifferenzaOccupazione(**d) for d in differenze])
+
+    # stato del circuit breaker e latenze delle chiamate a member-service
+    @strawberry.field
+    def member_service_stats(self) -> ClientStats:
+        return ClientStats(**member_client.stats())
+
+    # query persistite conosciute e utilizzo della cache APQ
+    @strawberry.field
+    def persisted_query_stats(self) -> PersistedQueryStats:
+        return PersistedQueryStats(**persisted.persisted_queries.stats())
 
 
 @strawberry.type
@@ -73,11 +316,11 @@ class Mutation:
 
     # aggiunge la prenotazione di un campo
     @strawberry.mutation
-    def add_campo(self, booking: CampoBookingInput) -> str:
+    async def add_campo(self, booking: CampoBookingInput) -> str:
         cf = booking.cf.upper()
 
         # verifica l'esistenza del membro
-        if not check_member(cf):
+        if not await check_member(cf):
             raise Exception("Member doesn't exist")
 
         # verifica che la data sia successiva a oggi
@@ -88,52 +331,121 @@ class Mutation:
         if booking.ora < 10 or booking.ora > 21:
             raise Exception("I campi possono essere prenotati dalle 10 alle 21")
 
-        with get_db() as db:
-            # verifica se lo slot è impegnato
-            existing = db.query(PrenotazioniCampi).filter_by(
-                data=booking.data,
-                ora=booking.ora,
-                tipologia=booking.tipologia.value).first()
-            if existing:
+        # verifica se lo slot è impegnato, senza interrogare il database
+        if occupancy.is_taken(booking.data, booking.tipologia.value, booking.ora):
+            raise Exception("Slot già prenotato")
+
+        # aggiunge la prenotazione: il vincolo di unicità sullo slot fa fallire l'inserimento
+        # se nel frattempo lo slot è stato prenotato da un'altra richiesta
+        new = insert(PrenotazioniCampi).values(
+            cf=cf,
+            data=booking.data,
+            ora=booking.ora,
+            tipologia=booking.tipologia.value
+        ).on_conflict_do_nothing()
+
+        def inserisci(db: Session) -> int:
+            inserite = db.execute(new).rowcount
+            db.commit()
+            return inserite
+
+        inserite = await run_db(inserisci)
+        occupancy.book(booking.data, booking.tipologia.value, booking.ora)
+        changed([(booking.data, booking.tipologia.value)])
+        if not inserite:
+            raise Exception("Slot già prenotato")
+        return "Booking added"
+
+    # prenota più slot in una volta (più ore consecutive o più campi): i membri vengono verificati una volta sola,
+    # gli slot con una sola query e l'inserimento avviene in un'unica transazione, quindi o tutti o nessuno
+    @strawberry.mutation
+    async def add_campi(self, bookings: list[CampoBookingInput]) -> str:
+        if not bookings:
+            raise Exception("Nessuno slot richiesto")
+        if len(bookings) > MAX_SLOT_PRENOTAZIONE:
+            raise Exception(f"Al massimo {MAX_SLOT_PRENOTAZIONE} slot per richiesta")
+
+        # verifica che le date siano successive a oggi e gli slot validi
+        for booking in bookings:
+            if booking.data <= date.today():
+                raise Exception("La data deve essere successiva ad oggi")
+            if booking.ora < 10 or booking.ora > 21:
+                raise Exception("I campi possono essere prenotati dalle 10 alle 21")
+
+        slots = [(b.data, b.tipologia.value, b.ora) for b in bookings]
+        if len(set(slots)) != len(slots):
+            raise Exception("Slot ripetuto nella richiesta")
+
+        # verifica l'esistenza dei membri
+        esiti = await check_members([b.cf for b in bookings])
+        if not all(esiti.values()):
+            raise Exception("Member doesn't exist")
+
+        # verifica se qualche slot è impegnato: prima sull'indice in memoria, poi con una sola query
+        occupati = [s for s in slots if occupancy.is_taken(*s)]
+        if not occupati:
+            # OR di uguaglianze e non (data, tipologia, ora) IN (VALUES ...): SQLite usa l'indice degli slot
+            # solo nel primo caso, il secondo scorre l'intero indice
+            occupati = await run_db(lambda db: db.query(
+                PrenotazioniCampi.data, PrenotazioniCampi.tipologia, PrenotazioniCampi.ora).filter(
+                or_(*(and_(PrenotazioniCampi.data == data, PrenotazioniCampi.tipologia == tipologia,
+                           PrenotazioniCampi.ora == ora) for data, tipologia, ora in slots))).all())
+            for slot in occupati:
+                occupancy.book(*slot)  # l'indice non era aggiornato
+            changed((data, tipologia) for data, tipologia, _ in occupati)
+        if occupati:
+            dettaglio = ", ".join(f"{data} {tipologia} ore {ora}" for data, tipologia, ora in occupati)
+            raise Exception(f"Slot già prenotato: {dettaglio}")
+
+        # aggiunge tutte le prenotazioni nella stessa transazione
+        def inserisci(db: Session) -> None:
+            try:
+                db.execute(insert(PrenotazioniCampi), [
+                    {"cf": b.cf.upper(), "data": b.data, "ora": b.ora, "tipologia": b.tipologia.value}
+                    for b in bookings])
+                db.commit()
+            except IntegrityError:
+                db.rollback()
                 raise Exception("Slot già prenotato")
 
-            # aggiunge la prenotazione
-            new = PrenotazioniCampi(
-                cf=cf,
-                data=booking.data,
-                ora=booking.ora,
-                tipologia=booking.tipologia.value
-            )
-            db.add(new)
-            db.commit()
-            return "Booking added"
+        await run_db(inserisci)
+
+        for slot in slots:
+            occupancy.book(*slot)
+        changed((data, tipologia) for data, tipologia, _ in slots)
+        return f"{len(bookings)} bookings added"
 
     # rimuove la prenotazione di un campo
     @strawberry.mutation
-    def delete_campo(self, booking: CampoBookingInput) -> str:
-        with get_db() as db:
+    async def delete_campo(self, booking: CampoBookingInput) -> str:
+        def rimuovi(db: Session) -> bool:
             prenotazione = db.query(PrenotazioniCampi).filter_by(
                 cf=booking.cf.upper(),
                 data=booking.data,
                 ora=booking.ora,
                 tipologia=booking.tipologia.value
             ).first()
+            if not prenotazione:
+                return False
+            db.delete(prenotazione)
+            db.commit()
+            return True
 
-            # verifica l'esistenza della prenotazione
-            if prenotazione:
-                db.delete(prenotazione)
-                db.commit()
-                return "Booking deleted"
+        # verifica l'esistenza della prenotazione
+        if await run_db(rimuovi):
+            occupancy.release(booking.data, booking.tipologia.value, booking.ora)
+            changed([(booking.data, booking.tipologia.value)])
+            return "Booking deleted"
 
-            raise Exception("Booking not found")
+        raise Exception("Booking not found")
 
     # aggiunge una prenotazione in piscina
     @strawberry.mutation
-    def add_piscina(self, booking: PiscinaBookingInput) -> str:
+    async def add_piscina(self, booking: PiscinaBookingInput) -> str:
         cf = booking.cf.upper()
 
         # verifica l'esistenza di un membro
-        if not check_member(cf):
+        if not await check_member(cf):
             raise Exception("Member doesn't exist")
 
         # verifica che la data sia successiva a oggi
@@ -147,7 +459,7 @@ class Mutation:
         if not (inizio <= (mese, giorno) <= fine):
             raise Exception("La data deve essere compresa tra il 20 maggio e il 15 settembre")
 
-        with get_db() as db:
+        def prenota(db: Session) -> None:
             # verifica che il membro non abbia già una prenotazione in quella data
             existing = db.query(PrenotazioniPiscina).filter_by(
                 data=booking.data,
@@ -155,18 +467,14 @@ class Mutation:
             if existing:
                 raise Exception(f"{cf} has already a reservation")
 
-            # verifica che ci siano abbastanza lettini disponibili
-            lettini_prenotati = db.query(func.sum(PrenotazioniPiscina.lettini)).filter(
-                                                PrenotazioniPiscina.data == booking.data).scalar() or 0
-            if lettini_prenotati + booking.lettini > 80:
-                lettini_disponibili = 80 - lettini_prenotati
-                raise Exception(f"Only {lettini_disponibili} lettini available on {booking.data}")
-
-            # verifica che ci siano abbastanza ombrelloni disponibili
-            ombrelloni_prenotati = db.query(func.sum(PrenotazioniPiscina.ombrelloni)).filter(
-                                                    PrenotazioniPiscina.data == booking.data).scalar() or 0
-            if ombrelloni_prenotati + booking.ombrelloni > 20:
-                ombrelloni_disponibili = 20 - ombrelloni_prenotati
+            # riserva lettini e ombrelloni solo se ce ne sono abbastanza
+            if not capacity.reserve(db, booking.data, booking.lettini, booking.ombrelloni):
+                db.rollback()
+                lettini_prenotati, ombrelloni_prenotati = capacity.booked(db, booking.data)
+                if lettini_prenotati + booking.lettini > capacity.LETTINI_TOTALI:
+                    lettini_disponibili = capacity.LETTINI_TOTALI - lettini_prenotati
+                    raise Exception(f"Only {lettini_disponibili} lettini available on {booking.data}")
+                ombrelloni_disponibili = capacity.OMBRELLONI_TOTALI - ombrelloni_prenotati
                 raise Exception(f"Only {ombrelloni_disponibili} ombrelloni available on {booking.data}")
 
             # aggiunta della prenotazione
@@ -178,41 +486,185 @@ class Mutation:
             db.add(new)
             db.commit()
 
+        await run_db(prenota)
+        changed([(booking.data, PISCINA)])
         return "Booking added"
 
     # rimuove la prenotazione della piscina di un membro in una certa data
     @strawberry.mutation
-    def delete_piscina(self, cf: str, data: date) -> str:
-        with get_db() as db:
+    async def delete_piscina(self, cf: str, data: date) -> str:
+        def rimuovi(db: Session) -> bool:
             prenotazione = db.query(PrenotazioniPiscina).filter_by(
                     cf=cf.upper(),
                     data=data).first()
 
-            # verifica la prenotazione
-            if prenotazione:
-                db.delete(prenotazione)
-                db.commit()
-                return "Booking deleted"
+            # verifica la prenotazione; la cancellazione e il rilascio dei posti avvengono nella stessa transazione
+            if not prenotazione:
+                return False
+            capacity.release(db, data, prenotazione.lettini, prenotazione.ombrelloni)
+            db.delete(prenotazione)
+            db.commit()
+            return True
 
+        if await run_db(rimuovi):
+            changed([(data, PISCINA)])
+            return "Booking deleted"
         raise Exception("Booking not found")
 
     # rimuove tutte le prenotazioni di un membro dalla data corrente in poi
     @strawberry.mutation
-    def delete_prenotazioni(self, cf: str) -> None:
-        with get_db() as db:
-            db.query(PrenotazioniCampi).filter(PrenotazioniCampi.cf == cf,
-                                                PrenotazioniCampi.data >= date.today()).delete(synchronize_session=False)
-            db.query(PrenotazioniPiscina).filter(PrenotazioniPiscina.cf == cf,
-                                                PrenotazioniPiscina.data >= date.today()).delete(synchronize_session=False)
-            db.commit()
+    async def delete_prenotazioni(self, cf: str) -> None:
+        await run_db(remove_bookings, [cf])
         return
 
+    # rimuove in una sola transazione le prenotazioni di più membri eliminati; usata da member-service
+    # per consegnare le cancellazioni a blocchi, può essere ripetuta senza effetti collaterali
+    @strawberry.mutation
+    async def delete_prenotazioni_batch(self, cfs: list[str],
+                                        cancellati: list[MembroCancellatoInput] | None = None,
+                                        inviato: datetime | None = None) -> int:
+        if len(cfs) > MAX_CF_CANCELLAZIONE:
+            raise Exception(f"At most {MAX_CF_CANCELLAZIONE} CFs per request")
+        return await run_db(remove_bookings, cfs, {m.cf: m.cancellato for m in cancellati or []}, inviato)
+
+    # se l'indice in memoria dei campi non coincide con la tabella lo ricarica; restituisce le differenze trovate
+    @strawberry.mutation
+    async def ripara_occupazione(self) -> VerificaOccupazione:
+        differenze = await run_db(occupancy.verify, read=True)
+        if differenze:
+            await run_db(occupancy.load, read=True)
+            availability.clear()
+        return VerificaOccupazione(coerente=not differenze,
+                                   differenze=[DifferenzaOccupazione(**d) for d in differenze])
+
+
+@strawberry.type
+class Subscription:
+
+    # invia lo stato attuale delle date richieste e poi, a ogni prenotazione o cancellazione che le riguarda,
+    # solo le tipologie modificate; senza tipologie si ricevono tutti i campi, `piscina` include la piscina
+    @strawberry.subscription
+    async def disponibilita(self, giorni: list[date], tipologie: list[TipologiaCampo] | None = None,
+                            piscina: bool = True) -> AsyncGenerator[AggiornamentoDisponibilita, None]:
+        if not giorni:
+            raise Exception("Nessuna data richiesta")
+        if len(set(giorni)) > MAX_GIORNI_ISCRIZIONE:
+            raise Exception(f"Al massimo {MAX_GIORNI_ISCRIZIONE} date per iscrizione")
+
+        campi = {t.value: t for t in (tipologie or list(TipologiaCampo))}
+        tipi = set(campi) | ({PISCINA} if piscina else set())
+
+        async def aggiornamento(data: date, modificati: set[str]) -> AggiornamentoDisponibilita:
+            return AggiornamentoDisponibilita(
+                data=data,
+                campi=[OrariCampo(tipologia=campi[tipo], liberi=campi_liberi(data, campi[tipo]))
+                       for tipo in sorted(modificati & campi.keys())],
+                piscina=await piscina_libera(data) if PISCINA in modificati else None)
+
+        # l'iscrizione precede la lettura dello stato iniziale, così non si perdono modifiche intermedie
+        iscrizione = broker.subscribe(set(giorni), tipi)
+        try:
+            for data in sorted(set(giorni)):
+                yield await aggiornamento(data, tipi)
+            async for modifiche in broker.listen(iscrizione):
+                for data in sorted(modifiche):
+                    yield await aggiornamento(data, modifiche[data])
+        finally:
+            broker.unsubscribe(iscrizione)
+
+
+# in modalità veloce le risposte GraphQL vengono codificate con orjson invece che con il modulo json
+class FastGraphQLRouter(GraphQLRouter):
+
+    def encode_json(self, data: object) -> bytes:
+        return fastjson.dumps(data)
+
 
 app = FastAPI(title="Resource Service - GraphQL")
-schema = strawberry.Schema(query=Query, mutation=Mutation)
-graphql_app = GraphQLRouter(schema)
+app.add_middleware(metrics.MetricsMiddleware)
+# traccia SQL per richiesta, solo con SQL_PROFILE=1
+if profiling.ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
+# pesi dei campi che accedono al database o ad altri servizi; le letture dall'indice in memoria costano 1
+modello_costo = cost.CostModel(
+    weights={
+        "Query.getCalendario": 5,
+        "Query.getPiscinalibera": 2,
+        "Query.prenotazioniMembri": 5,
+        "Query.verificaOccupazione": 50,
+        "Mutation.addCampo": 5,
+        "Mutation.addCampi": 10,
+        "Mutation.deleteCampo": 3,
+        "Mutation.addPiscina": 5,
+        "Mutation.deletePiscina": 3,
+        "Mutation.deletePrenotazioni": 5,
+        "Mutation.deletePrenotazioniBatch": 10,
+        "Mutation.riparaOccupazione": 50,
+        # già caricate insieme al membro con una sola query per tabella
+        "PrenotazioniMembro.campi": 0,
+        "PrenotazioniMembro.piscina": 0,
+    },
+    list_sizes={
+        "Query.getCalendario": lambda a: (a["to"] - a["from"]).days + 1,
+        "Query.prenotazioniMembri": lambda a: len(a["cfs"]),
+        "Subscription.disponibilita": lambda a: len(a["giorni"]),
+    },
+)
+
+# APQ, durata delle operazioni, traccia SQL, cache LRU dei documenti già analizzati e validati, limiti di profondità, alias e costo
+schema = strawberry.Schema(query=Query, mutation=Mutation, subscription=Subscription, extensions=[
+    persisted.PersistedQueryExtension,
+    operation_metrics.OperationMetrics,
+    sql_trace.SQLTrace,
+    lambda: ParserCache(maxsize=DOCUMENT_CACHE_SIZE),
+    lambda: ValidationCache(maxsize=DOCUMENT_CACHE_SIZE),
+    QueryDepthLimiter(max_depth=cost.MAX_DEPTH),
+    MaxAliasesLimiter(max_alias_count=cost.MAX_ALIASES),
+    lambda: cost.CostLimiter(modello_costo, cost.MAX_COST),
+])
+graphql_app = (FastGraphQLRouter if fastjson.FAST else GraphQLRouter)(schema)
 app.include_router(graphql_app, prefix="/graphql")
 
+
+# metriche in formato Prometheus: latenze per route e per operazione GraphQL, statement SQL per richiesta,
+# chiamate agli altri servizi
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# aggiorna lo schema dei database esistenti (vincolo di unicità sugli slot, indici), carica in memoria
+# l'occupazione dei campi, da cui vengono servite le letture, e riallinea i contatori giornalieri della piscina
+@app.on_event("startup")
+def load_occupancy():
+    migrations.migrate(engine)
+    with SessionLocal() as db:
+        occupancy.load(db)
+        capacity.rebuild(db)
+
+
+# le query inviate da member-service sono note: registrandole la prima chiamata non deve inviarne il testo
+@app.on_event("startup")
+def register_queries():
+    persisted.persisted_queries.register(queries.DELETE_PRENOTAZIONI_BATCH, queries.PRENOTAZIONI_MEMBRI)
+
+
+# sposta periodicamente negli archivi stagionali le prenotazioni passate (ARCHIVE_INTERVAL)
+@app.on_event("startup")
+def start_archive():
+    archive.start(SessionLocal, ReadSessionLocal)
+
+
+@app.on_event("shutdown")
+def stop_archive():
+    archive.stop()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await member_client.aclose()
+
+
 if __name__ == "__main__":
     Base.metadata.create_all(bind=engine)
     uvicorn.run("main:app", host="0.0.0.0", port=5000, reload=True)
\ No newline at end of file
@@ -0,0 +1,75 @@
+from threading import Lock
+from datetime import date
+from sqlalchemy.orm import Session
+from model import PrenotazioniCampi
+
+ORE_DISPONIBILI = range(10, 22)
+
+
+# indice in memoria dell'occupazione dei campi: per ogni (data, tipologia) una maschera
+# di 12 bit in cui il bit i indica che l'ora 10 + i è prenotata.
+# L'indice vive nel processo, quindi il servizio deve girare con un solo worker
+class OccupancyIndex:
+
+    def __init__(self):
+        self._masks: dict[tuple[date, str], int] = {}
+        self._lock = Lock()
+
+    # ricostruisce l'indice dalla tabella delle prenotazioni
+    def load(self, db: Session) -> None:
+        masks = self._from_table(db)
+        with self._lock:
+            self._masks = masks
+
+    def is_taken(self, data: date, tipologia: str, ora: int) -> bool:
+        return bool(self._masks.get((data, tipologia), 0) >> (ora - ORE_DISPONIBILI.start) & 1)
+
+    def book(self, data: date, tipologia: str, ora: int) -> None:
+        with self._lock:
+            self._masks[(data, tipologia)] = self._masks.get((data, tipologia), 0) | 1 << (ora - ORE_DISPONIBILI.start)
+
+    def release(self, data: date, tipologia: str, ora: int) -> None:
+        with self._lock:
+            mask = self._masks.get((data, tipologia), 0) & ~(1 << (ora - ORE_DISPONIBILI.start))
+            if mask:
+                self._masks[(data, tipologia)] = mask
+            else:
+                self._masks.pop((data, tipologia), None)
+
+    def free_hours(self, data: date, tipologia: str) -> list[int]:
+        mask = self._masks.get((data, tipologia), 0)
+        return [ora for ora in ORE_DISPONIBILI if not mask >> (ora - ORE_DISPONIBILI.start) & 1]
+
+    # confronta l'indice con la tabella e restituisce le differenze trovate
+    def verify(self, db: Session) -> list[dict]:
+        tabella = self._from_table(db)
+        with self._lock:
+            indice = dict(self._masks)
+
+        differenze = []
+        for data, tipologia in sorted(indice.keys() | tabella.keys()):
+            in_indice = indice.get((data, tipologia), 0)
+            in_tabella = tabella.get((data, tipologia), 0)
+            if in_indice != in_tabella:
+                differenze.append({
+                    "data": data,
+                    "tipologia": tipologia,
+                    "indice": self._hours(in_indice),
+                    "tabella": self._hours(in_tabella),
+                })
+        return differenze
+
+    @staticmethod
+    def _from_table(db: Session) -> dict[tuple[date, str], int]:
+        masks = {}
+        righe = db.query(PrenotazioniCampi.data, PrenotazioniCampi.tipologia, PrenotazioniCampi.ora).all()
+        for data, tipologia, ora in righe:
+            masks[(data, tipologia)] = masks.get((data, tipologia), 0) | 1 << (ora - ORE_DISPONIBILI.start)
+        return masks
+
+    @staticmethod
+    def _hours(mask: int) -> list[int]:
+        return [ora for ora in ORE_DISPONIBILI if mask >> (ora - ORE_DISPONIBILI.start) & 1]
+
+
+occupancy = OccupancyIndex()
@@ -0,0 +1,46 @@
+from time import perf_counter
+from typing import Iterator
+from graphql import FieldNode
+from graphql.utilities import get_operation_ast
+from strawberry.extensions import SchemaExtension
+from metrics import registry
+
+MAX_CAMPI_ETICHETTA = 3
+
+OPERATIONS = registry.histogram("graphql_operation_duration_seconds", "Durata delle operazioni GraphQL",
+                                ("type", "operation"))
+ERRORS = registry.counter("graphql_operation_errors_total", "Operazioni GraphQL terminate con errori",
+                          ("type", "operation"))
+
+
+# nome dell'operazione nelle metriche: i campi di primo livello richiesti, non il nome scelto dal client,
+# così il numero di etichette dipende solo dallo schema. I documenti non validi finiscono tutti
+# sotto "invalid", altrimenti ogni campo inesistente diventerebbe una nuova etichetta
+def _operation(context) -> tuple[str, str]:
+    document = context.graphql_document
+    operation = get_operation_ast(document, context.operation_name) if document is not None else None
+    if operation is None or context.pre_execution_errors:
+        return "unknown", "invalid"
+    campi = sorted({s.name.value for s in operation.selection_set.selections if isinstance(s, FieldNode)})
+    if not campi or len(campi) > MAX_CAMPI_ETICHETTA:
+        return operation.operation.value, "multiple"
+    return operation.operation.value, ",".join(campi)
+
+
+# durata ed errori di ogni operazione GraphQL, compresi analisi e validazione del documento.
+# Va dopo PersistedQueryExtension: strawberry non chiude gli hook già aperti se uno dei successivi
+# solleva un'eccezione entrando, e le query persistite non trovate sono già contate dalle metriche HTTP
+class OperationMetrics(SchemaExtension):
+
+    def on_operation(self) -> Iterator[None]:
+        inizio = perf_counter()
+        errore = True
+        try:
+            yield
+            errore = False
+        finally:
+            context = self.execution_context
+            labels = _operation(context)
+            OPERATIONS.observe(perf_counter() - inizio, labels)
+            if errore or context.pre_execution_errors or (context.result is not None and context.result.errors):
+                ERRORS.inc(labels)
@@ -0,0 +1,83 @@
+from datetime import date
+from typing import AsyncIterator, Iterable
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+PISCINA = "piscina"
+
+
+# iscrizione di un client agli aggiornamenti di alcune date e tipologie (campi o piscina).
+# Non ha una coda: le modifiche arrivate mentre il client è occupato vengono unite in `pending`,
+# così un client lento riceve un solo aggiornamento con lo stato più recente
+class Iscrizione:
+
+    def __init__(self, giorni: set[date], tipi: set[str]):
+        self.giorni = giorni
+        self.tipi = tipi
+        self.pending: dict[date, set[str]] = {}
+        self.evento = asyncio.Event()
+
+
+# pub/sub in memoria sull'event loop del servizio: gli iscritti sono indicizzati per data, quindi
+# una prenotazione raggiunge solo chi segue quella data; ogni iscrizione costa un Event e nessun thread.
+# publish può essere chiamata da qualsiasi thread (anche dal threadpool del database): la consegna
+# avviene sempre sull'event loop. Come l'indice dell'occupazione vive nel processo, quindi un solo worker
+class Broker:
+
+    def __init__(self):
+        self.pubblicati = 0
+        self.consegnati = 0
+        self._iscritti: dict[date, set[Iscrizione]] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def subscribe(self, giorni: set[date], tipi: set[str]) -> Iscrizione:
+        self._loop = asyncio.get_running_loop()
+        iscrizione = Iscrizione(giorni, tipi)
+        for data in giorni:
+            self._iscritti.setdefault(data, set()).add(iscrizione)
+        return iscrizione
+
+    def unsubscribe(self, iscrizione: Iscrizione) -> None:
+        for data in iscrizione.giorni:
+            iscritti = self._iscritti.get(data)
+            if iscritti is not None:
+                iscritti.discard(iscrizione)
+                if not iscritti:
+                    del self._iscritti[data]
+
+    # segnala le coppie (data, tipologia) modificate da una scrittura già confermata
+    def publish(self, modifiche: Iterable[tuple[date, str]]) -> None:
+        if not self._iscritti or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch, list(modifiche))
+        except RuntimeError:
+            logger.debug("Event loop chiuso, aggiornamenti non consegnati")
+
+    def _dispatch(self, modifiche: list[tuple[date, str]]) -> None:
+        self.pubblicati += 1
+        for data, tipo in modifiche:
+            for iscrizione in self._iscritti.get(data, ()):
+                if tipo in iscrizione.tipi:
+                    iscrizione.pending.setdefault(data, set()).add(tipo)
+                    iscrizione.evento.set()
+
+    # attende le modifiche per l'iscrizione e le restituisce raggruppate per data
+    async def listen(self, iscrizione: Iscrizione) -> AsyncIterator[dict[date, set[str]]]:
+        while True:
+            await iscrizione.evento.wait()
+            iscrizione.evento.clear()
+            modifiche, iscrizione.pending = iscrizione.pending, {}
+            if modifiche:
+                self.consegnati += 1
+                yield modifiche
+
+    def stats(self) -> dict:
+        iscrizioni = {i for iscritti in self._iscritti.values() for i in iscritti}
+        return {"iscrizioni": len(iscrizioni), "giorni": len(self._iscritti),
+                "pubblicati": self.pubblicati, "consegnati": self.consegnati}
+
+
+broker = Broker()
@@ -1,6 +1,6 @@
 import strawberry
 import enum
-from datetime import date
+from datetime import date, datetime
 
 
 @strawberry.enum
@@ -26,8 +26,145 @@ class PiscinaBookingInput:
     ombrelloni: int
 
 
+# membro eliminato da member-service e già registrato di nuovo, con l'istante dell'eliminazione
+@strawberry.input
+class MembroCancellatoInput:
+    cf: str
+    cancellato: datetime
+
+
 @strawberry.type
 class PiscinaLibera:
     lettini_liberi: int
     ombrelloni_liberi: int
 
+
+@strawberry.type
+class OrariCampo:
+    tipologia: TipologiaCampo
+    liberi: list[int]
+
+
+# stato di una data dopo una modifica: solo le tipologie modificate, piscina null se non è cambiata
+@strawberry.type
+class AggiornamentoDisponibilita:
+    data: date
+    campi: list[OrariCampo]
+    piscina: PiscinaLibera | None
+
+
+# orari liberi di ogni tipologia di campo
+@strawberry.type
+class CampiLiberi:
+    beach: list[int]
+    calcio: list[int]
+    tennis: list[int]
+
+
+@strawberry.type
+class GiornoCalendario:
+    data: date
+    campi: CampiLiberi
+    piscina_aperta: bool
+    lettini_liberi: int
+    ombrelloni_liberi: int
+
+
+@strawberry.type
+class PrenotazioneCampo:
+    data: date
+    ora: int
+    tipologia: TipologiaCampo
+
+
+@strawberry.type
+class PrenotazionePiscina:
+    data: date
+    lettini: int
+    ombrelloni: int
+
+
+# prenotazioni di un membro, restituite in blocco a member-service
+@strawberry.type
+class PrenotazioniMembro:
+    cf: str
+    campi: list[PrenotazioneCampo]
+    piscina: list[PrenotazionePiscina]
+
+
+@strawberry.type
+class DifferenzaOccupazione:
+    data: date
+    tipologia: str
+    indice: list[int]   # ore occupate secondo l'indice in memoria
+    tabella: list[int]  # ore occupate secondo il database
+
+
+@strawberry.type
+class VerificaOccupazione:
+    coerente: bool
+    differenze: list[DifferenzaOccupazione]
+
+
+@strawberry.type
+class CacheStats:
+    size: int
+    maxsize: int
+    ttl: float
+    negative_ttl: float
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+@strawberry.type
+class AvailabilityStats:
+    size: int
+    maxsize: int
+    versioned_dates: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+@strawberry.type
+class ArchivioStats:
+    stagioni: list[int]
+    limite: date  # le prenotazioni precedenti vengono archiviate
+    archiviate_campi: int
+    archiviate_piscina: int
+    ultima_esecuzione: datetime | None
+    ultimo_errore: str | None
+
+
+@strawberry.type
+class PersistedQueryStats:
+    size: int
+    maxsize: int
+    registered: int
+    hits: int
+    misses: int
+    hit_ratio: float
+
+
+@strawberry.type
+class ClientStats:
+    url: str
+    state: str
+    consecutive_failures: int
+    requests: int
+    errors: int
+    retries: int
+    short_circuited: int
+    avg_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+@strawberry.type
+class SubscriptionStats:
+    iscrizioni: int
+    giorni: int
+    pubblicati: int
+    consegnati: int
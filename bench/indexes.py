@@ -0,0 +1,228 @@
+# Confronta gli indici delle tabelle delle prenotazioni prima e dopo la migrazione 2 di migrations.py
+# (indici a colonna singola su ogni campo contro indici composti sulle query del servizio).
+# Crea un database con --rows prenotazioni per tabella e gli indici del vecchio modello, ne fa una copia
+# e la aggiorna sul posto con migrations.migrate; su entrambi misura il costo degli inserimenti (una
+# transazione per prenotazione come il servizio, e a blocchi come addCampi), quello delle ricerche
+# con le forme di query di main.py, la dimensione del file e il piano scelto da SQLite.
+#
+#   python bench/indexes.py --rows 1000000 --inserts 5000 --lookups 5000
+
+from datetime import date, timedelta
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "DEP", "resource-service", "app"))
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from model import PrenotazioniCampi, PrenotazioniPiscina  # noqa: E402
+from storage import StorageConfig, create_engines  # noqa: E402
+import migrations  # noqa: E402
+
+TIPOLOGIE = ("tennis", "beach", "calcio")
+ORE = range(10, 22)
+SLOT_AL_GIORNO = len(TIPOLOGIE) * len(ORE)
+PISCINA_AL_GIORNO = 40
+OGGI = date.today()
+# le prenotazioni occupano i giorni che terminano 90 giorni dopo oggi, quasi tutti nel passato come in
+# un database mai archiviato; gli inserimenti misurati usano i giorni successivi
+FINE = OGGI + timedelta(days=90)
+SECONDI_PER_RICERCA = 10
+
+# schema del modello prima della migrazione: indice su ogni colonna, chiave primaria compresa
+SCHEMA_ORIGINALE = """
+CREATE TABLE "PrenotazioniCampi" (id INTEGER NOT NULL, cf VARCHAR(16) NOT NULL, data DATE NOT NULL,
+    ora INTEGER NOT NULL, tipologia VARCHAR(50) NOT NULL, PRIMARY KEY (id));
+CREATE TABLE "PrenotazioniPiscina" (id INTEGER NOT NULL, cf VARCHAR(16) NOT NULL, data DATE NOT NULL,
+    lettini INTEGER NOT NULL, ombrelloni INTEGER NOT NULL, PRIMARY KEY (id));
+CREATE TABLE "OccupazionePiscina" (data DATE NOT NULL, lettini INTEGER NOT NULL, ombrelloni INTEGER NOT NULL,
+    PRIMARY KEY (data), CHECK (lettini BETWEEN 0 AND 80), CHECK (ombrelloni BETWEEN 0 AND 20));
+"""
+INDICI_ORIGINALI = """
+CREATE INDEX "ix_PrenotazioniCampi_id" ON "PrenotazioniCampi" (id);
+CREATE INDEX "ix_PrenotazioniCampi_cf" ON "PrenotazioniCampi" (cf);
+CREATE INDEX "ix_PrenotazioniCampi_data" ON "PrenotazioniCampi" (data);
+CREATE INDEX "ix_PrenotazioniCampi_ora" ON "PrenotazioniCampi" (ora);
+CREATE INDEX "ix_PrenotazioniCampi_tipologia" ON "PrenotazioniCampi" (tipologia);
+CREATE UNIQUE INDEX "ux_PrenotazioniCampi_slot" ON "PrenotazioniCampi" (data, tipologia, ora);
+CREATE INDEX "ix_PrenotazioniPiscina_id" ON "PrenotazioniPiscina" (id);
+CREATE INDEX "ix_PrenotazioniPiscina_cf" ON "PrenotazioniPiscina" (cf);
+CREATE INDEX "ix_PrenotazioniPiscina_data" ON "PrenotazioniPiscina" (data);
+CREATE INDEX "ix_PrenotazioniPiscina_lettini" ON "PrenotazioniPiscina" (lettini);
+CREATE INDEX "ix_PrenotazioniPiscina_ombrelloni" ON "PrenotazioniPiscina" (ombrelloni);
+PRAGMA user_version = 1;
+"""
+
+# forme delle query di main.py, con i parametri generati da parametri()
+RICERCHE = {
+    # delete_campo
+    "campo_slot_cf": 'SELECT id FROM "PrenotazioniCampi" WHERE cf = ? AND data = ? AND ora = ? AND tipologia = ?',
+    # addCampi: slot già occupati, con la forma precedente (tuple_ IN) e con quella attuale (OR di uguaglianze)
+    "campi_slot_values": 'SELECT data, tipologia, ora FROM "PrenotazioniCampi" '
+                         'WHERE (data, tipologia, ora) IN (VALUES (?, ?, ?), (?, ?, ?), (?, ?, ?))',
+    "campi_slot_or": 'SELECT data, tipologia, ora FROM "PrenotazioniCampi" '
+                     'WHERE (data = ? AND tipologia = ? AND ora = ?) OR (data = ? AND tipologia = ? AND ora = ?) '
+                     'OR (data = ? AND tipologia = ? AND ora = ?)',
+    # prenotazioniMembri e cancellazioni a cascata
+    "campi_membri_futuro": 'SELECT data, tipologia, ora FROM "PrenotazioniCampi" '
+                           'WHERE cf IN (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) AND data >= ?',
+    # add_piscina (prenotazione già presente) e delete_piscina
+    "piscina_cf_data": 'SELECT id, lettini, ombrelloni FROM "PrenotazioniPiscina" WHERE data = ? AND cf = ?',
+    "piscina_membri_futuro": 'SELECT data, lettini, ombrelloni FROM "PrenotazioniPiscina" '
+                             'WHERE cf IN (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) AND data >= ?',
+}
+
+
+def cf(i: int) -> str:
+    return f"BNC{i:013d}"
+
+
+def giorno(i: int) -> date:
+    return FINE - timedelta(days=i)
+
+
+# popola il database con lo schema e gli indici originali; gli indici vengono creati dopo il caricamento,
+# che altrimenti richiederebbe molto più tempo senza cambiare il risultato
+def seed(path: str, righe: int, membri: int) -> None:
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA_ORIGINALE)
+    campi = ((cf(random.randrange(membri)), giorno(i // SLOT_AL_GIORNO).isoformat(),
+              ORE[i % len(ORE)], TIPOLOGIE[i // len(ORE) % len(TIPOLOGIE)]) for i in range(righe))
+    conn.executemany('INSERT INTO "PrenotazioniCampi" (cf, data, ora, tipologia) VALUES (?, ?, ?, ?)', campi)
+    piscina = ((cf(random.randrange(membri)), giorno(i // PISCINA_AL_GIORNO).isoformat(),
+                random.randint(1, 2), random.randint(0, 1)) for i in range(righe))
+    conn.executemany('INSERT INTO "PrenotazioniPiscina" (cf, data, lettini, ombrelloni) VALUES (?, ?, ?, ?)',
+                     piscina)
+    conn.commit()
+    conn.executescript(INDICI_ORIGINALI)
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def parametri(nome: str, righe: int, membri: int) -> tuple:
+    cfs = tuple(cf(random.randrange(membri)) for _ in range(10))
+    if nome in ("campi_membri_futuro", "piscina_membri_futuro"):
+        return cfs + (OGGI.isoformat(),)
+    if nome in ("campi_slot_values", "campi_slot_or"):
+        return tuple(v for _ in range(3) for v in (giorno(random.randrange(righe // SLOT_AL_GIORNO)).isoformat(),
+                                                   random.choice(TIPOLOGIE), random.choice(ORE)))
+    if nome == "campo_slot_cf":
+        return (cfs[0], giorno(random.randrange(righe // SLOT_AL_GIORNO)).isoformat(),
+                random.choice(ORE), random.choice(TIPOLOGIE))
+    return giorno(random.randrange(righe // PISCINA_AL_GIORNO)).isoformat(), cfs[0]
+
+
+def lookups(path: str, quante: int, righe: int, membri: int) -> dict:
+    conn = sqlite3.connect(path)
+    risultati = {}
+    for nome, sql in RICERCHE.items():
+        piano = [r[-1] for r in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parametri(nome, righe, membri))]
+        argomenti = [parametri(nome, righe, membri) for _ in range(quante)]
+        eseguite = 0
+        inizio = time.perf_counter()
+        # le forme che scorrono l'intera tabella si fermano dopo SECONDI_PER_RICERCA
+        for a in argomenti:
+            conn.execute(sql, a).fetchall()
+            eseguite += 1
+            if time.perf_counter() - inizio > SECONDI_PER_RICERCA:
+                break
+        risultati[nome] = {"us": round((time.perf_counter() - inizio) / eseguite * 1e6, 1), "runs": eseguite,
+                           "plan": piano}
+    conn.close()
+    return risultati
+
+
+# inserimenti con l'ORM e i pragma del servizio (WAL, synchronous NORMAL), su giorni ancora liberi
+def inserts(path: str, quanti: int, membri: int) -> dict:
+    writer, reader = create_engines(path, StorageConfig.from_env())
+    Session = sessionmaker(bind=writer)
+    slot = [(FINE + timedelta(days=1 + i // SLOT_AL_GIORNO), ORE[i % len(ORE)],
+             TIPOLOGIE[i // len(ORE) % len(TIPOLOGIE)]) for i in range(2 * quanti)]
+
+    inizio = time.perf_counter()
+    for data, ora, tipologia in slot[:quanti]:
+        with Session() as db:
+            db.add(PrenotazioniCampi(cf=cf(random.randrange(membri)), data=data, ora=ora, tipologia=tipologia))
+            db.add(PrenotazioniPiscina(cf=cf(random.randrange(membri)), data=data, lettini=1, ombrelloni=0))
+            db.commit()
+    singole = time.perf_counter() - inizio
+
+    inizio = time.perf_counter()
+    with Session() as db:
+        for blocco in range(quanti, 2 * quanti, 36):
+            db.add_all(PrenotazioniCampi(cf=cf(random.randrange(membri)), data=data, ora=ora, tipologia=tipologia)
+                       for data, ora, tipologia in slot[blocco:blocco + 36])
+            db.commit()
+    blocchi = time.perf_counter() - inizio
+
+    writer.dispose()
+    reader.dispose()
+    return {
+        # una prenotazione per campo e una per la piscina per transazione
+        "us_per_transaction": round(singole / quanti * 1e6, 1),
+        "us_per_row_batch_36": round(blocchi / quanti * 1e6, 1),
+    }
+
+
+def indici(path: str) -> list[str]:
+    conn = sqlite3.connect(path)
+    nomi = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+    conn.close()
+    return nomi
+
+
+def misura(path: str, args) -> dict:
+    return {
+        "indexes": indici(path),
+        "size_mb": round(os.path.getsize(path) / 2 ** 20, 1),
+        "lookups": lookups(path, args.lookups, args.rows, args.members),
+        "inserts": inserts(path, args.inserts, args.members),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000, help="prenotazioni per tabella")
+    parser.add_argument("--members", type=int, default=20_000)
+    parser.add_argument("--inserts", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=5000, help="esecuzioni di ogni forma di query")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    cartella = tempfile.mkdtemp()
+    prima = os.path.join(cartella, "prima.db")
+    dopo = os.path.join(cartella, "dopo.db")
+    try:
+        seed(prima, args.rows, args.members)
+        shutil.copyfile(prima, dopo)
+
+        writer, reader = create_engines(dopo, StorageConfig.from_env())
+        inizio = time.perf_counter()
+        versione = migrations.migrate(writer)
+        durata_migrazione = time.perf_counter() - inizio
+        with writer.connect() as conn:
+            conn.exec_driver_sql("VACUUM")
+        writer.dispose()
+        reader.dispose()
+
+        random.seed(args.seed)
+        risultati = {"params": vars(args), "before": misura(prima, args)}
+        random.seed(args.seed)
+        risultati["after"] = misura(dopo, args)
+        risultati["migration"] = {"version": versione, "seconds": round(durata_migrazione, 2)}
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+
+    print(json.dumps(risultati, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(risultati, f, indent=2)
@@ -0,0 +1,131 @@
+# Confronta resource-service (REST) in modalità sync e async (SERVICE_MODE) sotto carico concorrente.
+# member-service è sostituito da un servizio fittizio che risponde con una latenza configurabile, così
+# le prenotazioni restano in attesa di rete come in produzione; le letture della piscina attendono il database.
+#
+#   python bench/modes.py --concurrency 200 --seconds 10 --latency 0.05
+
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+APP = os.path.join(os.path.dirname(__file__), "..", "DEP", "resource-service", "app")
+GIORNI = [date(2031, 6, 1) + timedelta(days=i) for i in range(90)]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# member-service fittizio: ogni codice fiscale esiste, dopo `latency` secondi
+def fake_member_service(latency: float) -> str:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            corpo = json.dumps({"cf": self.path.rsplit("/", 1)[-1]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_service(mode: str, member_url: str, cartella: str) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = dict(os.environ, SERVICE_MODE=mode, MEMBER_SERVICE_URL=member_url,
+               DB_PATH=os.path.join(cartella, "resources.db"),
+               MEMBER_CACHE_SIZE="0",  # ogni prenotazione interroga member-service
+               PEER_POOL_SIZE="1000", PEER_READ_TIMEOUT="30", PEER_DEADLINE="60")
+    processo = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                                 "--log-level", "warning"], cwd=APP, env=env)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            httpx.get(url + "/docs", timeout=0.2)
+            break
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    return processo, url
+
+
+async def load(url: str, concurrency: int, seconds: float, writes: float) -> dict:
+    latenze = []
+    errori = 0
+    fine = time.monotonic() + seconds
+    sequenza = iter(range(10 ** 9))
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errori
+        while time.monotonic() < fine:
+            inizio = time.monotonic()
+            if random.random() < writes:
+                response = await client.post("/resources/piscina", json={
+                    "cf": f"{next(sequenza):016d}", "data": random.choice(GIORNI).isoformat(),
+                    "lettini": 0, "ombrelloni": 0})
+            else:
+                response = await client.get(f"/resources/piscinalibera/{random.choice(GIORNI).isoformat()}")
+            if response.status_code >= 500:
+                errori += 1
+            latenze.append(time.monotonic() - inizio)
+
+    limiti = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limiti, timeout=60) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+
+    latenze.sort()
+    return {
+        "richieste": len(latenze),
+        "errori": errori,
+        "richieste_al_secondo": round(len(latenze) / seconds, 1),
+        "p50_ms": round(latenze[len(latenze) // 2] * 1000, 1) if latenze else 0.0,
+        "p99_ms": round(latenze[int(len(latenze) * 0.99)] * 1000, 1) if latenze else 0.0,
+    }
+
+
+def run(mode: str, args) -> dict:
+    cartella = tempfile.mkdtemp()
+    processo, url = start_service(mode, fake_member_service(args.latency), cartella)
+    try:
+        return asyncio.run(load(url, args.concurrency, args.seconds, args.writes))
+    finally:
+        processo.terminate()
+        processo.wait()
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=200, help="richieste contemporanee")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="latenza di member-service in secondi")
+    parser.add_argument("--writes", type=float, default=0.5, help="frazione di prenotazioni")
+    args = parser.parse_args()
+
+    print(json.dumps({mode: run(mode, args) for mode in ("sync", "async")}, indent=2))
@@ -0,0 +1,158 @@
+# Confronta la serializzazione dell'elenco completo dei membri nelle due modalità di risposta (RESPONSE_MODE):
+# "model", che crea gli oggetti dell'ORM e li valida e serializza uno per uno (MemberOut nel servizio REST,
+# MemberType e json nel servizio GraphQL), e "fast", che codifica direttamente le tuple lette dal database
+# con orjson. Per ogni numero di membri popola un database, avvia member-service in entrambe le modalità
+# sulla stessa copia e misura le richieste una alla volta, dopo una richiesta di riscaldamento;
+# verifica anche che le due modalità restituiscano gli stessi membri.
+#
+#   python bench/serialization.py --members 10000 100000 --repeat 10
+#   python bench/serialization.py --stacks graphql --members 100000 --output serializzazione.json
+
+from datetime import date, timedelta
+import argparse
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APPS = {
+    "rest": os.path.join(ROOT, "DEP", "member-service", "app"),
+    "graphql": os.path.join(ROOT, "DEPgraphql", "member-service", "app"),
+}
+MODALITA = ("model", "fast")
+QUERY_GRAPHQL = "{ allMembers { cf name surname registrationDate } }"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# crea le tabelle con il modello del servizio e inserisce n membri direttamente con sqlite3
+def seed(app: str, path: str, n: int) -> None:
+    env = dict(os.environ, DB_PATH=path)
+    subprocess.run([sys.executable, "-c", "from db import engine; from model import Base; "
+                    "Base.metadata.create_all(bind=engine)"], cwd=app, env=env, check=True)
+    inizio = date(2020, 1, 1)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO members (cf, name, surname, registration_date) VALUES (?, ?, ?, ?)", (
+            (f"BNC{i:013d}", f"Nome{i % 997}", f"Cognome{i % 991}", (inizio + timedelta(days=i % 2000)).isoformat())
+            for i in range(n)))
+    # il database è in WAL: chiudendo l'ultima connessione le righe passano nel file, che viene poi copiato
+    conn.close()
+
+
+def start_service(app: str, path: str, modalita: str) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = dict(os.environ, DB_PATH=path, RESPONSE_MODE=modalita, SQL_PROFILE="0")
+    processo = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                                 "--log-level", "warning"], cwd=app, env=env)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            httpx.get(url + "/docs", timeout=0.2)
+            break
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    return processo, url
+
+
+# richiede l'elenco completo e restituisce la durata, la dimensione del corpo e i membri ricevuti
+def richiesta(client: httpx.Client, stack: str) -> tuple[float, int, list]:
+    inizio = time.perf_counter()
+    if stack == "rest":
+        response = client.get("/members")
+    else:
+        response = client.post("/graphql", json={"query": QUERY_GRAPHQL})
+    durata = time.perf_counter() - inizio
+    response.raise_for_status()
+    dati = response.json()
+    if stack == "graphql":
+        if dati.get("errors"):
+            raise RuntimeError(f"Errore GraphQL: {dati['errors']}")
+        dati = dati["data"]["allMembers"]
+    return durata, len(response.content), dati
+
+
+def misura(stack: str, n: int, repeat: int, cartella: str) -> list[dict]:
+    app = APPS[stack]
+    originale = os.path.join(cartella, f"{stack}-{n}.db")
+    seed(app, originale, n)
+
+    risultati, membri = [], {}
+    for modalita in MODALITA:
+        # ogni modalità parte dalla stessa copia del database
+        path = os.path.join(cartella, f"{stack}-{n}-{modalita}.db")
+        shutil.copyfile(originale, path)
+        processo, url = start_service(app, path, modalita)
+        try:
+            with httpx.Client(base_url=url, timeout=300) as client:
+                _, dimensione, membri[modalita] = richiesta(client, stack)
+                durate = [richiesta(client, stack)[0] for _ in range(repeat)]
+        finally:
+            processo.terminate()
+            processo.wait()
+        if len(membri[modalita]) != n:
+            raise RuntimeError(f"{stack} {modalita}: attesi {n} membri, ricevuti {len(membri[modalita])}")
+        risultati.append({
+            "stack": stack,
+            "membri": n,
+            "modalita": modalita,
+            "p50_ms": round(statistics.median(durate) * 1000, 1),
+            "min_ms": round(min(durate) * 1000, 1),
+            "max_ms": round(max(durate) * 1000, 1),
+            "kb": round(dimensione / 1024, 1),
+        })
+
+    if membri["model"] != membri["fast"]:
+        raise RuntimeError(f"{stack} con {n} membri: le due modalità restituiscono membri diversi")
+    risultati[-1]["speedup"] = round(risultati[0]["p50_ms"] / risultati[-1]["p50_ms"], 2)
+    return risultati
+
+
+def tabella(risultati: list[dict]) -> str:
+    righe = [f"{'stack':8} {'membri':>8} {'modalità':8} {'p50 ms':>9} {'min ms':>9} {'max ms':>9} {'KB':>9} "
+             f"{'speedup':>8}"]
+    for r in risultati:
+        speedup = f"{r['speedup']:.2f}x" if "speedup" in r else ""
+        righe.append(f"{r['stack']:8} {r['membri']:>8} {r['modalita']:8} {r['p50_ms']:>9} {r['min_ms']:>9} "
+                     f"{r['max_ms']:>9} {r['kb']:>9} {speedup:>8}")
+    return "\n".join(righe)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stacks", nargs="+", choices=list(APPS), default=list(APPS))
+    parser.add_argument("--members", nargs="+", type=int, default=[10000, 100000], help="dimensioni dell'elenco")
+    parser.add_argument("--repeat", type=int, default=5, help="richieste misurate per modalità")
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    args = parser.parse_args()
+
+    cartella = tempfile.mkdtemp(prefix="bench-serialization-")
+    try:
+        risultati = []
+        for stack in args.stacks:
+            for n in args.members:
+                print(f"{stack}: {n} membri...", file=sys.stderr, flush=True)
+                risultati += misura(stack, n, args.repeat, cartella)
+        print(tabella(risultati))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(risultati, f, indent=2)
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# Confronta sotto lo stesso carico lo stack REST (DEP) e quello GraphQL (DEPgraphql).
+# Per ogni stack avvia member-service e resource-service in locale, collegati tra loro al posto dei nomi
+# della rete docker, li popola con un insieme di dati sintetico e li interroga con un mix di operazioni:
+# ricerche di membri, interrogazioni periodiche della disponibilità e prenotazioni. A intervalli regolari
+# il mix passa alle raffiche di prenotazioni (--burst-every, --burst-seconds, --burst-mix).
+# Per ogni operazione riporta throughput, latenze p50/p95/p99 e tassi di errore, come JSON e come tabella;
+# i conflitti (slot già prenotato, posti esauriti) sono esiti attesi e sono contati a parte.
+#
+#   python bench/stacks.py --concurrency 50 --seconds 20 --members 5000 --output risultati.json
+#   python bench/stacks.py --stacks graphql --mode async --mix lookup=1,campi=4,piscina=4,booking=1
+
+from datetime import date, datetime, timedelta
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+STACKS = {
+    "rest": (os.path.join(ROOT, "DEP", "member-service", "app"),
+             os.path.join(ROOT, "DEP", "resource-service", "app")),
+    "graphql": (os.path.join(ROOT, "DEPgraphql", "member-service", "app"),
+                os.path.join(ROOT, "DEPgraphql", "resource-service", "app")),
+}
+OPERAZIONI = ("lookup", "campi", "piscina", "booking")
+TIPOLOGIE = ("tennis", "beach", "calcio")
+GIORNI = [date(date.today().year + 1, 6, 1) + timedelta(days=i) for i in range(30)]
+SLOT_PER_PRENOTAZIONE = 3
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cf(i: int) -> str:
+    return f"BNC{i:013d}"
+
+
+def parse_mix(testo: str) -> dict[str, float]:
+    mix = {}
+    for parte in testo.split(","):
+        nome, peso = parte.split("=")
+        if nome not in OPERAZIONI:
+            raise argparse.ArgumentTypeError(f"operazione sconosciuta: {nome}")
+        mix[nome] = float(peso)
+    return mix
+
+
+# avvia i due servizi di uno stack su porte locali, ognuno configurato con l'indirizzo dell'altro
+def start_stack(stack: str, mode: str, cartella: str, verbose: bool = False) -> tuple[list[subprocess.Popen], str, str]:
+    member_app, resource_app = STACKS[stack]
+    member_port, resource_port = free_port(), free_port()
+    member_url, resource_url = f"http://127.0.0.1:{member_port}", f"http://127.0.0.1:{resource_port}"
+    comune = dict(os.environ, SERVICE_MODE=mode, MEMBER_SERVICE_URL=member_url, RESOURCE_SERVICE_URL=resource_url,
+                  OUTBOX_POLL_INTERVAL="1")
+
+    # i servizi GraphQL registrano ogni errore applicativo (anche i conflitti attesi) con il traceback
+    output = None if verbose else subprocess.DEVNULL
+    processi = []
+    for app, porta, db in ((member_app, member_port, "members.db"), (resource_app, resource_port, "resources.db")):
+        env = dict(comune, DB_PATH=os.path.join(cartella, db))
+        # i servizi GraphQL creano le tabelle solo se avviati con python main.py
+        subprocess.run([sys.executable, "-c", "from db import engine; from model import Base; "
+                        "Base.metadata.create_all(bind=engine)"], cwd=app, env=env, check=True)
+        processi.append(subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(porta),
+                                          "--log-level", "warning"], cwd=app, env=env, stdout=output, stderr=output))
+
+    for url in (member_url, resource_url):
+        for _ in range(200):
+            try:
+                httpx.get(url + "/docs", timeout=0.2)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.1)
+    return processi, member_url, resource_url
+
+
+# operazioni dello stack REST; ognuna restituisce "ok", "conflitto" o "errore"
+class RestClient:
+
+    def __init__(self, member: httpx.AsyncClient, resource: httpx.AsyncClient):
+        self.member = member
+        self.resource = resource
+
+    @staticmethod
+    def esito(response: httpx.Response) -> str:
+        if response.status_code == 409:
+            return "conflitto"
+        return "ok" if response.status_code < 400 else "errore"
+
+    async def seed_members(self, n: int) -> None:
+        corpo = "\n".join(json.dumps({"cf": cf(i), "name": "Nome", "surname": "Cognome"}) for i in range(n))
+        response = await self.member.post("/members/bulk", content=corpo.encode(),
+                                          headers={"Content-Type": "application/x-ndjson"})
+        response.raise_for_status()
+
+    async def lookup(self, i: int) -> str:
+        return self.esito(await self.member.get(f"/members/{cf(i)}"))
+
+    async def campi(self, giorno: date, tipologia: str) -> str:
+        return self.esito(await self.resource.get(f"/resources/campiliberi/{giorno.isoformat()}/{tipologia}"))
+
+    async def piscina(self, giorno: date) -> str:
+        return self.esito(await self.resource.get(f"/resources/piscinalibera/{giorno.isoformat()}"))
+
+    async def booking(self, i: int, slots: list[tuple[date, str, int]]) -> str:
+        return self.esito(await self.resource.post("/resources/campi", json=[
+            {"cf": cf(i), "data": giorno.isoformat(), "ora": ora, "tipologia": tipologia}
+            for giorno, tipologia, ora in slots]))
+
+
+# operazioni dello stack GraphQL: gli errori applicativi arrivano con stato 200 nel campo `errors`
+class GraphQLClient:
+
+    CONFLITTI = ("già prenotato", "already", "available")
+
+    def __init__(self, member: httpx.AsyncClient, resource: httpx.AsyncClient):
+        self.member = member
+        self.resource = resource
+
+    @classmethod
+    def esito(cls, response: httpx.Response) -> str:
+        if response.status_code >= 400:
+            return "errore"
+        errori = response.json().get("errors") or []
+        if not errori:
+            return "ok"
+        if all(any(c in e.get("message", "") for c in cls.CONFLITTI) for e in errori):
+            return "conflitto"
+        return "errore"
+
+    async def seed_members(self, n: int) -> None:
+        for inizio in range(0, n, 1000):
+            membri = [{"cf": cf(i), "name": "Nome", "surname": "Cognome"} for i in range(inizio, min(n, inizio + 1000))]
+            response = await self.member.post("/graphql", json={
+                "query": "mutation ($m: [MemberInput!]!) { addMembers(members: $m) { aggiunti } }",
+                "variables": {"m": membri}})
+            response.raise_for_status()
+
+    async def lookup(self, i: int) -> str:
+        return self.esito(await self.member.post("/graphql", json={
+            "query": "query ($cf: String!) { checkMember(cf: $cf) { cf name surname registrationDate } }",
+            "variables": {"cf": cf(i)}}))
+
+    async def campi(self, giorno: date, tipologia: str) -> str:
+        return self.esito(await self.resource.post("/graphql", json={
+            "query": "query ($d: Date!, $t: TipologiaCampo!) { getCampiliberi(data: $d, tipologia: $t) }",
+            "variables": {"d": giorno.isoformat(), "t": tipologia}}))
+
+    async def piscina(self, giorno: date) -> str:
+        return self.esito(await self.resource.post("/graphql", json={
+            "query": "query ($d: Date!) { getPiscinalibera(data: $d) { lettiniLiberi ombrelloniLiberi } }",
+            "variables": {"d": giorno.isoformat()}}))
+
+    async def booking(self, i: int, slots: list[tuple[date, str, int]]) -> str:
+        return self.esito(await self.resource.post("/graphql", json={
+            "query": "mutation ($b: [CampoBookingInput!]!) { addCampi(bookings: $b) }",
+            "variables": {"b": [{"cf": cf(i), "data": giorno.isoformat(), "ora": ora, "tipologia": tipologia}
+                                for giorno, tipologia, ora in slots]}}))
+
+
+CLIENTS = {"rest": RestClient, "graphql": GraphQLClient}
+
+
+class Statistiche:
+
+    def __init__(self):
+        self.latenze: dict[str, list[float]] = {op: [] for op in OPERAZIONI}
+        self.esiti: dict[str, dict[str, int]] = {op: {"ok": 0, "conflitto": 0, "errore": 0} for op in OPERAZIONI}
+
+    def add(self, operazione: str, esito: str, latenza: float) -> None:
+        self.latenze[operazione].append(latenza)
+        self.esiti[operazione][esito] += 1
+
+    def report(self, seconds: float) -> dict:
+        risultato = {}
+        for op in OPERAZIONI:
+            latenze = sorted(self.latenze[op])
+            if not latenze:
+                continue
+            n = len(latenze)
+            risultato[op] = {
+                "richieste": n,
+                "richieste_al_secondo": round(n / seconds, 1),
+                "conflitti": self.esiti[op]["conflitto"],
+                "errori": self.esiti[op]["errore"],
+                "tasso_errori": round(self.esiti[op]["errore"] / n, 4),
+                "p50_ms": round(latenze[int(n * 0.50)] * 1000, 1),
+                "p95_ms": round(latenze[min(n - 1, int(n * 0.95))] * 1000, 1),
+                "p99_ms": round(latenze[min(n - 1, int(n * 0.99))] * 1000, 1),
+            }
+        return risultato
+
+
+async def load(client, args, stats: Statistiche) -> None:
+    rnd = random.Random(args.seed)
+    inizio = time.monotonic()
+    fine = inizio + args.seconds
+
+    def mix_corrente() -> dict[str, float]:
+        trascorso = time.monotonic() - inizio
+        if args.burst_every and trascorso % args.burst_every >= args.burst_every - args.burst_seconds:
+            return args.burst_mix
+        return args.mix
+
+    async def operazione(nome: str) -> str:
+        if nome == "lookup":
+            return await client.lookup(rnd.randrange(args.members))
+        if nome == "campi":
+            return await client.campi(rnd.choice(GIORNI), rnd.choice(TIPOLOGIE))
+        if nome == "piscina":
+            return await client.piscina(rnd.choice(GIORNI))
+        giorno, tipologia = rnd.choice(GIORNI), rnd.choice(TIPOLOGIE)
+        prima = rnd.randint(10, 22 - SLOT_PER_PRENOTAZIONE)
+        return await client.booking(rnd.randrange(args.members),
+                                    [(giorno, tipologia, ora) for ora in range(prima, prima + SLOT_PER_PRENOTAZIONE)])
+
+    async def worker():
+        while time.monotonic() < fine:
+            mix = mix_corrente()
+            nome = rnd.choices(list(mix), weights=list(mix.values()))[0]
+            t = time.monotonic()
+            try:
+                esito = await operazione(nome)
+            except httpx.HTTPError:
+                esito = "errore"
+            stats.add(nome, esito, time.monotonic() - t)
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+async def bench(stack: str, member_url: str, resource_url: str, args) -> dict:
+    limiti = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=member_url, limits=limiti, timeout=60) as member, \
+            httpx.AsyncClient(base_url=resource_url, limits=limiti, timeout=60) as resource:
+        client = CLIENTS[stack](member, resource)
+        await client.seed_members(args.members)
+        # prenotazioni iniziali, così la disponibilità non è sempre quella di un giorno vuoto
+        rnd = random.Random(args.seed)
+        for n in range(args.bookings):
+            prima = rnd.randint(10, 22 - SLOT_PER_PRENOTAZIONE)
+            giorno, tipologia = rnd.choice(GIORNI), rnd.choice(TIPOLOGIE)
+            await client.booking(rnd.randrange(args.members),
+                                 [(giorno, tipologia, ora) for ora in range(prima, prima + SLOT_PER_PRENOTAZIONE)])
+
+        stats = Statistiche()
+        await load(client, args, stats)
+        return stats.report(args.seconds)
+
+
+def run(stack: str, args) -> dict:
+    cartella = tempfile.mkdtemp()
+    processi, member_url, resource_url = start_stack(stack, args.mode, cartella, args.verbose)
+    try:
+        return asyncio.run(bench(stack, member_url, resource_url, args))
+    finally:
+        for processo in processi:
+            processo.terminate()
+            processo.wait()
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+def table(risultati: dict) -> str:
+    colonne = ("richieste_al_secondo", "p50_ms", "p95_ms", "p99_ms", "tasso_errori", "conflitti")
+    righe = [f"{'stack':<8} {'operazione':<10} " + " ".join(f"{c:>20}" for c in colonne)]
+    for stack, operazioni in risultati.items():
+        for op, valori in operazioni.items():
+            righe.append(f"{stack:<8} {op:<10} " + " ".join(f"{valori[c]:>20}" for c in colonne))
+    return "\n".join(righe)
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stacks", default="rest,graphql", help="stack da confrontare, separati da virgola")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync", help="SERVICE_MODE dei servizi")
+    parser.add_argument("--concurrency", type=int, default=50, help="richieste contemporanee")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--members", type=int, default=5000, help="membri del dataset sintetico")
+    parser.add_argument("--bookings", type=int, default=300, help="prenotazioni iniziali")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("lookup=3,campi=4,piscina=2,booking=1"),
+                        help="pesi delle operazioni nel carico normale")
+    parser.add_argument("--burst-mix", type=parse_mix, default=parse_mix("lookup=1,campi=2,piscina=1,booking=6"),
+                        help="pesi delle operazioni durante le raffiche di prenotazioni")
+    parser.add_argument("--burst-every", type=float, default=10, help="secondi tra l'inizio di due raffiche, 0 per nessuna")
+    parser.add_argument("--burst-seconds", type=float, default=2, help="durata di una raffica")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--verbose", action="store_true", help="mostra i log dei servizi")
+    args = parser.parse_args()
+
+    risultati = {stack: run(stack, args) for stack in args.stacks.split(",")}
+    documento = {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit(),
+        "parametri": {k: v for k, v in vars(args).items() if k != "output"},
+        "risultati": risultati,
+    }
+    print(table(risultati))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(documento, f, indent=2)
+    else:
+        print(json.dumps(documento, indent=2))
@@ -0,0 +1,100 @@
+# Confronta il throughput di un carico misto di letture e scritture su SQLite tra la
+# configurazione originale (engine di default) e quella di storage.py (WAL, pragmi, pool separati).
+#
+#   python bench/storage.py --threads 8 --seconds 10 --writes 0.2
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "DEP", "resource-service", "app"))
+
+from sqlalchemy import create_engine, func  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from model import Base, PrenotazioniPiscina  # noqa: E402
+from storage import StorageConfig, create_engines  # noqa: E402
+
+GIORNI = [date(2030, 6, 1) + timedelta(days=i) for i in range(90)]
+
+
+def baseline(path: str):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    return engine, engine
+
+
+def tuned(path: str):
+    return create_engines(path, StorageConfig.from_env())
+
+
+def seed(engine, righe: int) -> None:
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all(PrenotazioniPiscina(cf=f"{i:016d}", data=random.choice(GIORNI), lettini=1, ombrelloni=0)
+                   for i in range(righe))
+        db.commit()
+
+
+def run(factory, threads: int, seconds: float, writes: float, righe: int) -> dict:
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    writer, reader = factory(path)
+    seed(writer, righe)
+    WriteSession = sessionmaker(bind=writer)
+    ReadSession = sessionmaker(bind=reader)
+
+    contatori = {"letture": 0, "scritture": 0, "errori": 0}
+    lock = threading.Lock()
+    fine = time.monotonic() + seconds
+    sequenza = iter(range(righe, 10 ** 9))
+
+    def worker():
+        locali = {"letture": 0, "scritture": 0, "errori": 0}
+        while time.monotonic() < fine:
+            try:
+                if random.random() < writes:
+                    with WriteSession() as db:
+                        db.add(PrenotazioniPiscina(cf=f"{next(sequenza):016d}", data=random.choice(GIORNI),
+                                                   lettini=1, ombrelloni=0))
+                        db.commit()
+                    locali["scritture"] += 1
+                else:
+                    with ReadSession() as db:
+                        db.query(func.sum(PrenotazioniPiscina.lettini)).filter(
+                            PrenotazioniPiscina.data == random.choice(GIORNI)).scalar()
+                    locali["letture"] += 1
+            except OperationalError:
+                locali["errori"] += 1
+        with lock:
+            for k, v in locali.items():
+                contatori[k] += v
+
+    with ThreadPoolExecutor(threads) as pool:
+        for _ in range(threads):
+            pool.submit(worker)
+
+    writer.dispose()
+    reader.dispose()
+    totale = contatori["letture"] + contatori["scritture"]
+    return {**contatori, "ops_al_secondo": round(totale / seconds, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writes", type=float, default=0.2, help="frazione di operazioni di scrittura")
+    parser.add_argument("--rows", type=int, default=20000, help="prenotazioni iniziali")
+    args = parser.parse_args()
+
+    risultati = {
+        "baseline": run(baseline, args.threads, args.seconds, args.writes, args.rows),
+        "tuned": run(tuned, args.threads, args.seconds, args.writes, args.rows),
+    }
+    print(json.dumps(risultati, indent=2))